@@ -1,3 +1,6 @@
 from fogcoap.data_manager import DataManager, StorageType, InvalidData, InvalidClient
+from fogcoap.storage_config import StorageConfig
+from fogcoap.admission import AdmissionController
 from fogcoap.alerts import AlertSpec
-from fogcoap.broker import Broker
\ No newline at end of file
+from fogcoap.broker import Broker
+from fogcoap.forwarder import Forwarder, FileSink, CoapSink
\ No newline at end of file
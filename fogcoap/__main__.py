@@ -1,15 +1,18 @@
 import fogcoap
 from sys import argv
+from argparse import ArgumentParser
+from pymongo.errors import PyMongoError
+from fogcoap.bulk import BulkImporter, BulkExporter
 
 
-def main():
+def run_broker(args: list):
 	database = 'fogcoap'
 	uri = 'mongodb://localhost'
-	if len(argv) >= 2:
-		database = argv[1]
+	if len(args) >= 1:
+		database = args[0]
 	
-	if len(argv) >= 3:
-		uri = argv[2]
+	if len(args) >= 2:
+		uri = args[1]
 	
 	print(f'Connecting to database {database} on uri {uri}')
 	dm = fogcoap.DataManager(database, uri)
@@ -20,5 +23,96 @@ def main():
 	print('Stopped')
 
 
+def run_import(args: list):
+	parser = ArgumentParser(prog='python -m fogcoap import', description='Imports CSV or NDJSON history files straight into the database.')
+	parser.add_argument('client', help='name of the registered client the readings belong to')
+	parser.add_argument('files', nargs='+', help='files to import, .csv, .ndjson or .jsonl, optionally gzip compressed as .gz')
+	parser.add_argument('-d', '--database', default='fogcoap', help='database name, defaults to fogcoap')
+	parser.add_argument('-u', '--uri', default='mongodb://localhost', help='mongo uri, defaults to mongodb://localhost')
+	parser.add_argument('-f', '--format', choices=('csv', 'ndjson'), help='format of the files, guessed from their extension if not set')
+	parser.add_argument('--time-column', default='time', help='CSV column with the time of the readings, defaults to time')
+	parser.add_argument('--skip', nargs='*', default=[], metavar='COLUMN', help='CSV columns that are not datatypes, such as an index')
+	parser.add_argument('--alerts', action='store_true', help='check every reading for alerts, rejecting the ones prohibiting the insert')
+	parser.add_argument('--workers', type=int, default=4, help='batches inserted at the same time, defaults to 4')
+	parser.add_argument('--batch-size', type=int, default=5000, help='readings per bulk insert, defaults to 5000')
+	options = parser.parse_args(args)
+
+	# Without warnings, old timestamps are expected when importing history
+	try:
+		dm = fogcoap.DataManager(options.database, options.uri, warnings=False)
+	except PyMongoError as e:
+		print(f'Failed to connect to the database: {e}')
+		exit(1)
+	importer = BulkImporter(dm, options.workers, options.batch_size, options.alerts)
+	try:
+		for path in options.files:
+			print(f'Importing {path}')
+			try:
+				result = importer.import_file(options.client, path, options.format, options.time_column, options.skip)
+			except (OSError, ValueError, fogcoap.InvalidClient, PyMongoError) as e:
+				print(f'Failed to import {path}: {e}')
+				exit(1)
+
+			print(f'Inserted {result.inserted} readings, rejected {result.rejected}, found {result.alerts} alerts')
+			for line, message in result.errors:
+				print(f'Line {line}: {message}')
+			if result.rejected > len(result.errors):
+				print(f'And {result.rejected - len(result.errors)} more rejected readings')
+	finally:
+		dm.close()
+
+
+def run_export(args: list):
+	parser = ArgumentParser(prog='python -m fogcoap export', description='Exports data to compressed files, one for each client and datatype.')
+	parser.add_argument('directory', help='directory the files are written to, created if needed')
+	parser.add_argument('-d', '--database', default='fogcoap', help='database name, defaults to fogcoap')
+	parser.add_argument('-u', '--uri', default='mongodb://localhost', help='mongo uri, defaults to mongodb://localhost')
+	parser.add_argument('-f', '--format', choices=('npz', 'parquet', 'ndjson'), default='npz',
+	                    help='npz for NumPy arrays, parquet (requires pyarrow) or gzip compressed ndjson, defaults to npz')
+	parser.add_argument('-c', '--client', nargs='*', metavar='CLIENT', help='only export these clients')
+	parser.add_argument('-t', '--datatype', nargs='*', metavar='DATATYPE', help='only export these datatypes')
+	parser.add_argument('--start', help='only export data from this date on, as an ISO date or a timestamp')
+	parser.add_argument('--end', help='only export data up to this date, as an ISO date or a timestamp')
+	parser.add_argument('--chunk-size', type=int, default=10000, help='readings read and written at a time, defaults to 10000')
+	options = parser.parse_args(args)
+
+	date_range = None
+	if options.start is not None or options.end is not None:
+		date_range = [int(date) if date is not None and date.isdigit() else date for date in (options.start, options.end)]
+
+	try:
+		dm = fogcoap.DataManager(options.database, options.uri)
+	except PyMongoError as e:
+		print(f'Failed to connect to the database: {e}')
+		exit(1)
+	exporter = BulkExporter(dm, options.chunk_size)
+	try:
+		counts = exporter.export(options.directory, options.format, options.client, options.datatype, date_range)
+	except (OSError, ValueError, ImportError, fogcoap.InvalidData, fogcoap.InvalidClient, PyMongoError) as e:
+		print(f'Failed to export: {e}')
+		exit(1)
+	finally:
+		dm.close()
+
+	for (client, datatype), count in sorted(counts.items()):
+		print(f'Exported {count} readings of {datatype} from {client}')
+	print(f'Exported {sum(counts.values())} readings to {options.directory}')
+
+
+# Subcommand -> function receiving the remaining arguments
+_Commands = {
+	'import': run_import,
+	'export': run_export
+}
+
+
+def main():
+	# Anything else is the database and uri of the broker, as before subcommands existed
+	if len(argv) >= 2 and argv[1] in _Commands:
+		_Commands[argv[1]](argv[2:])
+	else:
+		run_broker(argv[1:])
+
+
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,106 @@
+from math import ceil
+from time import monotonic
+from typing import Optional
+
+
+class TokenBucket:
+	"""
+	Classic token bucket: holds up to `burst` tokens, refilled at `rate` tokens per second.
+	"""
+
+	def __init__(self, rate: float, burst: int):
+		"""
+		:param rate: Tokens added per second.
+		:param burst: Maximum number of tokens, the size of a burst accepted after being idle.
+		"""
+		self._rate = rate
+		self._burst = burst
+		self._tokens = float(burst)
+		self._last = monotonic()
+
+	def take(self) -> float:
+		"""
+		Takes a token if one is available.
+		:return: 0 if a token was taken, otherwise the seconds until one is available.
+		"""
+		now = monotonic()
+		self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+		self._last = now
+
+		if self._tokens >= 1:
+			self._tokens -= 1
+			return 0
+		return (1 - self._tokens) / self._rate
+
+
+class AdmissionController:
+	"""
+	Bounds the work the broker accepts, so a misbehaving client or a burst of requests degrades the service instead of saturating the
+	database for everyone. Every limit is optional and left unbounded by default.
+	Not thread safe, must only be used from the event loop, as the broker's resources do.
+	"""
+
+	def __init__(self, client_rate: Optional[float] = None, client_burst: int = 10, max_in_flight: Optional[int] = None,
+	             max_readings: Optional[int] = None, busy_retry: int = 1):
+		"""
+		:param client_rate: Maximum sustained number of inserts per second accepted from each client. Excess requests are answered with
+		                    4.29 Too Many Requests, with a Max-Age option for the seconds until the client may retry.
+		:param client_burst: How many inserts a client can send at once after being idle, when `client_rate` is set.
+		:param max_in_flight: Maximum number of inserts being processed at the same time, from all clients. Excess requests are answered with
+		                      5.03 Service Unavailable, with a Max-Age option of `busy_retry` seconds.
+		:param max_readings: Maximum number of readings accepted in a single insert. Bigger inserts are answered with 4.13 Request Entity Too
+		                     Large, as retrying won't help, the client must split them.
+		:param busy_retry: Seconds a client is told to wait when the broker is busy.
+		"""
+		if client_rate is not None and client_rate <= 0:
+			raise ValueError('client_rate must be higher than 0')
+		if client_burst < 1:
+			raise ValueError('client_burst must be at least 1')
+		if max_in_flight is not None and max_in_flight <= 0:
+			raise ValueError('max_in_flight must be higher than 0')
+		if max_readings is not None and max_readings <= 0:
+			raise ValueError('max_readings must be higher than 0')
+
+		self._client_rate = client_rate
+		self._client_burst = client_burst
+		self._max_in_flight = max_in_flight
+		self.max_readings = max_readings
+		self.busy_retry = busy_retry
+
+		self._in_flight = 0
+		self._buckets = {}
+
+	def enter(self) -> bool:
+		"""
+		Starts processing a request, unless too many are already being processed. Every successful call must be followed by a `leave`.
+		:return: True if the request was admitted, False if the broker is busy.
+		"""
+		if self._max_in_flight is not None and self._in_flight >= self._max_in_flight:
+			return False
+
+		self._in_flight += 1
+		return True
+
+	def leave(self) -> None:
+		"""
+		Finishes processing a request admitted by `enter`.
+		"""
+		self._in_flight -= 1
+
+	def take(self, client: str) -> int:
+		"""
+		Takes one of the client's tokens.
+		:return: 0 if the request is within the client's rate, otherwise the seconds until the client may retry, rounded up.
+		"""
+		if self._client_rate is None:
+			return 0
+
+		bucket = self._buckets.get(client)
+		if bucket is None:
+			bucket = self._buckets[client] = TokenBucket(self._client_rate, self._client_burst)
+
+		return ceil(bucket.take())
+
+	@property
+	def in_flight(self) -> int:
+		return self._in_flight
@@ -1,10 +1,13 @@
 import json
+import asyncio
 import numpy as np
+from time import monotonic, time
+from collections import deque
 from enum import Enum
 from typing import Union, Tuple, Optional, List
-from aiocoap import Message
+from aiocoap import Code, Message
 from aiocoap.resource import ObservableResource
-from gzip import compress as gzcompress
+from gzip import compress as gzcompress, decompress as gzdecompress
 
 
 class ArrayTreatment(Enum):
@@ -171,18 +174,224 @@ class AlertSpec:
 		self.past_avg_count = count
 
 
+class _BadCompression(ValueError):
+	# Raised for parameters that are not properly compressed, answered without compression like `_gzip_payload` does
+	pass
+
+
+class AlertStream(ObservableResource):
+	"""
+	Observable resource that multiplexes the alerts of every client, so a single observation is enough to follow all of them.
+	"""
+	
+	def __init__(self, backlog: int = 1024):
+		"""
+		:param backlog: How many alert events are kept in memory for observers catching up from a sequence number.
+		"""
+		super().__init__()
+		
+		self._backlog = deque(maxlen=backlog)
+		self._seq = 0
+		# Sequence numbers restart with the broker, so observers must also know which run they belong to
+		self._epoch = int(time() * 1000)
+		# Server observation -> (datatype filter, client prefix filter)
+		self._filters = {}
+	
+	def publish(self, client: str, alerts: list):
+		"""
+		Adds an alert event to the stream and notifies every observer whose filters match it.
+		:param client: The name of the client that generated the alerts.
+		:param alerts: The alert list, as sent to the client's `ClientAlert` observers.
+		"""
+		self._seq += 1
+		event = {'e': self._epoch, 's': self._seq, 'c': client, 'a': alerts}
+		self._backlog.append(event)
+		
+		# Observers sharing the same filters share the same compressed payload
+		payloads = {}
+		for observation, filters in self._filters.items():
+			if filters not in payloads:
+				matched = self._filter_event(event, *filters)
+				payloads[filters] = self._dump([matched]) if matched is not None else None
+			
+			if payloads[filters] is not None:
+				observation.trigger(Message(code=Code.CONTENT, payload=payloads[filters]))
+	
+	async def add_observation(self, request: Message, serverobservation):
+		try:
+			datatype, prefix, _, _ = self._parse_parameters(request)
+		except ValueError:
+			# The render will answer with an error and end the observation
+			return
+		
+		self._filters[serverobservation] = (datatype, prefix)
+		
+		def _cancel(self=self, obs=serverobservation):
+			self._filters.pop(obs, None)
+		
+		serverobservation.accept(_cancel)
+	
+	async def render_get(self, request: Message):
+		"""
+		Get method for the alert stream.
+		If a payload is present, expects a gzip compressed json payload (preferably minified) with 3 optional keys:
+		`d` or `datatype`: only alerts for this datatype will be returned.
+		`c` or `client`: only alerts from clients whose name starts with this prefix will be returned.
+		`s` or `seq`: the last sequence number the observer has seen. Every retained event after it will be returned, so that reconnecting
+		              observers can catch up. If not set, only the latest event is returned.
+		`e` or `epoch`: the epoch of the sequence number. If it's not the current one, or the sequence number is higher than any sent, the
+		                broker restarted since and every retained event is returned.
+		
+		Returns a gzip compressed json list of events, each an object with 4 keys:
+		`e`: the epoch, which changes every time the broker starts, as sequence numbers restart from 1.
+		`s`: the event's sequence number.
+		`c`: the client's name.
+		`a`: the list of alerts, in the same format as the client's alert resource.
+		Notifications sent to observers contain only the new event.
+		"""
+		try:
+			datatype, prefix, seq, epoch = self._parse_parameters(request)
+		except _BadCompression as e:
+			return Message(code=Code.BAD_REQUEST, payload=json.dumps({'error': str(e)}).encode('ascii'))
+		except ValueError as e:
+			return Message(code=Code.BAD_REQUEST, payload=gzcompress(json.dumps({'error': str(e)}).encode('ascii')))
+		
+		if seq is None:
+			events = list(self._backlog)[-1:]
+		elif (epoch is not None and epoch != self._epoch) or seq > self._seq:
+			# Sequence number of a previous run, everything retained is new to the observer
+			events = list(self._backlog)
+		else:
+			events = [event for event in self._backlog if event['s'] > seq]
+		
+		matched = [self._filter_event(event, datatype, prefix) for event in events]
+		return Message(payload=self._dump([event for event in matched if event is not None]))
+	
+	@staticmethod
+	def _parse_parameters(request: Message) -> Tuple[Optional[str], Optional[str], Optional[int], Optional[int]]:
+		if len(request.payload) == 0:
+			return None, None, None, None
+		
+		try:
+			parameters = json.loads(gzdecompress(request.payload))
+		except OSError:
+			raise _BadCompression('Bad GZIP compression')
+		except (json.JSONDecodeError, UnicodeDecodeError):
+			raise ValueError('Bad JSON format')
+		
+		if not isinstance(parameters, dict):
+			raise ValueError('Bad JSON format')
+		
+		seq = parameters.get('s', parameters.get('seq'))
+		if seq is not None and (isinstance(seq, bool) or not isinstance(seq, int)):
+			raise ValueError('Sequence number must be an int')
+		
+		epoch = parameters.get('e', parameters.get('epoch'))
+		if epoch is not None and (isinstance(epoch, bool) or not isinstance(epoch, int)):
+			raise ValueError('Epoch must be an int')
+		
+		datatype = parameters.get('d') or parameters.get('datatype')
+		if datatype is not None and not isinstance(datatype, str):
+			raise ValueError('Datatype must be a str')
+		
+		prefix = parameters.get('c') or parameters.get('client')
+		if prefix is not None and not isinstance(prefix, str):
+			raise ValueError('Client prefix must be a str')
+		
+		return datatype, prefix, seq, epoch
+	
+	@staticmethod
+	def _filter_event(event: dict, datatype: Optional[str], prefix: Optional[str]) -> Optional[dict]:
+		if prefix is not None and not event['c'].startswith(prefix):
+			return None
+		
+		if datatype is None:
+			return event
+		
+		alerts = [alert for alert in event['a'] if alert.get('n') == datatype]
+		if len(alerts) == 0:
+			return None
+		
+		return {'e': event['e'], 's': event['s'], 'c': event['c'], 'a': alerts}
+	
+	@staticmethod
+	def _dump(events: list) -> bytes:
+		return gzcompress(json.dumps(events, separators=(',', ':'), ensure_ascii=True).encode('ascii'))
+
+
 class ClientAlert(ObservableResource):
-	def __init__(self):
+	def __init__(self, coalesce_window: float = 0, dedup_window: float = 0, min_interval: float = 0, client: str = None,
+	             stream: AlertStream = None):
+		"""
+		Observable resource that pushes a client's alerts to subscribed observers.
+		:param coalesce_window: How many seconds to wait after an alert arrives before notifying observers. Every alert received during
+		                        this window is sent in the same notification. If 0, observers are notified immediately.
+		:param dedup_window: For how many seconds an alert identical to the last one sent for the same datatype is dropped.
+		                     If 0, duplicated alerts are not dropped.
+		:param min_interval: Minimum amount of seconds between two alerts sent for the same datatype, alerts arriving sooner are dropped.
+		                     If 0, alerts are not rate limited.
+		:param client: The client's name, required if `stream` is set.
+		:param stream: An optional `AlertStream` to which every notification is also published.
+		"""
 		super().__init__()
 		
+		if stream is not None and client is None:
+			raise ValueError('A client name must be set to publish alerts to a stream')
+		
+		self._client = client
+		self._stream = stream
+		self._coalesce_window = coalesce_window
+		self._dedup_window = dedup_window
+		self._min_interval = min_interval
+		
 		self._last_alert = b''
+		self._pending = []
+		self._flush_handle = None
+		# Datatype name -> (time the last alert was accepted, the alert description)
+		self._last_accepted = {}
 		
 	def notify(self, alert):
 		"""
 		Called when you want to notify any subscribed clients of an alert.
-		:param alert: The JSON dumpable alert, probably generated from the database manager.
+		Alerts may be dropped if they are duplicated or rate limited and may be delayed if a coalescing window is set.
+		:param alert: The JSON dumpable alert list, probably generated from the database manager.
 		"""
-		self._last_alert = gzcompress(json.dumps(alert, separators=(',', ':'), ensure_ascii=True).encode('ascii'))
+		now = monotonic()
+		for single_alert in alert:
+			if self._accept(single_alert, now):
+				self._pending.append(single_alert)
+		
+		if len(self._pending) == 0:
+			return
+		
+		if self._coalesce_window <= 0:
+			self._flush()
+		elif self._flush_handle is None:
+			self._flush_handle = asyncio.get_event_loop().call_later(self._coalesce_window, self._flush)
+	
+	def _accept(self, alert: dict, now: float) -> bool:
+		last = self._last_accepted.get(alert.get('n'))
+		if last is not None:
+			last_time, last_description = last
+			if now - last_time < self._min_interval:
+				return False
+			if now - last_time < self._dedup_window and last_description == alert.get('a'):
+				return False
+		
+		self._last_accepted[alert.get('n')] = (now, alert.get('a'))
+		return True
+	
+	def _flush(self):
+		self._flush_handle = None
+		if len(self._pending) == 0:
+			return
+		
+		# Serialized and compressed only once, every observer's render shares the same payload
+		self._last_alert = gzcompress(json.dumps(self._pending, separators=(',', ':'), ensure_ascii=True).encode('ascii'))
+		if self._stream is not None:
+			self._stream.publish(self._client, self._pending)
+		
+		self._pending = []
 		self.updated_state()
 	
 	async def render_get(self, request: Message):
@@ -0,0 +1,107 @@
+import logging
+import threading
+from typing import List, Hashable, Optional
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+
+writer_logger = logging.Logger(__name__)
+
+
+class BatchWriter:
+	"""
+	Buffers write operations for a collection and sends them in unordered bulk writes from a background thread,
+	so whoever queues an operation never waits for the database.
+	"""
+
+	def __init__(self, collection: Collection, batch_size: int = 500, flush_interval: float = 1.0, max_pending: int = 100000):
+		"""
+		:param collection: The collection the operations will be written to.
+		:param batch_size: How many operations are sent in a single bulk write. Reaching this many queued operations also triggers a write.
+		:param flush_interval: Maximum amount of seconds an operation waits in the queue before being written.
+		:param max_pending: Maximum amount of queued operations. When full, new operations are dropped so memory stays bounded.
+		"""
+		self._collection = collection
+		self._batch_size = batch_size
+		self._flush_interval = flush_interval
+		self._max_pending = max_pending
+
+		self._pending = []
+		# Key -> index in the pending operations, for operations that replace each other
+		self._keyed = {}
+		self._condition = threading.Condition()
+		self._closed = False
+
+		self._thread = threading.Thread(target=self._run, name=f'BatchWriter-{collection.name}', daemon=True)
+		self._thread.start()
+
+	def put(self, operation, key: Optional[Hashable] = None) -> bool:
+		"""
+		Queues an operation, such as `pymongo.InsertOne` or `pymongo.UpdateOne`, to be written.
+		:param key: If set, the operation replaces any queued operation with the same key that wasn't written yet, so an often updated
+		            document is written once per batch instead of once per update.
+		:return: False if the operation was dropped because the queue is full, True otherwise.
+		"""
+		with self._condition:
+			closed = self._closed
+		if closed:
+			# Nothing would ever write it otherwise
+			self._write([operation])
+			return True
+
+		with self._condition:
+			if key is not None and key in self._keyed:
+				self._pending[self._keyed[key]] = operation
+				return True
+			
+			if len(self._pending) >= self._max_pending:
+				writer_logger.warning('Write queue for %s is full, dropping operation', self._collection.name)
+				return False
+
+			if key is not None:
+				self._keyed[key] = len(self._pending)
+			self._pending.append(operation)
+			if len(self._pending) >= self._batch_size:
+				self._condition.notify()
+
+		return True
+
+	def flush(self) -> None:
+		"""
+		Synchronously writes every queued operation.
+		"""
+		with self._condition:
+			batch, self._pending = self._pending, []
+			self._keyed.clear()
+		self._write(batch)
+
+	def close(self) -> None:
+		"""
+		Stops the background thread and writes every queued operation. Operations queued afterwards are written synchronously.
+		"""
+		with self._condition:
+			self._closed = True
+			self._condition.notify()
+		self._thread.join()
+		self.flush()
+
+	def _run(self):
+		while True:
+			with self._condition:
+				if not self._closed and len(self._pending) < self._batch_size:
+					self._condition.wait(self._flush_interval)
+
+				if self._closed:
+					return
+
+				batch, self._pending = self._pending, []
+				self._keyed.clear()
+
+			self._write(batch)
+
+	def _write(self, batch: List):
+		for i in range(0, len(batch), self._batch_size):
+			try:
+				self._collection.bulk_write(batch[i:i + self._batch_size], ordered=False)
+			except PyMongoError:
+				writer_logger.exception('Failed to write %d operations to %s', len(batch[i:i + self._batch_size]), self._collection.name)
@@ -1,20 +1,97 @@
+import os
+import bson
 import asyncio
+from functools import partial
 from signal import SIGINT, SIGTERM
-from aiocoap import Context
-from typing import Union
+from aiocoap import Context, Message, Code
+from aiocoap.error import NotFound
+from aiocoap.pipe import Pipe
+from typing import Union, Optional
+from traceback import print_exc
 from aiocoap.resource import Site, WKCResource, Resource, ObservableResource
 from fogcoap.data_manager import DataManager
-from fogcoap.resources import ClientResource, DatatypeResource, ListClientsResource, ListDatatypesResource, AllData
-from fogcoap.alerts import ClientAlert
+from fogcoap.resources import ClientResource, DatatypeResource, ListClientsResource, ListDatatypesResource, AllData, \
+	AlertHistoryResource, LatestResource, AllLatestResource
+from fogcoap.alerts import ClientAlert, AlertStream
+from fogcoap.forwarder import Forwarder
+from fogcoap.admission import AdmissionController
+from fogcoap.keys import KeyRegistry
+
+
+class _StartingSite(Site):
+	# Site answering requests for resources not yet set up with 5.03 instead of 4.04 while the broker is starting
+	def __init__(self):
+		super().__init__()
+		self.starting = True
+	
+	async def render_to_pipe(self, pipe: Pipe):
+		# The server dispatches every request through here, resolving the path and raising NotFound if no resource matches it
+		try:
+			return await super().render_to_pipe(pipe)
+		except NotFound:
+			if not self.starting:
+				raise
+			pipe.add_response(Message(code=Code.SERVICE_UNAVAILABLE, max_age=1, payload=b'{"error":"Server starting"}'), is_last=True)
 
 
 class Broker:
-	def __init__(self, db_manager: DataManager, port: int = 5683):
+	# Resources set up between each chance for the event loop to serve requests
+	_SetupBatch = 256
+	
+
+	def __init__(self, db_manager: DataManager, port: int = 5683, alert_coalesce_window: float = 0, alert_dedup_window: float = 0,
+	             alert_min_interval: float = 0, alert_backlog: int = 1024, retention_interval: Optional[float] = 3600,
+	             forwarder: Forwarder = None, observable_data: bool = False, admission: AdmissionController = None,
+	             preload_keys: bool = False, oscore_credentials: Optional[dict] = None, registry_snapshot: Optional[str] = None):
+		"""
+		The CoAP broker, serving the resources for every registered client and datatype.
+		:param db_manager: An instance of the database manager.
+		:param port: The port to listen on.
+		:param alert_coalesce_window: Seconds during which a client's alerts are grouped in a single notification, see `ClientAlert`.
+		:param alert_dedup_window: Seconds during which repeated alerts for the same client and datatype are dropped, see `ClientAlert`.
+		:param alert_min_interval: Minimum seconds between alerts for the same client and datatype, see `ClientAlert`.
+		:param alert_backlog: How many alert events the `/alerts` stream keeps for observers catching up, see `AlertStream`.
+		:param retention_interval: Seconds between each run of the database manager's `enforce_retention`, or `None` to never run it.
+		:param forwarder: An optional `Forwarder`, run alongside the broker to ship the received data upstream.
+		:param observable_data: Whether the client and datatype resources can be observed. Observers are pushed only the newly inserted
+		                        readings, instead of polling the whole history.
+		:param admission: An optional `AdmissionController`, limiting the rate and size of the inserts accepted from the clients.
+		:param preload_keys: Whether every client's public key is parsed in the background on startup. Otherwise, each key is only parsed when
+		                     its client first inserts data.
+		:param oscore_credentials: Optional OSCORE server credentials, in the format of `aiocoap.credentials.CredentialsMap.load_from_dict`.
+		                           A client whose credentials are named ":" followed by its name can insert data protected by OSCORE
+		                           instead of signing every payload, which is far cheaper for the broker once the security context is set
+		                           up. Requires aiocoap's oscore extra.
+		:param registry_snapshot: Optional path to a local snapshot of the client and datatype registries. The broker starts serving
+		                          before loading the registries, setting up their resources in the background. With a snapshot, they
+		                          are first loaded from it, without waiting for the database. The snapshot is rewritten after every start.
+		"""
 		self._db_manager = db_manager
 		self._port = port
+		self._alert_options = {
+			'coalesce_window': alert_coalesce_window,
+			'dedup_window': alert_dedup_window,
+			'min_interval': alert_min_interval
+		}
+		self._alert_stream = AlertStream(alert_backlog)
+		self._retention_interval = retention_interval
+		self._forwarder = forwarder
+		self._observable_data = observable_data
+		self._admission = admission
+		self._preload_keys = preload_keys
+		self._oscore_credentials = oscore_credentials
+		self._registry_snapshot = registry_snapshot
+		self._keys = KeyRegistry()
+		
+		# Names -> resources, for publishing inserted readings to observers
+		self._client_resources = {}
+		self._datatype_resources = {}
+		# Readings inserted since the last publish, as (client, datatype, document) tuples
+		self._pending_inserts = []
 		
 		self._loop = None
-		self._root = Site()
+		self._root = _StartingSite()
+		self._all_latest = None
 	
 	def add_topic(self, path: tuple, instance: Union[Resource, ObservableResource]):
 		"""
@@ -26,25 +103,101 @@ class Broker:
 		self._root.add_resource(path, instance)
 	
 	def _setup_resources(self):
+		# Only the resources not depending on the registries, the rest are set up by `_load_registries`
 		self.add_topic(('.well-known', 'core'), WKCResource(self._root.get_resources_as_linkheader))
 		self.add_topic(('alldata',), AllData(self._db_manager))
+		self.add_topic(('list', 'clients'), ListClientsResource(self._db_manager))
+		self.add_topic(('list', 'datatypes'),  ListDatatypesResource(self._db_manager))
+		self.add_topic(('alerts',), self._alert_stream)
+		self.add_topic(('alerts', 'history'), AlertHistoryResource(self._db_manager))
+		self._all_latest = AllLatestResource(self._db_manager)
+		self.add_topic(('latest',), self._all_latest)
+	
+	async def _load_registries(self):
+		try:
+			if self._registry_snapshot is not None and os.path.exists(self._registry_snapshot):
+				try:
+					clients, datatypes = await self._loop.run_in_executor(None, self._read_snapshot)
+				except Exception:
+					print_exc()
+				else:
+					await self._setup_registries(clients, datatypes)
+			
+			clients = await self._loop.run_in_executor(None, self._db_manager.query_clients)
+			datatypes = await self._loop.run_in_executor(None, self._db_manager.query_datatypes)
+			await self._setup_registries(clients, datatypes)
+			self._remove_stale(clients, datatypes)
+		except Exception:
+			# Whatever was loaded from the snapshot is still served
+			print_exc()
+			return
+		finally:
+			self._root.starting = False
 		
-		self._setup_clients()
-		self._setup_datatypes()
+		if self._registry_snapshot is not None:
+			await self._run_in_background(partial(self._write_snapshot, clients, datatypes))
+		if self._preload_keys:
+			await self._run_in_background(self._keys.preload)
+	
+	async def _setup_registries(self, clients: list, datatypes: list):
+		# Sets up the resources in batches, so the ones already set up are served meanwhile
+		for i, client in enumerate(clients, 1):
+			self._setup_client(client)
+			if i % self._SetupBatch == 0:
+				await asyncio.sleep(0)
 		
-	def _setup_clients(self):
-		self.add_topic(('list', 'clients'), ListClientsResource(self._db_manager))
+		for i, datatype in enumerate(datatypes, 1):
+			self._setup_datatype(datatype)
+			if i % self._SetupBatch == 0:
+				await asyncio.sleep(0)
+	
+	def _setup_client(self, client: dict):
+		self._keys.set_from_document(client)
+		if client['name'] in self._client_resources:
+			return
 		
-		for client in self._db_manager.query_clients():
-			alert_resource = ClientAlert()
-			self.add_topic(('alert', client['name']), alert_resource)
-			self.add_topic(('client', client['name']),  ClientResource(client['name'], client['ecc_public_key'], self._db_manager, alert_resource))
+		alert_resource = ClientAlert(client=client['name'], stream=self._alert_stream, **self._alert_options)
+		self.add_topic(('alert', client['name']), alert_resource)
+		latest_resource = LatestResource(client['name'], self._db_manager, self._all_latest)
+		self.add_topic(('latest', client['name']), latest_resource)
+		client_resource = ClientResource(client['name'], self._keys, self._db_manager, alert_resource, latest_resource,
+		                                 self._observable_data, self._admission)
+		self._client_resources[client['name']] = client_resource
+		self.add_topic(('client', client['name']), client_resource)
+	
+	def _setup_datatype(self, datatype: dict):
+		if datatype['name'] in self._datatype_resources:
+			return
 		
-	def _setup_datatypes(self):
-		self.add_topic(('list', 'datatypes'),  ListDatatypesResource(self._db_manager))
+		datatype_resource = DatatypeResource(datatype['name'], self._db_manager, self._observable_data)
+		self._datatype_resources[datatype['name']] = datatype_resource
+		self.add_topic(('datatype', datatype['name']), datatype_resource)
+	
+	def _remove_stale(self, clients: list, datatypes: list):
+		# Removes what was loaded from the snapshot but is no longer registered
+		names = {client['name'] for client in clients}
+		for name in [name for name in self._client_resources if name not in names]:
+			del self._client_resources[name]
+			self._keys.remove(name)
+			for path in (('client', name), ('alert', name), ('latest', name)):
+				self._root.remove_resource(path)
 		
-		for datatype in self._db_manager.query_datatypes():
-			self.add_topic(('datatype', datatype['name']), DatatypeResource(datatype['name'], self._db_manager))
+		names = {datatype['name'] for datatype in datatypes}
+		for name in [name for name in self._datatype_resources if name not in names]:
+			del self._datatype_resources[name]
+			self._root.remove_resource(('datatype', name))
+	
+	def _read_snapshot(self) -> tuple:
+		with open(self._registry_snapshot, 'rb') as file:
+			snapshot = bson.decode(file.read())
+		return snapshot['clients'], snapshot['datatypes']
+	
+	def _write_snapshot(self, clients: list, datatypes: list):
+		# Written to a temporary file first, so a crash never leaves a truncated snapshot behind
+		temporary = self._registry_snapshot + '.tmp'
+		with open(temporary, 'wb') as file:
+			file.write(bson.encode({'clients': clients, 'datatypes': datatypes}))
+		os.replace(temporary, self._registry_snapshot)
 	
 	def run(self):
 		self._setup_resources()
@@ -52,10 +205,82 @@ class Broker:
 		self._loop = asyncio.get_event_loop()
 		self._loop.add_signal_handler(SIGTERM, self.stop)
 		self._loop.add_signal_handler(SIGINT, self.stop)
+		if self._observable_data:
+			self._db_manager.add_insert_listener(self._on_insert)
+		self._db_manager.add_registry_listener(self._on_registry_change)
 		
-		asyncio.Task(Context.create_server_context(self._root, bind=('::', self._port)))
+		if self._oscore_credentials is None:
+			asyncio.Task(Context.create_server_context(self._root, bind=('::', self._port)))
+		else:
+			# Only imported when needed, as the oscore extra has dependencies of its own
+			from aiocoap.credentials import CredentialsMap
+			from aiocoap.oscore_sitewrapper import OscoreSiteWrapper
+			
+			credentials = CredentialsMap()
+			credentials.load_from_dict(self._oscore_credentials)
+			asyncio.Task(Context.create_server_context(OscoreSiteWrapper(self._root, credentials), bind=('::', self._port),
+			                                           server_credentials=credentials))
+		self._loop.create_task(self._load_registries())
+		self._loop.create_task(self._run_in_background(self._db_manager.seed_stats))
+		if self._retention_interval is not None:
+			self._loop.create_task(self._enforce_retention())
+		if self._forwarder is not None:
+			self._loop.create_task(self._forwarder.run())
 		self._loop.run_forever()
 	
+	async def _run_in_background(self, func):
+		try:
+			await self._loop.run_in_executor(None, func)
+		except Exception:
+			print_exc()
+	
+	def _on_registry_change(self, collection: str, name: Optional[str]):
+		# Reloads rotated keys, may be called from the registry watcher thread
+		if collection != 'client_registry':
+			return
+		
+		clients = [self._db_manager.query_client(name)] if name is not None else self._db_manager.query_clients()
+		for client in clients:
+			if client is not None and client['name'] in self._client_resources:
+				self._keys.set_from_document(client)
+	
+	def _on_insert(self, client: str, datatype: str, document: dict):
+		# May be called from the database manager's worker threads
+		self._loop.call_soon_threadsafe(self._queue_insert, client, datatype, document)
+	
+	def _queue_insert(self, client: str, datatype: str, document: dict):
+		# Readings queued before the event loop gets to publish them are published together. In sync mode, that's every reading of the
+		# same request, but in async mode they arrive one at a time from the worker threads and may be split. Observers never miss any,
+		# as readings published before a notification is sent are merged into it
+		if len(self._pending_inserts) == 0:
+			self._loop.call_soon(self._publish_inserts)
+		self._pending_inserts.append((client, datatype, document))
+	
+	def _publish_inserts(self):
+		inserts, self._pending_inserts = self._pending_inserts, []
+		
+		by_client = {}
+		by_datatype = {}
+		for client, datatype, document in inserts:
+			by_client.setdefault(client, {}).setdefault(datatype, []).append(document)
+			by_datatype.setdefault(datatype, {}).setdefault(client, []).append(document)
+		
+		for client, readings in by_client.items():
+			resource = self._client_resources.get(client)
+			if resource is not None:
+				resource.publish(readings)
+		
+		for datatype, readings in by_datatype.items():
+			resource = self._datatype_resources.get(datatype)
+			if resource is not None:
+				resource.publish(readings)
+	
+	async def _enforce_retention(self):
+		while True:
+			await asyncio.sleep(self._retention_interval)
+			# Always off the event loop, rolling up a big collection can take a while
+			await self._run_in_background(self._db_manager.enforce_retention)
+	
 	def stop(self, s=None, f=None):
 		self._loop.stop()
 		self._db_manager.close()
@@ -0,0 +1,407 @@
+import os
+import csv
+import gzip
+import json
+import zipfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pymongo.errors import PyMongoError
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, TextIO
+from fogcoap.data_manager import DataManager, StorageType, InvalidData, InvalidClient
+from fogcoap.encoding import encode_documents
+
+
+class ImportResult:
+	"""
+	Summary of an import. Only the first `MaxErrors` errors are kept, the rest are only counted.
+	"""
+	__slots__ = ('inserted', 'rejected', 'alerts', 'errors')
+	MaxErrors = 100
+
+	def __init__(self):
+		self.inserted = 0
+		self.rejected = 0
+		self.alerts = 0
+		# (line, error message) tuples
+		self.errors = []
+
+	def reject(self, line: int, message: str) -> None:
+		self.rejected += 1
+		if len(self.errors) < self.MaxErrors:
+			self.errors.append((line, message))
+
+
+class BulkImporter:
+	"""
+	Loads history files straight into the database, instead of replaying them to the broker one signed request at a time.
+	Files are streamed, only a few batches of readings are held in memory at once, and the batches are inserted by several threads with
+	`DataManager.insert_many`, so readings go through the same checks as when sent by a client.
+	Supported formats:
+	- CSV, with a header, a time column and one column per datatype, named after it, such as the files in `tests/sample_data`. Empty cells
+	  are skipped.
+	- NDJSON, with a reading per line, as a json object with the same keys accepted by `DataManager.insert_data`, or an array of them.
+	Either can be gzip compressed, if the file name ends in ".gz".
+	"""
+
+	def __init__(self, db_manager: DataManager, workers: int = 4, batch_size: int = 5000, check_alerts: bool = False):
+		"""
+		:param db_manager: An instance of the database manager.
+		:param workers: Number of batches inserted at the same time.
+		:param batch_size: Number of readings inserted by each bulk write.
+		:param check_alerts: Whether every reading is checked for alerts with `DataManager.verify_alert` before being inserted, which is
+		                     much slower. Alerts are recorded as usual, and readings with an alert prohibiting the insert are rejected.
+		"""
+		if workers < 1:
+			raise ValueError('workers must be at least 1')
+		if batch_size < 1:
+			raise ValueError('batch_size must be at least 1')
+
+		self._db_manager = db_manager
+		self._workers = workers
+		self._batch_size = batch_size
+		self._check_alerts = check_alerts
+
+	def import_file(self, client: str, path: str, file_format: Optional[str] = None, time_column: str = 'time',
+	                skip_columns: Iterable[str] = ()) -> ImportResult:
+		"""
+		Imports every reading of a file for a client.
+		:param client: The name of the registered client the readings belong to.
+		:param path: The path of the file.
+		:param file_format: Either "csv" or "ndjson". If None, it's guessed from the file's extension.
+		:param time_column: For CSV files, the name of the column with the time of the readings, as an ISO date or an int timestamp.
+		:param skip_columns: For CSV files, the names of columns that are not datatypes and must be ignored, such as an index.
+		:return: The summary of the import.
+		"""
+		if file_format is None:
+			file_format = self.guess_format(path)
+
+		opener = gzip.open if path.endswith('.gz') else open
+		with opener(path, 'rt', encoding='utf-8', newline='') as file:
+			if file_format == 'csv':
+				return self.import_readings(client, self.iter_csv(file, time_column, skip_columns))
+			if file_format == 'ndjson':
+				return self.import_readings(client, self.iter_ndjson(file))
+		raise ValueError(f'Unknown file format {file_format}, expected csv or ndjson')
+
+	def import_readings(self, client: str, readings: Iterable[Tuple[int, object]]) -> ImportResult:
+		"""
+		Imports readings for a client, in batches inserted by the worker threads.
+		:param client: The name of the registered client the readings belong to.
+		:param readings: An iterable of (line, reading) tuples. A reading that is an `InvalidData` instead of a dict is counted as rejected.
+		:raise InvalidClient: If the client is not registered, before importing anything.
+		:return: The summary of the import.
+		"""
+		if self._db_manager.query_client(client) is None:
+			raise InvalidClient('Specified client has not been registered')
+
+		result = ImportResult()
+		# Future -> its batch
+		pending = {}
+
+		with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='BulkImporter') as executor:
+			for batch in self._batches(readings, result):
+				# Bounded, so a huge file is never read into memory faster than it's written
+				if len(pending) >= 2 * self._workers:
+					done, _ = wait(pending, return_when=FIRST_COMPLETED)
+					self._collect(done, pending, result)
+				pending[executor.submit(self._insert_batch, client, batch)] = batch
+
+			self._collect(list(pending), pending, result)
+
+		return result
+
+	def iter_csv(self, file: TextIO, time_column: str = 'time', skip_columns: Iterable[str] = ()) -> Iterator[Tuple[int, object]]:
+		"""
+		Reads the readings of a CSV file, see the class documentation for its format.
+		:raise ValueError: If the time column is missing or a column is not a registered datatype, before reading any row.
+		:return: An iterator over (line, reading) tuples.
+		"""
+		reader = csv.reader(file)
+		header = next(reader, None)
+		if header is None:
+			return
+		if time_column not in header:
+			raise ValueError(f'Time column {time_column} not found')
+
+		time_index = header.index(time_column)
+		skip_columns = set(skip_columns)
+		columns = []
+		for i, name in enumerate(header):
+			if i == time_index or name in skip_columns:
+				continue
+
+			datatype = self._db_manager.query_datatype(name)
+			if datatype is None:
+				raise ValueError(f'Column {name} is not a registered datatype')
+			columns.append((i, name, StorageType(datatype['storage_type'])))
+
+		for row in reader:
+			if len(row) == 0:
+				continue
+			line = reader.line_num
+			if len(row) != len(header):
+				yield line, InvalidData('Row has a different number of columns than the header')
+				continue
+
+			time = self._parse_time(row[time_index])
+			for i, name, storage_type in columns:
+				if row[i] == '':
+					continue
+				try:
+					yield line, {'n': name, 'v': self._parse_value(row[i], storage_type), 't': time}
+				except ValueError:
+					yield line, InvalidData(f'Invalid value for {name}')
+
+	@staticmethod
+	def iter_ndjson(file: TextIO) -> Iterator[Tuple[int, object]]:
+		"""
+		Reads the readings of a NDJSON file, see the class documentation for its format.
+		:return: An iterator over (line, reading) tuples.
+		"""
+		for line, text in enumerate(file, 1):
+			if text.strip() == '':
+				continue
+
+			try:
+				item = json.loads(text)
+			except ValueError:
+				yield line, InvalidData('Bad JSON format')
+				continue
+
+			for reading in item if isinstance(item, list) else (item,):
+				yield line, reading if isinstance(reading, dict) else InvalidData('Reading is not a JSON object')
+
+	@staticmethod
+	def guess_format(path: str) -> str:
+		name = path[:-3] if path.endswith('.gz') else path
+		if name.endswith('.csv'):
+			return 'csv'
+		if name.endswith(('.ndjson', '.jsonl', '.json')):
+			return 'ndjson'
+		raise ValueError(f'Can\'t guess the format of {path}, expected a .csv, .ndjson or .jsonl file')
+
+	def _batches(self, readings: Iterable[Tuple[int, object]], result: ImportResult) -> Iterator[List[Tuple[int, dict]]]:
+		batch = []
+		for line, reading in readings:
+			if isinstance(reading, InvalidData):
+				result.reject(line, str(reading))
+				continue
+
+			batch.append((line, reading))
+			if len(batch) >= self._batch_size:
+				yield batch
+				batch = []
+
+		if len(batch) > 0:
+			yield batch
+
+	def _insert_batch(self, client: str, batch: List[Tuple[int, dict]]) -> Tuple[int, int, list]:
+		# Runs on the worker threads, returns the inserted count, the alert count and the rejected readings as (line, message) tuples
+		alerts = 0
+		rejected = []
+		if self._check_alerts:
+			allowed = []
+			for line, reading in batch:
+				try:
+					alert = self._db_manager.verify_alert(client, reading)
+				except InvalidData as e:
+					rejected.append((line, str(e)))
+					continue
+
+				if alert is not None:
+					alerts += 1
+					if alert['p']:
+						rejected.append((line, f'Insert prohibited by alert: {alert["a"]}'))
+						continue
+				allowed.append((line, reading))
+			batch = allowed
+
+		results = self._db_manager.insert_many(client, [reading for _, reading in batch])
+		inserted = 0
+		for (line, _), inserted_id in zip(batch, results):
+			if isinstance(inserted_id, InvalidData):
+				rejected.append((line, str(inserted_id)))
+			else:
+				inserted += 1
+
+		return inserted, alerts, rejected
+
+	@staticmethod
+	def _collect(futures, pending: dict, result: ImportResult):
+		for future in futures:
+			batch = pending.pop(future)
+			try:
+				inserted, alerts, rejected = future.result()
+			except PyMongoError as e:
+				# A single error for the whole batch, at its first line, instead of one for each of its readings
+				result.rejected += len(batch) - 1
+				result.reject(batch[0][0], f'Failed to write the batch of {len(batch)} readings up to line {batch[-1][0]}: {e}')
+				continue
+
+			result.inserted += inserted
+			result.alerts += alerts
+			for line, message in rejected:
+				result.reject(line, message)
+
+	@staticmethod
+	def _parse_time(value: str):
+		# Int timestamps are kept as ints, anything else is left for the database manager to parse as an ISO date
+		try:
+			return int(value)
+		except ValueError:
+			return value
+
+	@staticmethod
+	def _parse_value(value: str, storage_type: StorageType):
+		if storage_type is StorageType.STR:
+			return value
+		if storage_type is StorageType.ARRAY:
+			return json.loads(value)
+		try:
+			return int(value)
+		except ValueError:
+			return float(value)
+
+
+class _NdjsonWriter:
+	# A reading per line, as {"t": timestamp, "v": value}, gzip compressed as it's written
+	extension = '.ndjson.gz'
+
+	def __init__(self, path: str, storage_type: StorageType):
+		self._file = gzip.open(path, 'wb')
+
+	def write(self, columns: dict) -> None:
+		self._file.write(b''.join(encode_documents({'t': t, 'v': v}) + b'\n' for t, v in zip(columns['t'], columns['v'])))
+
+	def close(self) -> None:
+		self._file.close()
+
+
+class _NpzWriter:
+	# Each chunk as a pair of arrays, "t_N" with the datetimes and "v_N" with the values, so a chunk never waits for the next one
+	extension = '.npz'
+
+	def __init__(self, path: str, storage_type: StorageType):
+		self._file = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+		self._numbers = storage_type is StorageType.NUMBER
+		self._count = 0
+
+	def write(self, columns: dict) -> None:
+		if self._numbers:
+			values = np.array(columns['v'], dtype=float)
+		else:
+			try:
+				values = np.array(columns['v'])
+			except ValueError:
+				# Arrays of different lengths, only loadable with `allow_pickle=True`
+				values = np.array(columns['v'], dtype=object)
+
+		for name, array in ((f't_{self._count}', np.array(columns['t'], dtype='datetime64[ms]')), (f'v_{self._count}', values)):
+			with self._file.open(name + '.npy', 'w', force_zip64=True) as entry:
+				np.lib.format.write_array(entry, array, allow_pickle=True)
+		self._count += 1
+
+	def close(self) -> None:
+		self._file.close()
+
+
+class _ParquetWriter:
+	# A row group per chunk, with the columns "time" and "value" typed after the datatype's storage type
+	extension = '.parquet'
+
+	def __init__(self, path: str, storage_type: StorageType, array_type: Optional[StorageType] = None):
+		# Optional dependency, only needed for this format
+		import pyarrow
+		import pyarrow.parquet
+		self._pa = pyarrow
+		types = {StorageType.NUMBER: pyarrow.float64(), StorageType.STR: pyarrow.string()}
+		value_type = types.get(storage_type) or pyarrow.list_(types[array_type or StorageType.NUMBER])
+		self._schema = pyarrow.schema([('time', pyarrow.timestamp('ms')), ('value', value_type)])
+		self._writer = pyarrow.parquet.ParquetWriter(path, self._schema, compression='zstd')
+
+	def write(self, columns: dict) -> None:
+		pa = self._pa
+		table = pa.Table.from_arrays([pa.array(columns['t'], self._schema.field('time').type),
+		                              pa.array(columns['v'], self._schema.field('value').type)], schema=self._schema)
+		self._writer.write_table(table)
+
+	def close(self) -> None:
+		self._writer.close()
+
+
+class BulkExporter:
+	"""
+	Exports data to compressed files, one for each client and datatype, named "[CLIENT].[DATATYPE]" followed by the format's extension:
+	- "npz": NumPy arrays, in chunks, the arrays "t_0", "t_1"... holding the datetimes and "v_0", "v_1"... the values. Concatenate them to get
+	  the whole series.
+	- "parquet": Parquet files with the columns "time" and "value", requires pyarrow.
+	- "ndjson": gzip compressed NDJSON, a reading per line as {"t": timestamp, "v": value}.
+	The data is streamed with `DataManager.export`, so memory use is bounded by its chunk size and read concurrency, not by the data's size.
+	"""
+	_Writers = {
+		'npz': _NpzWriter,
+		'parquet': _ParquetWriter,
+		'ndjson': _NdjsonWriter
+	}
+
+	def __init__(self, db_manager: DataManager, chunk_size: int = 10000):
+		"""
+		:param db_manager: An instance of the database manager.
+		:param chunk_size: Maximum number of readings read and written at a time for each client and datatype.
+		"""
+		self._db_manager = db_manager
+		self._chunk_size = chunk_size
+
+	def export(self, directory: str, file_format: str = 'npz', clients: Optional[List[str]] = None, datatypes: Optional[List[str]] = None,
+	           date_range: Optional[list] = None) -> Dict[Tuple[str, str], int]:
+		"""
+		Exports the data to a directory, created if it doesn't exist.
+		:param directory: The directory the files are written to. Existing files with the same names are replaced.
+		:param file_format: Either "npz", "parquet" or "ndjson".
+		:param clients: An optional list of client names as a filter.
+		:param datatypes: An optional list of datatype names as a filter.
+		:param date_range: An optional list with the beginning and end dates to export, as accepted by `DataManager.query_all`.
+		:return: The number of exported readings of each (client name, datatype name).
+		"""
+		writer_class = self._Writers.get(file_format)
+		if writer_class is None:
+			raise ValueError(f'Unknown file format {file_format}, expected npz, parquet or ndjson')
+		os.makedirs(directory, exist_ok=True)
+
+		# Datatype name -> registry document
+		datatypes_info = {}
+		writers = {}
+		counts = {}
+		try:
+			for client, datatype, columns in self._db_manager.export(clients, datatypes, date_range, self._chunk_size):
+				key = (client, datatype)
+				if columns is None:
+					writer = writers.pop(key, None)
+					if writer is not None:
+						writer.close()
+					continue
+
+				writer = writers.get(key)
+				if writer is None:
+					if datatype not in datatypes_info:
+						datatypes_info[datatype] = self._db_manager.query_datatype(datatype)
+					writer = writers[key] = self._open(writer_class, directory, client, datatype, datatypes_info[datatype])
+				writer.write(columns)
+				counts[key] = counts.get(key, 0) + len(columns['t'])
+		finally:
+			for writer in writers.values():
+				writer.close()
+
+		return counts
+
+	@staticmethod
+	def _open(writer_class, directory: str, client: str, datatype: str, datatype_info: Optional[dict]):
+		path = os.path.join(directory, f'{client}.{datatype}{writer_class.extension}')
+		if datatype_info is None:
+			# Deleted datatype with data left behind, the values are exported as numbers
+			return writer_class(path, StorageType.NUMBER)
+
+		storage_type = StorageType(datatype_info['storage_type'])
+		if writer_class is _ParquetWriter and storage_type is StorageType.ARRAY:
+			return writer_class(path, storage_type, StorageType(datatype_info['array_type']))
+		return writer_class(path, storage_type)
@@ -1,18 +1,35 @@
+import bson
 import pymongo
 import re
 import logging
+import asyncio
+import threading
+import weakref
 import numpy as np
 from fogcoap.alerts import AlertSpec, ArrayTreatment
-from pymongo.errors import ConnectionFailure, DuplicateKeyError
+from fogcoap.batch_writer import BatchWriter
+from fogcoap.encoding import to_columns
+from fogcoap.log_pipeline import LogPipeline, StructuredFormatter
+from fogcoap.metadata import ClientInfo, DatatypeInfo
+from fogcoap.metadata_cache import MetadataCache
+from fogcoap.storage_config import StorageConfig
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, PyMongoError, OperationFailure, BulkWriteError
 from enum import Enum
 from bson.objectid import ObjectId
-from datetime import datetime
+from bson.errors import InvalidId
+from time import perf_counter
+from datetime import datetime, timedelta
+from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
-from typing import Union, Tuple, List, Optional
+from typing import Union, Tuple, List, Optional, Callable, Iterable, Iterator
 
 
 database_logger = logging.Logger(__name__)
+# Loggers of the existing instances, see `DataManager.set_logging_level`
+_instance_loggers = weakref.WeakSet()
 
 
 class StorageType(Enum):
@@ -48,9 +65,26 @@ class DataManager:
 	_ClientNameIndex = 'name_index'
 	_TypeMetadata = 'type_metadata'
 	_TypeMetadataNameIndex = 'type_index'
+	_Alerts = 'alerts'
+	_AlertIndex = 'alert_index'
+	_AlertTimeIndex = 'alert_time_index'
 	_Data = 'data'
+	_Summary = 'summary'
+	_RetentionIndex = 'retention_index'
+	_IndexOptionsConflict = 85
+	_RollupRuns = 'rollup_runs'
+	# Field marking the readings being summarized by a rollup run
+	_RollupMark = 'rollup_run'
+	_Checkpoints = 'forwarder_checkpoints'
+	_Latest = 'latest'
+	_UnionWithBatch = 500
+	# Only what `ClientInfo` keeps is read, not the keys
+	_ClientInfoProjection = {'name': True}
 
-	def __init__(self, database: str, uri: str = 'mongodb://localhost', warnings: bool = True) -> None:
+	def __init__(self, database: str, uri: str = 'mongodb://localhost', warnings: bool = True, persist_alerts: bool = True,
+	             cache_size: int = 10000, cache_ttl: Optional[float] = 300, negative_cache_ttl: Optional[float] = 30,
+	             preload_metadata: bool = False, watch_registry: bool = False, storage_config: StorageConfig = None,
+	             log_handler: logging.Handler = None) -> None:
 		"""
 		Instances and connects a DatabaseManager to a MongoDB.
 		:param database: The database name to use.
@@ -58,50 +92,102 @@ class DataManager:
 		:param warnings: When set to true, the Manager will throw warnings when creating datatypes or registering clients with similar
 		                 names to ones previously created, or when abnormalies happen, for example when data with a timestamp distant from
 		                 the server's is received.
+		:param persist_alerts: When set to true, every alert generated by `verify_alert` is stored in the alerts collection, written in
+		                       batches by a background thread, so they can be queried later with `query_alerts`.
+		:param cache_size: Maximum number of keys in each of the client, datatype and alert specification caches. Every cached client or
+		                   datatype takes two keys, its name and its `ObjectId`.
+		:param cache_ttl: Seconds a cached client or datatype is kept before being read again from the database. If None, never expires.
+		:param negative_cache_ttl: Seconds an unknown client or datatype name is remembered as not registered, so repeated requests for it
+		                           don't reach the database. If 0, unknown names are always looked up.
+		:param preload_metadata: When set to true, every registered client and datatype is loaded into the caches on startup.
+		:param watch_registry: When set to true, a background thread watches the registry and metadata collections and invalidates the caches
+		                       whenever they are changed by another process. Requires MongoDB to be running as a replica set.
+		:param storage_config: An optional `StorageConfig` with connection pool, compression, write concern and read preference settings
+		                       and whether the async mode is enabled. If not supplied, the driver's defaults are used.
+		:param log_handler: An optional handler writing this instance's log records, with its level and formatter set. Records are handed to
+		                    it by a background thread, see `LogPipeline`. If not supplied, they are written to stderr, with the client,
+		                    datatype and latency of inserts appended as `key=value` fields.
 		"""
 		# Setup logger #
 		# ======================= #
-		formatter = logging.Formatter(f'%(asctime)s - {database} - %(levelname)s - %(message)s')
-		handler = logging.StreamHandler()
-		handler.setFormatter(formatter)
-
-		if warnings:
-			handler.setLevel(logging.WARNING)
-		else:
-			handler.setLevel(logging.ERROR)
-
-		database_logger.addHandler(handler)
+		if log_handler is None:
+			log_handler = logging.StreamHandler()
+			log_handler.setFormatter(StructuredFormatter(f'%(asctime)s - {database} - %(levelname)s - %(message)s'))
+			log_handler.setLevel(logging.WARNING if warnings else logging.ERROR)
+		
+		# Each instance logs to its own logger, so its records are only written by its own handler
+		self._logger = logging.Logger(f'{__name__}.{database}', database_logger.level)
+		_instance_loggers.add(self._logger)
+		self._log_pipeline = LogPipeline(self._logger, log_handler)
 		# ======================= #
 
 		# Connect to database and setup data structure #
 		# ======================= #
 		
-		self._client = pymongo.MongoClient(uri)
+		if storage_config is None:
+			storage_config = StorageConfig()
+		self._storage_config = storage_config
+		
+		self._client = pymongo.MongoClient(uri, **storage_config.client_options())
 		try:
 			# The ismaster command is cheap and does not require auth.
 			self._client.admin.command('ismaster')
 		except ConnectionFailure:
-			database_logger.critical(f'Database connection to {uri} failed', flush=True)
+			self._logger.critical('Database connection to %s failed', uri)
+			self._log_pipeline.close()
 			raise
-		database_logger.info(f'Connected to database {database}')
+		self._logger.info('Connected to database %s', database)
 
 		self._database = self._client[database]
+		self._query_database = self._client.get_database(database, read_preference=storage_config.read_preference())
 
 		self._client_registry = self._database[self._ClientRegistry]
 		self._client_registry.create_index('name', name=self._ClientNameIndex, unique=True)
-		database_logger.debug('Created index on client names')
+		self._logger.debug('Created index on client names')
 
 		self._type_metadata = self._database[self._TypeMetadata]
 		self._type_metadata.create_index('name', name=self._TypeMetadataNameIndex, unique=True)
 		self._data = self._database[self._Data]
 		
+		self._alerts = self._database[self._Alerts]
+		self._alerts.create_index([('c', pymongo.ASCENDING), ('n', pymongo.ASCENDING), ('datetime', pymongo.ASCENDING)],
+		                          name=self._AlertIndex)
+		self._alerts.create_index('datetime', name=self._AlertTimeIndex)
+		self._alert_writer = BatchWriter(self._alerts) if persist_alerts else None
+		self._executor = None
+		self._query_executor = None
+		# Queries may run concurrently on the async executor, the query pool must only be created once
+		self._query_executor_lock = threading.Lock()
+		# Data collections whose retention index has already been checked
+		self._retention_indexed = set()
+		
+		# (client name, datatype name) -> [reading count, last reading datetime, bytes], maintained on insert
+		self._stats = {}
+		self._stats_lock = threading.Lock()
+		self._stats_version = 0
+		
+		# Client name -> {datatype name -> latest document}, maintained on insert and persisted in the background
+		self._latest = {}
+		self._latest_lock = threading.Lock()
+		self._latest_writer = BatchWriter(self._database[self._Latest])
+		self._load_latest()
+		
 		# ======================= #
 		
 		self.warnings = warnings
 		
-		self._cached_datatypes = {}
-		self._cached_clients = {}
-		self._cached_alert_specs = {}
+		self._client_cache = MetadataCache(cache_size, cache_ttl, negative_cache_ttl)
+		self._datatype_cache = MetadataCache(cache_size, cache_ttl, negative_cache_ttl)
+		self._registry_listeners = []
+		self._insert_listeners = []
+		
+		if preload_metadata:
+			self.preload_metadata()
+		
+		self._registry_watcher = None
+		if watch_registry:
+			self._registry_watcher = threading.Thread(target=self._watch_registry, name='RegistryWatcher', daemon=True)
+			self._registry_watcher.start()
 
 	def register_client(self, client: str, ecc_public_key: bytes) -> ObjectId:
 		"""
@@ -127,21 +213,45 @@ class DataManager:
 		try:
 			obj_id = self._client_registry.insert_one({'name': client, 'ecc_public_key': ecc_public_key}).inserted_id
 		except DuplicateKeyError:
-			database_logger.error(f'Failed to add client {client} as it\'s a duplicate')
+			self._logger.error('Failed to add client %s as it\'s a duplicate', client)
 			raise
-		database_logger.info(f'Registered new client {client} with id {obj_id}')
+		self._logger.info('Registered new client %s with id %s', client, obj_id)
+		self._registry_changed(self._ClientRegistry, client)
 		# ======================= #
 
 		# ======================= #
 		# Warn for similarities if necessary #
 		if similar_names > 0:
-			database_logger.warning(f'There are {similar_names} clients with similar names to {client}')
+			self._logger.warning('There are %d clients with similar names to %s', similar_names, client)
 		# ======================= #
 
 		return obj_id
 
+	def rotate_client_key(self, client: Union[str, ObjectId], ecc_public_key: bytes, grace_period: float = 3600) -> None:
+		"""
+		Replaces a client's public key. The previous key stays valid for a while, so the client can switch keys without losing data.
+		Running brokers pick the new key up through the registry listeners, without restarting.
+		:param client: Either the client name as a string or the client's `ObjectId`.
+		:param ecc_public_key: The new ECC PEM encoded public key.
+		:param grace_period: Seconds the previous key is still accepted. If 0, it stops being accepted immediately.
+		"""
+		# Checks for errors on the public key, will be used for nothing else
+		serialization.load_pem_public_key(ecc_public_key, default_backend())
+		
+		document = self._client_registry.find_one({'_id': client} if isinstance(client, ObjectId) else {'name': client})
+		if document is None:
+			raise InvalidClient('Specified client has not been registered')
+		
+		self._client_registry.update_one({'_id': document['_id']}, {'$set': {
+			'ecc_public_key': ecc_public_key,
+			'previous_key': document['ecc_public_key'],
+			'previous_key_expiry': datetime.now() + timedelta(seconds=grace_period)
+		}})
+		self._logger.info('Rotated the key of client %s', document['name'], extra={'client': document['name']})
+		self._registry_changed(self._ClientRegistry, document['name'], document['_id'])
+	
 	def register_datatype(self, name: str, storage_type: StorageType, array_type: StorageType = None, unit: str = None,
-	                      valid_bounds: tuple = None, alert_spec: AlertSpec = None) -> ObjectId:
+	                      valid_bounds: tuple = None, alert_spec: AlertSpec = None, retention: int = None, rollup: int = None) -> ObjectId:
 		"""
 		Register a type of data that will be inserted into the DB.
 		Unregistered types or data that does not match the requirements will be rejected.
@@ -154,6 +264,11 @@ class DataManager:
 		of the data to be stored. Both bounds are optional, being ignored if passed as `None`.
 		:param alert_spec: An optional instance of `AlertSpec`, which specifies how (and if) alerts should be generated.
 		will be generated. Both bounds are optional, being ignored if passed as `None`.
+		:param retention: An optional amount of seconds to keep the data for, measured from the data's timestamp. Older data is deleted by a
+		TTL index, or by `enforce_retention` if `rollup` is set. If `None`, data is kept forever.
+		:param rollup: An optional amount of seconds. If set, instead of simply being deleted, expired data is first summarized into
+		buckets of this many seconds, with the count, sum, min and max of the values, stored in "summary.[CLIENT].[DATATYPE]" collections.
+		Requires `retention` to be set and can only be used with the NUMBER type.
 		:return: The ObjectId for the type in the database.
 		"""
 		# ======================= #
@@ -163,7 +278,7 @@ class DataManager:
 			raise TypeError(f'Invalid storage_type when registering type {name}')
 		
 		if storage_type is not StorageType.ARRAY and array_type is not None:
-			database_logger.warning('Parameter array_type will be ignored if storage_type is not ARRAY')
+			self._logger.warning('Parameter array_type will be ignored if storage_type is not ARRAY')
 			array_type = None
 		
 		if storage_type is StorageType.ARRAY:
@@ -185,10 +300,12 @@ class DataManager:
 		else:
 			if valid_bounds is not None:
 				valid_bounds = None
-				database_logger.warning('Can\'t set bounds for STRs, they will be ignored')
+				self._logger.warning('Can\'t set bounds for STRs, they will be ignored')
 			if alert_spec is not None:
 				alert_spec = None
-				database_logger.warning('Can\'t set alert thresholds for STRs, they will be ignored')
+				self._logger.warning('Can\'t set alert thresholds for STRs, they will be ignored')
+		
+		retention, rollup = self._verify_retention(retention, rollup, storage_type)
 		# ======================= #
 		
 		# ======================= #
@@ -208,16 +325,19 @@ class DataManager:
 				'array_type': None if array_type is None else array_type.value,
 				'unit': unit,
 				'valid_bounds': valid_bounds,
-				'alert_spec': alert_spec.to_dict() if alert_spec is not None else None
+				'alert_spec': alert_spec.to_dict() if alert_spec is not None else None,
+				'retention': retention,
+				'rollup': rollup
 			}).inserted_id
 		except DuplicateKeyError:
-			database_logger.error(f'Failed to add type {name} as it\'s a duplicate')
+			self._logger.error('Failed to add type %s as it\'s a duplicate', name)
 			raise
-		database_logger.info(f'Registered new type {name} with id {obj_id}')
+		self._logger.info('Registered new type %s with id %s', name, obj_id)
+		self._registry_changed(self._TypeMetadata, name)
 		
 		# Warn for similarities if necessary #
 		if similar_names > 0:
-			database_logger.warning(f'There are {similar_names} types with similar names to {name}')
+			self._logger.warning('There are %d types with similar names to %s', similar_names, name)
 		# ======================= #
 	
 		return obj_id
@@ -234,64 +354,142 @@ class DataManager:
 		:return: The ObjectID of the inserted data.
 		
 		"""
+		start = perf_counter()
 		# ======================= #
 		# Check client #
 		client_info = self._verify_client(client)
 		# ======================= #
 		
-		# ======================= #
-		# Get values from dict #
-		data_name, data_value, data_datetime = self._verify_data(data)
-		# ======================= #
+		datatype_info, document = self._validate_reading(client_info, data)
 		
-		# ======================= #
-		# Verify the received data #
-		datatype_info = self._verify_datatype(data_name)
+		client_name, datatype_name = client_info.name, datatype_info.name
+		collection = self._data[client_name][datatype_name]
+		self._ensure_retention(collection, datatype_info)
+		self._seed_stats(client_name, datatype_name)
+		obj_id = collection.insert_one(document).inserted_id
+		self._update_stats(client_name, datatype_name, document)
+		self._update_latest(client_name, datatype_name, document)
 		
-		try:
-			value_type = StorageType.type_enum(type(data_value))
-			if value_type.value != datatype_info['storage_type']:
-				database_logger.info('Received data insert with incorrect value type')
-				raise InvalidData('Value type is different from the registered data type')
+		for callback in self._insert_listeners:
+			callback(client_name, datatype_name, document)
+		
+		# Checked first, so the extra fields aren't even built when nobody would see them
+		if self._logger.isEnabledFor(logging.INFO):
+			self._logger.info('Received successful data insert for client %s', client_name,
+			                   extra={'client': client_name, 'datatype': datatype_name, 'latency': perf_counter() - start})
+		return obj_id
+	
+	def insert_many(self, client: Union[str, ObjectId], data: Iterable[dict]) -> List[Union[ObjectId, 'InvalidData']]:
+		"""
+		Inserts many readings of a client at once, such as when importing history files.
+		Every reading goes through the same checks as in `insert_data`, then the valid ones are written with a single unordered bulk insert
+		per datatype, so a rejected reading never stops the others. Safe to call from several threads at once.
+		:param client: Either the client name as a string or the client's `ObjectId` as returned by the `register_client` method.
+		:param data: The readings, each a dictionary as accepted by `insert_data`.
+		:return: A list with, for each reading and in the same order, either the `ObjectId` of the inserted data or the `InvalidData` error
+		         that rejected it.
+		"""
+		start = perf_counter()
+		client_info = self._verify_client(client)
+		client_name = client_info.name
+		
+		results = []
+		# Datatype name -> (datatype info, documents, index in results of each document)
+		groups = {}
+		for data_item in data:
+			try:
+				datatype_info, document = self._validate_reading(client_info, data_item)
+			except InvalidData as e:
+				results.append(e)
+				continue
 			
-			if value_type is not StorageType.ARRAY:
-				if value_type is not StorageType.STR and datatype_info['valid_bounds'] is not None:
-					if (datatype_info['valid_bounds'][0] is not None and data_value < datatype_info['valid_bounds'][0]) or \
-					   (datatype_info['valid_bounds'][1] is not None and data_value > datatype_info['valid_bounds'][1]):
-						database_logger.info('Received data insert with value outside the allowed bounds')
-						raise InvalidData('Value is outside the valid bounds')
+			group = groups.get(datatype_info.name)
+			if group is None:
+				group = groups[datatype_info.name] = (datatype_info, [], [])
+			group[1].append(document)
+			group[2].append(len(results))
+			results.append(None)
+		
+		for datatype_name, (datatype_info, documents, indexes) in groups.items():
+			collection = self._data[client_name][datatype_name]
+			self._ensure_retention(collection, datatype_info)
+			self._seed_stats(client_name, datatype_name)
+			
+			failed = set()
+			try:
+				collection.insert_many(documents, ordered=False)
+			except BulkWriteError as e:
+				failed = {error['index'] for error in e.details['writeErrors']}
+			except PyMongoError:
+				# Which readings were written is unknown, so they are all reported as failed, without losing the other datatypes' results
+				self._logger.exception('Failed bulk insert of %d readings of %s for client %s', len(documents), datatype_name, client_name,
+				                        extra={'client': client_name, 'datatype': datatype_name, 'count': len(documents)})
+				failed = set(range(len(documents)))
+			
+			latest = None
+			for i, (document, index) in enumerate(zip(documents, indexes)):
+				if i in failed:
+					results[index] = InvalidData('Failed to write the reading')
+					continue
 				
+				results[index] = document['_id']
+				self._update_stats(client_name, datatype_name, document)
+				if latest is None or document['datetime'] >= latest['datetime']:
+					latest = document
+				for callback in self._insert_listeners:
+					callback(client_name, datatype_name, document)
+			
+			if latest is not None:
+				self._update_latest(client_name, datatype_name, latest)
+		
+		if self._logger.isEnabledFor(logging.INFO):
+			count = sum(len(documents) for _, documents, _ in groups.values())
+			self._logger.info('Received successful bulk insert of %d readings for client %s', count, client_name,
+			                   extra={'client': client_name, 'count': count, 'latency': perf_counter() - start})
+		return results
+	
+	def set_retention(self, datatype: Union[str, ObjectId], retention: Optional[int], rollup: Optional[int] = None) -> None:
+		"""
+		Changes the retention of a registered datatype, updating the TTL indexes of the data already stored.
+		:param datatype: Either the `ObjectID` or the name of the registered datatype.
+		:param retention: Seconds to keep the data for, or `None` to keep it forever. See `register_datatype`.
+		:param rollup: Size in seconds of the summary buckets for expired data, or `None` to simply delete it. See `register_datatype`.
+		"""
+		datatype_info = self._verify_datatype(datatype)
+		retention, rollup = self._verify_retention(retention, rollup, datatype_info.storage_type)
+		
+		self._type_metadata.update_one({'_id': datatype_info.id}, {'$set': {'retention': retention, 'rollup': rollup}})
+		self._registry_changed(self._TypeMetadata, datatype_info.name, datatype_info.id)
+		
+		for coll in self._database.list_collection_names(filter={'name': {'$regex': self._datatype_collections_regex(datatype_info.name)}}):
+			if retention is not None and rollup is None:
+				self._set_ttl_index(self._database[coll], retention)
 			else:
-				if len(data_value) == 0:
-					database_logger.info('Received array data insert with empty list')
-					raise InvalidData('Array of values is empty')
-				
-				for v in data_value:
-					v_type = StorageType.type_enum(type(v))
-					if v_type.value != datatype_info['array_type']:
-						database_logger.info('Received data insert with incorrect value type')
-						raise InvalidData('Value type in list is different from the registered array type')
-					if v_type is not StorageType.STR and datatype_info['valid_bounds'] is not None:
-						if (datatype_info['valid_bounds'][0] is not None and v < datatype_info['valid_bounds'][0]) or \
-						   (datatype_info['valid_bounds'][1] is not None and v > datatype_info['valid_bounds'][1]):
-							database_logger.info('Received data insert with value outside the allowed bounds')
-							raise InvalidData('Value in list is outside the valid bounds')
-					
-		except KeyError:
-			database_logger.info('Received data insert with incorrect value type')
-			raise InvalidData('Value type is not a valid type, expected number, str or list')
+				try:
+					self._database[coll].drop_index(self._RetentionIndex)
+				except OperationFailure:
+					# The index didn't exist
+					pass
+			self._retention_indexed.add(coll)
 		
-		if self.warnings:
-			time_diff = data_datetime.timestamp() - datetime.now().timestamp()
-			if time_diff >= 900:  # 15 minutes, make it configurable later?
-				database_logger.warning(f'Data received from {client_info["name"]} has timestamp ahead of the server by {time_diff} seconds, '
-				                        f'either server or client is desynced')
-			elif time_diff <= -86400:  # 1 day, make it configurable later?
-				database_logger.warning(f'Data received from {client_info["name"]} has timestamp behind of the server by {time_diff} seconds, '
-				                        f'either client is desynced or it was disconnected for a long time')
+		self._logger.info('Changed retention of type %s to %s seconds with rollup %s', datatype_info.name, retention, rollup,
+		                   extra={'datatype': datatype_info.name})
+	
+	def enforce_retention(self) -> int:
+		"""
+		Summarizes and deletes the expired data of every datatype with a `rollup` set. Data of datatypes without one is deleted by MongoDB
+		itself, through TTL indexes. Should be called periodically, the broker already does so.
+		:return: The number of deleted readings.
+		"""
+		deleted = 0
+		for document in self._type_metadata.find({'retention': {'$ne': None}, 'rollup': {'$ne': None}}):
+			cutoff = datetime.now() - timedelta(seconds=document['retention'])
+			for coll in self._database.list_collection_names(filter={'name': {'$regex': self._datatype_collections_regex(document['name'])}}):
+				deleted += self._rollup_collection(coll, cutoff, document['rollup'])
 		
-		database_logger.info(f'Received successful data insert for client {client_info["name"]}')
-		return self._data[str(client_info['name'])][str(datatype_info['name'])].insert_one({'value': data_value, 'datetime': data_datetime}).inserted_id
+		if deleted > 0:
+			self._logger.info('Rolled up and deleted %d expired readings', deleted, extra={'count': deleted})
+		return deleted
 
 	def verify_alert(self, client: Union[str, ObjectId], data: dict) -> Optional[dict]:
 		"""
@@ -308,27 +506,19 @@ class DataManager:
 		"""
 		data_name, data_value, data_datetime = self._verify_data(data)
 		datatype_info = self._verify_datatype(data_name)
-		if data_name in self._cached_alert_specs:
-			alert_spec = self._cached_alert_specs[data_name]
-		else:
-			if datatype_info['alert_spec'] is not None:
-				alert_spec = AlertSpec.from_dict(datatype_info['alert_spec'])
-				self._cached_alert_specs[data_name] = alert_spec
-			else:
-				alert_spec = None
-				self._cached_alert_specs[data_name] = None
+		alert_spec = datatype_info.alert_spec
 		
 		value_type = StorageType.type_enum(type(data_value))
-		if value_type.value != datatype_info['storage_type']:
-			database_logger.info('Received data insert with incorrect value type')
+		if value_type is not datatype_info.storage_type:
+			self._logger.info('Received data insert with incorrect value type')
 			raise InvalidData('Value type is different from the registered data type')
 		
 		if alert_spec is None or value_type is StorageType.STR:
 			return None
 		
 		# If it's an array of values, convert the value to be whatever it needs to be according to the spec
-		if value_type == StorageType.ARRAY and alert_spec.array_treatment is not ArrayTreatment.INDIVIDUALLY:
-			data_value = ArrayTreatment.get_func(alert_spec.array_treatment)(data_value)
+		if value_type is StorageType.ARRAY and datatype_info.array_func is not None:
+			data_value = datatype_info.array_func(data_value)
 		
 		alert_msg = {'n': data_name, 't': int(data_datetime.timestamp()), 'p': alert_spec.prohibit_insert}
 		
@@ -336,132 +526,329 @@ class DataManager:
 			alert = self._verify_alert_abs_thresholds(data_value, alert_spec.abs_alert_thresholds)
 			if alert is not None:
 				alert_msg['a'] = alert
-				return alert_msg
+				return self._record_alert(client, alert_msg, data_datetime)
 		
 		if alert_spec.alert_intervals is not None:
 			for interval in alert_spec.alert_intervals:
 				alert = self._verify_alert_interval(data_value, interval)
 				if alert is not None:
 					alert_msg['a'] = alert
-					return alert_msg
+					return self._record_alert(client, alert_msg, data_datetime)
 		
 		# We can assume that past_avg_count is also not None since an AlertSpec checks for it
 		if alert_spec.avg_deviation is not None:
-			client_info = self._verify_client(client)
+			collection = self._database[self._Data][self._verify_client(client).name][datatype_info.name]
 			# Only check avg if the number of documents stored is already higher than the past_avg_count necessary
-			if self._database[self._Data][client_info['name']][datatype_info['name']].count_documents({}) >= alert_spec.past_avg_count:
+			if collection.count_documents({}) >= alert_spec.past_avg_count:
 				past_values = [record['value'] for record in
-				               self._database[self._Data][client_info['name']][datatype_info['name']]
-				               .find(projection={'_id': 0, 'value': 1}).sort('_id', pymongo.DESCENDING).limit(alert_spec.past_avg_count)]
+				               collection.find(projection={'_id': 0, 'value': 1}).sort('_id', pymongo.DESCENDING).limit(alert_spec.past_avg_count)]
 				
-				if value_type == StorageType.ARRAY and alert_spec.array_treatment is not ArrayTreatment.INDIVIDUALLY:
-					past_values = list(map(ArrayTreatment.get_func(alert_spec.array_treatment), past_values))
+				if value_type is StorageType.ARRAY and datatype_info.array_func is not None:
+					past_values = list(map(datatype_info.array_func, past_values))
 					
 				avg = np.mean(past_values, axis=0)
 				
 				alert = self._verify_alert_avg_deviation(data_value, alert_spec.avg_deviation, avg)
 				if alert is not None:
 					alert_msg['a'] = alert
-					return alert_msg
+					return self._record_alert(client, alert_msg, data_datetime)
 		
 		return None
 
 	def query_data_client(self, client: Union[str, ObjectId], datatype: Union[str, ObjectId] = None,
-	                      date_range: Tuple[Union[str, int, datetime, None], Union[str, int, datetime, None]] = None) -> dict:
+	                      date_range: Tuple[Union[str, int, datetime, None], Union[str, int, datetime, None]] = None,
+	                      after: Union[str, ObjectId] = None, include_id: bool = True, limit: Optional[int] = None,
+	                      columnar: bool = False) -> dict:
 		"""
 		Queries the data for a specific client.
 		:param client: Either the `ObjectID` or the name of the registered client.
 		:param datatype: An optional `ObjectID` or the name of the registered datatype as a filter.
 		:param date_range: An optional tuple that specifies the beginning and end dates for querying.
+		:param after: An optional `ObjectId`, or its string representation, of the last document already seen. If set, only documents
+		              inserted after it are returned, sorted by insertion order, regardless of their timestamps.
+		:param include_id: Whether each document's `_id` should be returned. If False, it is left out by the database itself.
+		:param limit: An optional maximum number of documents returned for each datatype. Without `after`, these are the latest documents
+		              inserted, read with a backwards scan of the `_id` index, so `limit=1` returns the latest value. With `after`, these are the
+		              first documents inserted after it, for paging.
+		:param columnar: If True, each datatype's data is returned as a dict of lists instead of a list of documents, see `fogcoap.encoding.to_columns`.
 		:return: A dict with all the data.
 		"""
 		# ======================= #
 		# Check client #
-		client_info = self._verify_client(client)
-		client_filter = client_info['name']
+		client_filter = self._verify_client(client).name
 			
 		# ======================= #
 		# Check datatype #
 		if datatype:
-			datatype_info = self._verify_datatype(datatype)
-			datatype_filter = str(datatype_info['name'])
+			datatype_filter = re.escape(self._verify_datatype(datatype).name)
 		else:
-			datatype_filter = '.*'
+			datatype_filter = '[^.]+'
 		# ======================= #
-		date_filter = self._setup_date_filter(date_range)
+		date_filter = self._setup_query_filter(date_range, after)
+		projection = None if include_id else {'_id': False}
+		self._verify_limit(limit)
 		
-		all_data = {}
 		# Filter breaks down collections that start with the prefix for data
 		# The name format is "data.[CLIENT_ID].[DATATYPE_ID]"
-		for coll in self._database.list_collection_names(filter={'name': {'$regex': f'{self._Data}\.{client_filter}\.{datatype_filter}'}}):
-			_, client, datatype = coll.split('.')
-			
-			# Convert the returns to a list and add it to the dict
-			all_data[datatype] = list(self._database[coll].find(date_filter))
+		colls = self._query_database.list_collection_names(
+			filter={'name': {'$regex': f'^{self._Data}\\.{re.escape(client_filter)}\\.{datatype_filter}$'}}
+		)
 		
-		database_logger.info(f'Received successful client data query for client {client}')
+		# Collections are read concurrently and added to the dict as they arrive
+		all_data = {coll.split('.')[2]: data for coll, data in self._parallel_find(colls, date_filter, projection, limit, columnar)}
+		
+		self._logger.info('Received successful client data query for client %s', client, extra={'client': client})
 		return all_data
 
-	def query_data_type(self, datatype: Union[str, ObjectId], date_range: Tuple[Union[str, int, datetime, None], Union[str, int, datetime, None]] = None) -> dict:
+	def query_data_type(self, datatype: Union[str, ObjectId], date_range: Tuple[Union[str, int, datetime, None], Union[str, int, datetime, None]] = None,
+	                    after: Union[str, ObjectId] = None, include_id: bool = True, limit: Optional[int] = None, columnar: bool = False) -> dict:
 		"""
 		Queries the data for a specific datatype.
 		:param datatype: Either a `ObjectID` or the name of the registered datatype as a filter.
 		:param date_range: An optional tuple that specifies the beginning and end dates for querying.
+		:param after: An optional `ObjectId` of the last document already seen, see `query_data_client`.
+		:param include_id: Whether each document's `_id` should be returned, see `query_data_client`.
+		:param limit: An optional maximum number of documents returned for each client, see `query_data_client`.
+		:param columnar: If True, each client's data is returned as a dict of lists, see `query_data_client`.
 		:return: A dict with all the data.
 		"""
 		# ======================= #
 		# Check datatype #
-		datatype_info = self._verify_datatype(datatype)
-		datatype_filter = str(datatype_info['name'])
+		datatype_filter = self._verify_datatype(datatype).name
 		# ======================= #
-		date_filter = self._setup_date_filter(date_range)
+		date_filter = self._setup_query_filter(date_range, after)
+		projection = None if include_id else {'_id': False}
+		self._verify_limit(limit)
 		
-		all_data = {}
-		# Filter breaks down collections that start with the prefix for data
 		# The name format is "data.[CLIENT_ID].[DATATYPE_ID]"
-		for coll in self._database.list_collection_names(filter={'name': {'$regex': f'{self._Data}\..*\.{datatype_filter}'}}):
-			_, client, datatype = coll.split('.')
-			
-			# Convert the returns to a list and add it to the dict
-			all_data[client] = list(self._database[coll].find(date_filter))
+		colls = self._query_database.list_collection_names(filter={'name': {'$regex': self._datatype_collections_regex(datatype_filter)}})
+		
+		if self._storage_config.use_union_with:
+			all_data = self._union_find(colls, date_filter, projection, limit, columnar)
+		else:
+			all_data = {coll.split('.')[1]: data for coll, data in self._parallel_find(colls, date_filter, projection, limit, columnar)}
 		
-		database_logger.info(f'Received successful datatype data query for datatype {datatype}')
+		self._logger.info('Received successful datatype data query for datatype %s', datatype, extra={'datatype': datatype})
 		return all_data
 	
-	def query_all(self, date_range: Tuple[Union[str, int, datetime, None], Union[str, int, datetime, None]] = None) -> dict:
+	def query_all(self, date_range: Tuple[Union[str, int, datetime, None], Union[str, int, datetime, None]] = None,
+	              after: Union[str, ObjectId] = None, include_id: bool = True, limit: Optional[int] = None, columnar: bool = False) -> dict:
 		"""
 		Returns all actual data in the database, not including the metadata for clients and datatypes.
 		:param date_range: An optional tuple that specifies the beginning and end dates for querying.
+		:param after: An optional `ObjectId` of the last document already seen, see `query_data_client`.
+		:param include_id: Whether each document's `_id` should be returned, see `query_data_client`.
+		:param limit: An optional maximum number of documents returned for each client and datatype, see `query_data_client`.
+		:param columnar: If True, each client and datatype's data is returned as a dict of lists, see `query_data_client`.
 		:return: A dict with all the data.
 		"""
-		date_filter = self._setup_date_filter(date_range)
+		date_filter = self._setup_query_filter(date_range, after)
+		projection = None if include_id else {'_id': False}
+		self._verify_limit(limit)
 		all_data = {}
 		
 		# Filter breaks down collections that start with the prefix for data
 		# The name format is "data.[CLIENT_ID].[DATATYPE_ID]"
-		for coll in self._database.list_collection_names(filter={'name': {'$regex': f'{self._Data}\.'}}):
+		colls = self._query_database.list_collection_names(filter={'name': {'$regex': f'^{self._Data}\\.'}})
+		
+		# Collections are read concurrently and merged into the dict as they arrive
+		for coll, data in self._parallel_find(colls, date_filter, projection, limit, columnar):
 			_, client, datatype = coll.split('.')
 			
 			# Create the dicts for the client if it doesn't exist on the return yet
 			if not all_data.get(client):
 				all_data[client] = {}
 			
-			# Create the dicts for the datatype on the client if it doesn't exist on the return yet
-			if not all_data[client].get(datatype):
-				all_data[client][datatype] = {}
-			
-			# Convert the returns to a list and add it to the dict
-			all_data[client][datatype] = list(self._database[coll].find(date_filter))
+			all_data[client][datatype] = data
 		
-		database_logger.info('Received successful generic data query')
+		self._logger.info('Received successful generic data query')
 		return all_data
 	
+	def query_alerts(self, client: Union[str, ObjectId] = None, datatype: Union[str, ObjectId] = None,
+	                 date_range: Tuple[Union[str, int, datetime, None], Union[str, int, datetime, None]] = None) -> list:
+		"""
+		Queries the stored alert history, ordered by the data's time.
+		:param client: An optional `ObjectID` or the name of the registered client as a filter.
+		:param datatype: An optional `ObjectID` or the name of the registered datatype as a filter.
+		:param date_range: An optional tuple that specifies the beginning and end dates for querying.
+		:return: A list of alerts, each a dict with the keys "c" for the client name, "n" for the datatype name, "a" and "p" as returned by
+		         `verify_alert` and "datetime" for the time of the data that generated the alert.
+		"""
+		alert_filter = self._setup_date_filter(date_range) or {}
+		if client:
+			alert_filter['c'] = self._verify_client(client).name
+		if datatype:
+			alert_filter['n'] = self._verify_datatype(datatype).name
+		
+		self._logger.info('Received alert history query')
+		return list(self._query_database[self._Alerts].find(alert_filter).sort('datetime', pymongo.ASCENDING))
+	
+	def tail_data(self, client: str, datatype: str, after: Optional[ObjectId] = None, limit: int = 1000) -> list:
+		"""
+		Reads the data of a client and datatype in insertion order, starting after a known `ObjectId`.
+		:param client: The name of the client.
+		:param datatype: The name of the datatype.
+		:param after: The `ObjectId` of the last document already read. If `None`, reads from the beginning.
+		:param limit: Maximum number of documents returned.
+		:return: A list of documents, sorted by `_id`.
+		"""
+		id_filter = {'_id': {'$gt': after}} if after is not None else {}
+		return list(self._data[client][datatype].find(id_filter).sort('_id', pymongo.ASCENDING).limit(limit))
+	
+	def list_data_collections(self) -> List[Tuple[str, str]]:
+		"""
+		:return: A list of (client name, datatype name) tuples, one for each client and datatype combination with stored data.
+		"""
+		return [tuple(coll.split('.')[1:]) for coll in self._database.list_collection_names(filter={'name': {'$regex': f'^{self._Data}\\.'}})]
+	
+	def export(self, clients: Optional[List[Union[str, ObjectId]]] = None, datatypes: Optional[List[Union[str, ObjectId]]] = None,
+	           date_range: Tuple[Union[str, int, datetime, None], Union[str, int, datetime, None]] = None,
+	           chunk_size: int = 10000) -> Iterator[Tuple[str, str, Optional[dict]]]:
+		"""
+		Streams the data of many clients and datatypes in chunks, for exports too big to be queried at once.
+		Up to `query_concurrency` collections are read at the same time, each one a chunk at a time, so no more than that many chunks are
+		held in memory however much data is exported.
+		:param clients: An optional list of `ObjectID`s or names of registered clients as a filter.
+		:param datatypes: An optional list of `ObjectID`s or names of registered datatypes as a filter.
+		:param date_range: An optional tuple that specifies the beginning and end dates for exporting.
+		:param chunk_size: Maximum number of documents in each chunk.
+		:return: An iterator over (client name, datatype name, columns) tuples, where columns is a dict of lists, with the key "t" for the
+		         datetimes and "v" for the values. The chunks of each client and datatype come in insertion order, followed by a last tuple
+		         with `None` as columns once all of them were returned. Chunks of different clients and datatypes may be interleaved.
+		"""
+		if isinstance(chunk_size, bool) or not isinstance(chunk_size, int) or chunk_size <= 0:
+			raise ValueError('chunk_size must be an int higher than 0')
+		date_filter = self._setup_date_filter(date_range)
+		client_names = None if clients is None else {self._verify_client(client).name for client in clients}
+		datatype_names = None if datatypes is None else {self._verify_datatype(datatype).name for datatype in datatypes}
+		
+		colls = deque(f'{self._Data}.{client}.{datatype}' for client, datatype in self.list_data_collections()
+		              if (client_names is None or client in client_names) and (datatype_names is None or datatype in datatype_names))
+		
+		if self._storage_config.query_concurrency == 1:
+			for coll in colls:
+				_, client, datatype = coll.split('.')
+				after = None
+				while True:
+					documents = self._read_chunk(coll, date_filter, after, chunk_size)
+					if len(documents) > 0:
+						yield client, datatype, to_columns(documents, False)
+					if len(documents) < chunk_size:
+						break
+					after = documents[-1]['_id']
+				yield client, datatype, None
+			return
+		
+		query_executor = self._get_query_executor()
+		
+		# Future -> collection, with at most one chunk of each collection being read at a time
+		futures = {}
+		while len(colls) > 0 and len(futures) < self._storage_config.query_concurrency:
+			coll = colls.popleft()
+			futures[query_executor.submit(self._read_chunk, coll, date_filter, None, chunk_size)] = coll
+		
+		while len(futures) > 0:
+			done, _ = wait(futures, return_when=FIRST_COMPLETED)
+			for future in done:
+				coll = futures.pop(future)
+				documents = future.result()
+				_, client, datatype = coll.split('.')
+				if len(documents) > 0:
+					yield client, datatype, to_columns(documents, False)
+				
+				if len(documents) == chunk_size:
+					futures[query_executor.submit(self._read_chunk, coll, date_filter, documents[-1]['_id'], chunk_size)] = coll
+					continue
+				
+				yield client, datatype, None
+				if len(colls) > 0:
+					coll = colls.popleft()
+					futures[query_executor.submit(self._read_chunk, coll, date_filter, None, chunk_size)] = coll
+	
+	def load_checkpoints(self, name: str) -> dict:
+		"""
+		Loads the checkpoints saved by `save_checkpoints`.
+		:param name: The name the checkpoints were saved with.
+		:return: A dict with (client name, datatype name) tuples as keys and the last processed `ObjectId` as values.
+		"""
+		return {(checkpoint['_id']['c'], checkpoint['_id']['d']): checkpoint['last']
+		        for checkpoint in self._database[self._Checkpoints].find({'_id.n': name})}
+	
+	def save_checkpoints(self, name: str, checkpoints: dict) -> None:
+		"""
+		Persists the last processed `ObjectId` of each client and datatype, for consumers of `tail_data` such as the upstream forwarder.
+		:param name: A name identifying the consumer.
+		:param checkpoints: A dict with (client name, datatype name) tuples as keys and the last processed `ObjectId` as values.
+		"""
+		if len(checkpoints) == 0:
+			return
+		
+		self._database[self._Checkpoints].bulk_write([
+			pymongo.UpdateOne({'_id': {'n': name, 'c': client, 'd': datatype}}, {'$set': {'last': last}}, upsert=True)
+			for (client, datatype), last in checkpoints.items()
+		], ordered=False)
+	
+	def query_stats(self) -> dict:
+		"""
+		Returns statistics for the stored data, maintained on every insert instead of being queried.
+		Statistics for a client and datatype are only known after the first insert since startup, or after `seed_stats` is called.
+		Readings deleted by the retention policies are not subtracted.
+		:return: A dict with (client name, datatype name) tuples as keys and dicts as values, with the keys "count" for the number of
+		         readings, "last" for the datetime of the last reading received and "bytes" for the approximate size of the readings.
+		"""
+		with self._stats_lock:
+			return {key: {'count': count, 'last': last, 'bytes': size} for key, (count, last, size) in self._stats.items()}
+	
+	@property
+	def stats_version(self) -> int:
+		"""
+		A number that changes every time the statistics change, so callers can cheaply know when `query_stats` must be called again.
+		"""
+		return self._stats_version
+	
+	def seed_stats(self) -> None:
+		"""
+		Loads the statistics of every client and datatype with stored data, so `query_stats` is complete even before new inserts.
+		Costs a couple of queries per data collection, so it's better called in the background.
+		"""
+		for client, datatype in self.list_data_collections():
+			self._seed_stats(client, datatype)
+	
+	def query_latest(self, client: Optional[str] = None) -> dict:
+		"""
+		Returns the latest reading of each client and datatype, kept in memory and updated on every insert, so it never queries the data.
+		The latest reading is the one with the most recent timestamp, readings received late don't replace it.
+		:param client: An optional client name. If set, only the readings of that client are returned.
+		:return: If `client` is set, a dict with the datatype names as keys and the latest documents as values, otherwise a dict with client
+		         names as keys and those dicts as values.
+		"""
+		with self._latest_lock:
+			if client is not None:
+				return dict(self._latest.get(client, {}))
+			return {client_name: dict(datatypes) for client_name, datatypes in self._latest.items()}
+	
+	def query_client(self, client: str) -> Optional[dict]:
+		"""
+		Queries a single registered client, skipping the cache.
+		:param client: The client's name.
+		:return: The client, or `None` if it's not registered.
+		"""
+		return self._client_registry.find_one({'name': client})
+	
+	def query_datatype(self, datatype: str) -> Optional[dict]:
+		"""
+		Queries a single registered datatype, skipping the cache.
+		:param datatype: The datatype's name.
+		:return: The datatype, or `None` if it's not registered.
+		"""
+		return self._type_metadata.find_one({'name': datatype})
+	
 	def query_datatypes(self) -> list:
 		"""
 		Queries all the registered datatypes in the database.
 		:return: A list of datatypes on the database.
 		"""
-		database_logger.info('Received query for datatypes')
+		self._logger.info('Received query for datatypes')
 		# TODO: Add some filters?
 		return list(self._type_metadata.find())
 	
@@ -470,78 +857,507 @@ class DataManager:
 		Queries all the registered clients in the database.
 		:return: A list of clients on the database.
 		"""
-		database_logger.info('Received query for clients')
+		self._logger.info('Received query for clients')
 		# TODO: Extra logging
 		return list(self._client_registry.find())
 	
+	def preload_metadata(self) -> None:
+		"""
+		Loads every registered client and datatype into the caches, so the first requests don't need to query them.
+		Only as many entries as the cache size allows are kept.
+		"""
+		for document in self._client_registry.find(projection=self._ClientInfoProjection):
+			client_info = self._client_info(document)
+			self._client_cache.put((client_info.name, client_info.id), client_info)
+		
+		for document in self._type_metadata.find():
+			datatype_info = self._datatype_info(document)
+			self._datatype_cache.put((datatype_info.name, datatype_info.id), datatype_info)
+		
+		self._logger.info('Preloaded client and datatype metadata')
+	
+	def add_registry_listener(self, callback: Callable[[str, Optional[str]], None]) -> None:
+		"""
+		Adds a function to be called whenever a client or datatype is registered or changed.
+		If the registry is being watched, it may be called from a background thread.
+		:param callback: A function receiving the changed collection name, either "client_registry" or "type_metadata", and the name of
+		                 the changed client or datatype, which is None when it can't be known, such as when a document is deleted.
+		"""
+		self._registry_listeners.append(callback)
+	
+	@property
+	def async_mode(self) -> bool:
+		return self._storage_config.async_workers > 0
+	
+	async def run_async(self, func: Callable, *args, **kwargs):
+		"""
+		Runs a blocking function, usually one of this class's methods, from a coroutine.
+		In async mode, the function runs on one of the worker threads and the event loop is free to serve other requests meanwhile.
+		Otherwise, it is simply called.
+		:return: The function's return value.
+		"""
+		if not self.async_mode:
+			return func(*args, **kwargs)
+		
+		if self._executor is None:
+			self._executor = ThreadPoolExecutor(max_workers=self._storage_config.async_workers, thread_name_prefix='DataManager')
+		return await asyncio.get_event_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+	
+	def _get_query_executor(self) -> ThreadPoolExecutor:
+		with self._query_executor_lock:
+			if self._query_executor is None:
+				self._query_executor = ThreadPoolExecutor(max_workers=self._storage_config.query_concurrency,
+				                                          thread_name_prefix='DataManagerQuery')
+			return self._query_executor
+	
+	def add_insert_listener(self, callback: Callable[[str, str, dict], None]) -> None:
+		"""
+		Adds a function to be called after every successful insert. In async mode, it is called from the worker threads.
+		:param callback: A function receiving the client name, the datatype name and the inserted document, including its `_id`.
+		"""
+		self._insert_listeners.append(callback)
+	
 	def close(self) -> None:
 		"""
 		Closes the connection to the database. If the database is used again, it will be automatically re-opened.
+		Alerts still waiting to be persisted are written and running async operations are finished before closing.
 		"""
+		if self._executor is not None:
+			self._executor.shutdown()
+			self._executor = None
+		with self._query_executor_lock:
+			query_executor, self._query_executor = self._query_executor, None
+		if query_executor is not None:
+			query_executor.shutdown()
+		if self._alert_writer is not None:
+			self._alert_writer.close()
+		self._latest_writer.close()
 		self._client.close()
+		self._log_pipeline.close()
 	
-	def _verify_client(self, client: Union[str, ObjectId]) -> dict:
-		client_info = None
-		if client in self._cached_clients:
-			return self._cached_clients[client]
+	def _registry_changed(self, collection: str, name: Optional[str], obj_id: Optional[ObjectId] = None):
+		for key in (name, obj_id):
+			if key is None:
+				continue
+			
+			if collection == self._ClientRegistry:
+				self._client_cache.invalidate(key)
+			else:
+				self._datatype_cache.invalidate(key)
 		
+		for callback in self._registry_listeners:
+			callback(collection, name)
+	
+	def _watch_registry(self):
+		pipeline = [{'$match': {'ns.coll': {'$in': [self._ClientRegistry, self._TypeMetadata]}}}]
+		try:
+			with self._database.watch(pipeline, full_document='updateLookup') as stream:
+				for change in stream:
+					document = change.get('fullDocument') or {}
+					self._registry_changed(change['ns']['coll'], document.get('name'), change['documentKey']['_id'])
+		except PyMongoError as e:
+			self._logger.warning('Stopped watching the registry, caches will only be refreshed when they expire: %s', e)
+	
+	def _verify_client(self, client: Union[str, ObjectId]) -> ClientInfo:
+		client_info = self._client_cache.get(client)
+		if client_info is MetadataCache.NOT_FOUND:
+			raise InvalidClient('Specified client has not been registered')
+		if client_info is not MetadataCache.MISSING:
+			return client_info
+		
+		document = None
 		if isinstance(client, str):
-			client_info = self._client_registry.find_one({'name': client})
+			document = self._client_registry.find_one({'name': client}, self._ClientInfoProjection)
 		elif isinstance(client, ObjectId):
-			client_info = self._client_registry.find_one({'_id': client})
+			document = self._client_registry.find_one({'_id': client}, self._ClientInfoProjection)
 		
-		if client_info is None:
-			database_logger.info(f'Received data insert request for non registered client {client}')
+		if document is None:
+			self._logger.info('Received data insert request for non registered client %s', client, extra={'client': client})
+			self._client_cache.put_missing(client)
 			raise InvalidClient('Specified client has not been registered')
 		
-		self._cached_clients[client_info['name']] = client_info
-		self._cached_clients[client_info['_id']] = client_info
+		client_info = self._client_info(document)
+		self._client_cache.put((client_info.name, client_info.id), client_info)
 		
 		return client_info
 	
+	def _record_alert(self, client: Union[str, ObjectId], alert_msg: dict, data_datetime: datetime) -> dict:
+		if self._alert_writer is not None:
+			self._alert_writer.put(pymongo.InsertOne({
+				'c': self._verify_client(client).name,
+				'n': alert_msg['n'],
+				'datetime': data_datetime,
+				'a': alert_msg['a'],
+				'p': alert_msg['p']
+			}))
+		
+		return alert_msg
+	
+	def _ensure_retention(self, collection: pymongo.collection.Collection, datatype_info: DatatypeInfo):
+		if collection.name in self._retention_indexed:
+			return
+		
+		if datatype_info.retention is not None and datatype_info.rollup is None:
+			try:
+				self._set_ttl_index(collection, datatype_info.retention)
+			except PyMongoError as e:
+				# Not retried until the next restart or `set_retention`, an insert must never fail because of it
+				self._logger.error('Failed to set the retention index of %s, its data will not expire: %s', collection.name, e,
+				                   extra={'datatype': datatype_info.name})
+		self._retention_indexed.add(collection.name)
+	
+	def _set_ttl_index(self, collection: pymongo.collection.Collection, retention: int):
+		# Readings are stored as naive local time, which the TTL monitor reads as UTC, so the expiry is shifted by the UTC offset to
+		# make up for it. The offset is the one when the index is set, it's corrected on the next restart after a DST change
+		expiry = max(0, retention - int(datetime.now().astimezone().utcoffset().total_seconds()))
+		try:
+			collection.create_index('datetime', name=self._RetentionIndex, expireAfterSeconds=expiry)
+		except OperationFailure as e:
+			if e.code != self._IndexOptionsConflict:
+				raise
+			# The index already exists with a different expiry
+			self._database.command('collMod', collection.name, index={'name': self._RetentionIndex, 'expireAfterSeconds': expiry})
+	
+	def _seed_stats(self, client: str, datatype: str):
+		if (client, datatype) in self._stats:
+			return
+		
+		collection = self._data[client][datatype]
+		try:
+			storage = next(collection.aggregate([{'$collStats': {'storageStats': {}}}]), {}).get('storageStats', {})
+		except OperationFailure:
+			# The collection doesn't exist yet
+			storage = {}
+		last = collection.find_one(projection={'datetime': 1}, sort=[('_id', pymongo.DESCENDING)])
+		
+		with self._stats_lock:
+			if (client, datatype) not in self._stats:
+				self._stats[(client, datatype)] = [storage.get('count', 0), last['datetime'] if last else None, storage.get('size', 0)]
+				self._stats_version += 1
+	
+	def _update_stats(self, client: str, datatype: str, document: dict):
+		size = len(bson.encode(document))
+		with self._stats_lock:
+			stats = self._stats[(client, datatype)]
+			stats[0] += 1
+			if stats[1] is None or document['datetime'] > stats[1]:
+				stats[1] = document['datetime']
+			stats[2] += size
+			self._stats_version += 1
+	
+	def _load_latest(self):
+		for entry in self._database[self._Latest].find():
+			self._latest.setdefault(entry['_id']['c'], {})[entry['_id']['d']] = {
+				'_id': entry['i'], 'value': entry['value'], 'datetime': entry['datetime']
+			}
+	
+	def _update_latest(self, client: str, datatype: str, document: dict):
+		with self._latest_lock:
+			datatypes = self._latest.setdefault(client, {})
+			current = datatypes.get(datatype)
+			if current is not None and current['datetime'] > document['datetime']:
+				return
+			
+			datatypes[datatype] = dict(document)
+			# Queued under the lock so the last queued update is always the one in memory
+			self._latest_writer.put(pymongo.UpdateOne(
+				{'_id': {'c': client, 'd': datatype}},
+				{'$set': {'i': document['_id'], 'value': document['value'], 'datetime': document['datetime']}},
+				upsert=True
+			), key=(client, datatype))
+	
+	def _rollup_collection(self, coll: str, cutoff: datetime, rollup: int) -> int:
+		collection = self._database[coll]
+		runs = self._database[self._RollupRuns]
+		
+		# Each run marks the readings it summarizes and is recorded until they are deleted, so a run that failed halfway is finished by the
+		# next one instead of being summarized again
+		deleted = 0
+		pending = runs.find_one({'_id': coll})
+		if pending is not None:
+			deleted += self._finish_rollup(collection, pending['run'], rollup)
+		
+		expired_filter = {'datetime': {'$lt': cutoff}, self._RollupMark: {'$exists': False}}
+		if collection.find_one(expired_filter, projection={'_id': 1}) is None:
+			return deleted
+		
+		run = ObjectId()
+		runs.replace_one({'_id': coll}, {'run': run}, upsert=True)
+		# Readings inserted meanwhile are either marked now or left for the next run, never summarized without being deleted
+		collection.update_many(expired_filter, {'$set': {self._RollupMark: run}})
+		return deleted + self._finish_rollup(collection, run, rollup)
+	
+	def _finish_rollup(self, collection: pymongo.collection.Collection, run: ObjectId, rollup: int) -> int:
+		run_filter = {self._RollupMark: run}
+		# Buckets keep the last run merged into them, runs are finished in order so only the last one can have been merged already
+		merged = {'$eq': ['$run', run]}
+		
+		_, client, datatype = collection.name.split('.')
+		collection.aggregate([
+			{'$match': run_filter},
+			{'$group': {
+				'_id': {'$subtract': ['$datetime', {'$mod': [{'$toLong': '$datetime'}, rollup * 1000]}]},
+				'count': {'$sum': 1},
+				'sum': {'$sum': '$value'},
+				'min': {'$min': '$value'},
+				'max': {'$max': '$value'}
+			}},
+			{'$set': {'run': run}},
+			{'$merge': {
+				'into': f'{self._Summary}.{client}.{datatype}',
+				'on': '_id',
+				'whenMatched': [{'$set': {
+					'count': {'$cond': [merged, '$count', {'$add': ['$count', '$$new.count']}]},
+					'sum': {'$cond': [merged, '$sum', {'$add': ['$sum', '$$new.sum']}]},
+					'min': {'$cond': [merged, '$min', {'$min': ['$min', '$$new.min']}]},
+					'max': {'$cond': [merged, '$max', {'$max': ['$max', '$$new.max']}]},
+					'run': run
+				}}],
+				'whenNotMatched': 'insert'
+			}}
+		])
+		
+		deleted = collection.delete_many(run_filter).deleted_count
+		self._database[self._RollupRuns].delete_one({'_id': collection.name, 'run': run})
+		return deleted
+	
+	def _datatype_collections_regex(self, datatype: str) -> str:
+		return f'^{self._Data}\\.[^.]+\\.{re.escape(datatype)}$'
+	
 	def _verify_data(self, data: dict) -> Tuple[str, str, datetime]:
 		data_name = data.get('n') or data.get('name')
 		if data_name is None:
-			database_logger.info('Received data insert with missing data name')
+			self._logger.info('Received data insert with missing data name')
 			raise InvalidData('Data name "n" or "name" not specified')
 		
-		data_value = data.get('v') or data.get('value')
+		# Not `or`, a value of 0 is valid
+		data_value = data.get('v')
 		if data_value is None:
-			database_logger.info('Received data insert with missing data value')
+			data_value = data.get('value')
+		if data_value is None:
+			self._logger.info('Received data insert with missing data value')
 			raise InvalidData('Data value "v" or "value" not specified')
 		
 		data_timestamp = data.get('t') or data.get('time')
 		if data_timestamp is None:
-			database_logger.info('Received data insert with missing data time')
+			self._logger.info('Received data insert with missing data time')
 			raise InvalidData('Data timestamp "t" or "time" not specified')
 		
 		try:
 			data_datetime = self._parse_timestamp(data_timestamp)
 		except InvalidData:
-			database_logger.info('Received data insert with invalid time')
+			self._logger.info('Received data insert with invalid time')
 			raise
 		
 		return data_name, data_value, data_datetime
 	
-	def _verify_datatype(self, datatype: Union[str, ObjectId]) -> dict:
-		datatype_info = None
-		if datatype in self._cached_datatypes:
-			return self._cached_datatypes[datatype]
+	def _validate_reading(self, client_info: ClientInfo, data: dict) -> Tuple[DatatypeInfo, dict]:
+		# Every check a reading goes through before being stored, shared by `insert_data` and `insert_many`
+		# ======================= #
+		# Get values from dict #
+		data_name, data_value, data_datetime = self._verify_data(data)
+		# ======================= #
 		
+		# ======================= #
+		# Verify the received data #
+		datatype_info = self._verify_datatype(data_name)
+		
+		try:
+			value_type = StorageType.type_enum(type(data_value))
+			if value_type is not datatype_info.storage_type:
+				self._logger.info('Received data insert with incorrect value type')
+				raise InvalidData('Value type is different from the registered data type')
+			
+			lower_bound, upper_bound = datatype_info.lower_bound, datatype_info.upper_bound
+			if value_type is not StorageType.ARRAY:
+				if value_type is not StorageType.STR and datatype_info.has_bounds:
+					if (lower_bound is not None and data_value < lower_bound) or (upper_bound is not None and data_value > upper_bound):
+						self._logger.info('Received data insert with value outside the allowed bounds')
+						raise InvalidData('Value is outside the valid bounds')
+				
+			else:
+				if len(data_value) == 0:
+					self._logger.info('Received array data insert with empty list')
+					raise InvalidData('Array of values is empty')
+				
+				for v in data_value:
+					v_type = StorageType.type_enum(type(v))
+					if v_type is not datatype_info.array_type:
+						self._logger.info('Received data insert with incorrect value type')
+						raise InvalidData('Value type in list is different from the registered array type')
+					if v_type is not StorageType.STR and datatype_info.has_bounds:
+						if (lower_bound is not None and v < lower_bound) or (upper_bound is not None and v > upper_bound):
+							self._logger.info('Received data insert with value outside the allowed bounds')
+							raise InvalidData('Value in list is outside the valid bounds')
+					
+		except KeyError:
+			self._logger.info('Received data insert with incorrect value type')
+			raise InvalidData('Value type is not a valid type, expected number, str or list')
+		
+		if self.warnings:
+			time_diff = data_datetime.timestamp() - datetime.now().timestamp()
+			if time_diff >= 900:  # 15 minutes, make it configurable later?
+				self._logger.warning('Data received from %s has timestamp ahead of the server by %s seconds, either server or client is '
+				                      'desynced', client_info.name, time_diff, extra={'client': client_info.name, 'datatype': data_name})
+			elif time_diff <= -86400:  # 1 day, make it configurable later?
+				self._logger.warning('Data received from %s has timestamp behind of the server by %s seconds, either client is desynced or it '
+				                      'was disconnected for a long time', client_info.name, time_diff,
+				                      extra={'client': client_info.name, 'datatype': data_name})
+		
+		return datatype_info, {'value': data_value, 'datetime': data_datetime}
+	
+	def _verify_datatype(self, datatype: Union[str, ObjectId]) -> DatatypeInfo:
+		datatype_info = self._datatype_cache.get(datatype)
+		if datatype_info is MetadataCache.NOT_FOUND:
+			raise InvalidData('Specified datatype has not been registered')
+		if datatype_info is not MetadataCache.MISSING:
+			return datatype_info
+		
+		document = None
 		if isinstance(datatype, str):
-			datatype_info = self._type_metadata.find_one({'name': datatype})
+			document = self._type_metadata.find_one({'name': datatype})
 		elif isinstance(datatype, ObjectId):
-			datatype_info = self._type_metadata.find_one({'_id': datatype})
+			document = self._type_metadata.find_one({'_id': datatype})
 		
-		if datatype_info is None:
-			database_logger.info(f'Received client data query request for non registered datatype {datatype}')
+		if document is None:
+			self._logger.info('Received client data query request for non registered datatype %s', datatype, extra={'datatype': datatype})
+			self._datatype_cache.put_missing(datatype)
 			raise InvalidData('Specified datatype has not been registered')
 		
-		self._cached_datatypes[datatype_info['name']] = datatype_info
-		self._cached_datatypes[datatype_info['_id']] = datatype_info
+		datatype_info = self._datatype_info(document)
+		self._datatype_cache.put((datatype_info.name, datatype_info.id), datatype_info)
 	
 		return datatype_info
 	
+	@staticmethod
+	def _client_info(document: dict) -> ClientInfo:
+		return ClientInfo(document['_id'], document['name'])
+	
+	@staticmethod
+	def _datatype_info(document: dict) -> DatatypeInfo:
+		# Resolves once everything the inserts and alerts would otherwise resolve on every reading
+		storage_type = StorageType(document['storage_type'])
+		array_type = StorageType(document['array_type']) if document.get('array_type') is not None else None
+		lower_bound, upper_bound = document.get('valid_bounds') or (None, None)
+		
+		alert_spec = AlertSpec.from_dict(document['alert_spec']) if document.get('alert_spec') is not None else None
+		array_func = None
+		if alert_spec is not None and alert_spec.array_treatment not in (None, ArrayTreatment.INDIVIDUALLY):
+			array_func = ArrayTreatment.get_func(alert_spec.array_treatment)
+		
+		return DatatypeInfo(document['_id'], document['name'], storage_type, array_type, document.get('unit'), lower_bound, upper_bound,
+		                    alert_spec, array_func, document.get('retention'), document.get('rollup'))
+	
+	def _union_find(self, colls: List[str], query_filter: Optional[dict], projection: Optional[dict] = None, limit: Optional[int] = None,
+	                columnar: bool = False) -> dict:
+		# Every client's collection is read by a single aggregation, each document tagged with its client
+		all_data = {coll.split('.')[1]: [] for coll in colls}
+		
+		for i in range(0, len(colls), self._UnionWithBatch):
+			batch = colls[i:i + self._UnionWithBatch]
+			pipeline = self._union_stages(batch[0], query_filter, projection, limit)
+			for coll in batch[1:]:
+				pipeline.append({'$unionWith': {'coll': coll, 'pipeline': self._union_stages(coll, query_filter, projection, limit)}})
+			
+			for document in self._query_database[batch[0]].aggregate(pipeline):
+				all_data[document.pop('_client')].append(document)
+		
+		for client, documents in all_data.items():
+			if self._is_backwards_scan(query_filter, limit):
+				documents.reverse()
+			if columnar:
+				all_data[client] = to_columns(documents, projection is None)
+		
+		return all_data
+	
+	@staticmethod
+	def _union_stages(coll: str, query_filter: Optional[dict], projection: Optional[dict], limit: Optional[int]) -> list:
+		stages = [{'$match': query_filter or {}}]
+		if DataManager._is_backwards_scan(query_filter, limit):
+			stages.append({'$sort': {'_id': pymongo.DESCENDING}})
+		elif limit is not None or (query_filter is not None and '_id' in query_filter):
+			stages.append({'$sort': {'_id': pymongo.ASCENDING}})
+		if limit is not None:
+			stages.append({'$limit': limit})
+		if projection is not None:
+			stages.append({'$project': projection})
+		stages.append({'$addFields': {'_client': coll.split('.')[1]}})
+		return stages
+	
+	def _parallel_find(self, colls: List[str], query_filter: Optional[dict], projection: Optional[dict] = None, limit: Optional[int] = None,
+	                   columnar: bool = False):
+		"""
+		Reads each collection on a bounded pool of threads, yielding (collection name, documents) tuples as they are completed.
+		"""
+		if len(colls) <= 1 or self._storage_config.query_concurrency == 1:
+			for coll in colls:
+				yield coll, self._read(coll, query_filter, projection, limit, columnar)
+			return
+		
+		query_executor = self._get_query_executor()
+		
+		futures = {query_executor.submit(self._read, coll, query_filter, projection, limit, columnar): coll for coll in colls}
+		for future in as_completed(futures):
+			yield futures[future], future.result()
+	
+	def _read(self, coll: str, query_filter: Optional[dict], projection: Optional[dict], limit: Optional[int], columnar: bool) -> Union[list, dict]:
+		documents = list(self._find(coll, query_filter, projection, limit))
+		if self._is_backwards_scan(query_filter, limit):
+			# Read newest first to stop early, but returned in insertion order like every other query
+			documents.reverse()
+		return to_columns(documents, projection is None) if columnar else documents
+	
+	def _read_chunk(self, coll: str, date_filter: Optional[dict], after: Optional[ObjectId], chunk_size: int) -> list:
+		# Pages through a collection by _id, every chunk is an independent query so no cursor is shared between threads
+		query_filter = dict(date_filter) if date_filter is not None else {}
+		if after is not None:
+			query_filter['_id'] = {'$gt': after}
+		cursor = self._query_database[coll].find(query_filter, {'value': True, 'datetime': True})
+		return list(cursor.sort('_id', pymongo.ASCENDING).limit(chunk_size))
+	
+	def _find(self, coll: str, query_filter: Optional[dict], projection: Optional[dict] = None, limit: Optional[int] = None) -> pymongo.cursor.Cursor:
+		cursor = self._query_database[coll].find(query_filter, projection)
+		if self._is_backwards_scan(query_filter, limit):
+			cursor = cursor.sort('_id', pymongo.DESCENDING).limit(limit)
+		elif query_filter is not None and '_id' in query_filter:
+			# Incremental queries must be deterministic, served by a scan of the _id index
+			cursor = cursor.sort('_id', pymongo.ASCENDING)
+			if limit is not None:
+				cursor = cursor.limit(limit)
+		return cursor
+	
+	@staticmethod
+	def _is_backwards_scan(query_filter: Optional[dict], limit: Optional[int]) -> bool:
+		# A limit without an incremental cursor asks for the latest documents
+		return limit is not None and (query_filter is None or '_id' not in query_filter)
+	
+	@staticmethod
+	def _verify_limit(limit: Optional[int]):
+		if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit <= 0):
+			raise InvalidData('Limit is invalid, expected an int higher than 0')
+	
+	@staticmethod
+	def _setup_query_filter(date_range: Tuple[Union[str, int, datetime, None], Union[str, int, datetime, None]],
+	                        after: Union[str, ObjectId, None]) -> Optional[dict]:
+		query_filter = DataManager._setup_date_filter(date_range)
+		if after is not None:
+			if query_filter is None:
+				query_filter = {}
+			query_filter['_id'] = {'$gt': DataManager._parse_object_id(after)}
+		return query_filter
+	
+	@staticmethod
+	def _parse_object_id(obj_id: Union[str, ObjectId]) -> ObjectId:
+		if isinstance(obj_id, ObjectId):
+			return obj_id
+		if not isinstance(obj_id, str):
+			raise InvalidData('Id type is invalid, expected str')
+		
+		try:
+			return ObjectId(obj_id)
+		except InvalidId:
+			raise InvalidData('Id format is invalid, expected a 24 character hex str')
+	
 	@staticmethod
 	def _setup_date_filter(date_range: Tuple[Union[str, int, datetime, None], Union[str, int, datetime, None]]) -> dict:
 		date_filter = None
@@ -571,19 +1387,39 @@ class DataManager:
 		return date_filter
 	
 	@staticmethod
-	def _parse_timestamp(t):
+	def _parse_timestamp(t) -> datetime:
+		# Always returns a naive datetime in the server's local time, the same as int timestamps and the datetimes read back from MongoDB,
+		# so they can all be compared with each other
 		try:
-			if isinstance(t, datetime):
-				return t
 			if isinstance(t, str):
-				return datetime.fromisoformat(t)
-			if isinstance(t, int):
+				t = datetime.fromisoformat(t)
+			elif isinstance(t, int):
 				return datetime.fromtimestamp(t)
 			
 		except ValueError:
 			raise InvalidData('Timestamp format is invalid. Expected datetime object or ISO str or int timestamp')
+		
+		if isinstance(t, datetime):
+			if t.tzinfo is not None:
+				t = t.astimezone().replace(tzinfo=None)
+			return t
 		raise InvalidData('Timestamp type is invalid, expected datetime object, str or int')
 	
+	def _verify_retention(self, retention: Optional[int], rollup: Optional[int], storage_type: StorageType) -> Tuple[Optional[int], Optional[int]]:
+		if retention is not None and (isinstance(retention, bool) or not isinstance(retention, int) or retention <= 0):
+			raise ValueError('Retention must be a positive int amount of seconds')
+		
+		if rollup is not None:
+			if retention is None:
+				raise ValueError('Rollup can only be set if retention is also set')
+			if isinstance(rollup, bool) or not isinstance(rollup, int) or rollup <= 0:
+				raise ValueError('Rollup must be a positive int amount of seconds')
+			if storage_type is not StorageType.NUMBER:
+				self._logger.warning('Can\'t summarize values that are not NUMBERs, rollup will be ignored')
+				rollup = None
+		
+		return retention, rollup
+	
 	@staticmethod
 	def _verify_bounds(bounds: tuple, alert_spec: AlertSpec, expected_type: StorageType):
 		# Check that type isn't strings
@@ -690,6 +1526,8 @@ class DataManager:
 	@staticmethod
 	def set_logging_level(level: int) -> None:
 		database_logger.setLevel(level)
+		for logger in _instance_loggers:
+			logger.setLevel(level)
 
 
 class InvalidData(Exception):
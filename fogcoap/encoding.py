@@ -0,0 +1,46 @@
+import json
+from datetime import datetime
+from bson import ObjectId
+
+
+class DocumentEncoder(json.JSONEncoder):
+	"""
+	Minified json encoder that natively handles the types returned by the database manager's queries:
+	`ObjectId`s are encoded as their str representation and `datetime`s as int timestamps.
+	Documents are encoded as they come from the database, without converting each one in Python first, which keeps the whole
+	encoding in the C implementation of the json module.
+	"""
+
+	def __init__(self):
+		super().__init__(separators=(',', ':'), ensure_ascii=True)
+
+	def default(self, o):
+		if isinstance(o, ObjectId):
+			return str(o)
+		if isinstance(o, datetime):
+			return int(o.timestamp())
+		return super().default(o)
+
+
+_encoder = DocumentEncoder()
+
+
+def to_columns(documents: list, include_id: bool = True) -> dict:
+	"""
+	Converts a list of data documents to a dict of lists, with the key "t" for the timestamps, "v" for the values and, if `include_id` is
+	True, "i" for the ids. Keeps long responses much smaller than repeating the keys for every document.
+	"""
+	columns = {
+		't': [document['datetime'] for document in documents],
+		'v': [document['value'] for document in documents]
+	}
+	if include_id:
+		columns['i'] = [document['_id'] for document in documents]
+	return columns
+
+
+def encode_documents(data) -> bytes:
+	"""
+	Encodes query results, or any other json dumpable object, into an ascii json payload.
+	"""
+	return _encoder.encode(data).encode('ascii')
@@ -0,0 +1,230 @@
+import json
+import asyncio
+import logging
+import threading
+from time import monotonic
+from datetime import datetime, timedelta, timezone
+from gzip import compress as gzcompress
+from aiocoap import Context, Message, Code
+from pymongo.errors import PyMongoError
+from fogcoap.data_manager import DataManager
+
+
+forwarder_logger = logging.Logger(__name__)
+
+
+class UpstreamError(Exception):
+	"""Raised when an upstream sink fails to accept a batch"""
+	pass
+
+
+class UpstreamSink:
+	"""
+	Base class for the destinations of the `Forwarder`.
+	"""
+
+	async def send(self, payload: bytes) -> None:
+		"""
+		Sends a batch upstream, raising any exception if it was not accepted so it is retried later.
+		:param payload: A gzip compressed payload with one json object per line, see `Forwarder`.
+		"""
+		raise NotImplementedError
+
+
+class FileSink(UpstreamSink):
+	"""
+	Appends each batch to a local file, as a stand-in for a real upstream or for shipping files by other means.
+	As each batch is a complete gzip member, the file as a whole can be read as a single gzip stream.
+	"""
+
+	def __init__(self, path: str):
+		self._path = path
+
+	async def send(self, payload: bytes) -> None:
+		# Written from a worker thread, so a slow disk never stalls the event loop
+		await asyncio.get_event_loop().run_in_executor(None, self._append, payload)
+
+	def _append(self, payload: bytes):
+		with open(self._path, 'ab') as upstream_file:
+			upstream_file.write(payload)
+
+
+class CoapSink(UpstreamSink):
+	"""
+	Sends each batch as the payload of a POST to an upstream CoAP resource.
+	"""
+
+	def __init__(self, uri: str):
+		self._uri = uri
+		self._context = None
+
+	async def send(self, payload: bytes) -> None:
+		if self._context is None:
+			self._context = await Context.create_client_context()
+
+		response = await self._context.request(Message(code=Code.POST, uri=self._uri, payload=payload)).response
+		if not response.code.is_successful():
+			raise UpstreamError(f'Upstream answered with {response.code}')
+
+
+class Forwarder:
+	"""
+	Tails newly inserted readings and ships them upstream in compressed batches.
+	Progress is checkpointed in the database by the `ObjectId` of the last forwarded reading of each client and datatype, so nothing is
+	re-sent after a restart. As concurrent inserts may be committed out of `ObjectId` order, readings are only forwarded once their id is
+	older than `commit_lag`, so one committed late is not skipped by a checkpoint already past it. Readings inserted by other processes are
+	found by checking every collection each `rescan_interval`. While the sink is failing, the batch is retried with an exponential backoff and no new readings are read,
+	so memory stays bounded and inserts are never blocked.
+
+	Each batch is a gzip compressed payload with one json object per line, each with 5 keys:
+	`c`: the client's name.
+	`d`: the datatype's name.
+	`i`: the reading's id.
+	`v`: the reading's value.
+	`t`: the reading's timestamp.
+	"""
+
+	def __init__(self, db_manager: DataManager, sink: UpstreamSink, name: str = 'upstream', batch_size: int = 1000, interval: float = 5,
+	             max_retry_delay: float = 300, commit_lag: float = 5, rescan_interval: float = 60):
+		"""
+		:param db_manager: An instance of the database manager.
+		:param sink: Where the batches are sent to.
+		:param name: Name under which the checkpoints are stored, must be unique for each forwarder using the same database.
+		:param batch_size: Maximum number of readings sent in a batch.
+		:param interval: Seconds to wait for new readings once everything was forwarded.
+		:param max_retry_delay: Maximum seconds between retries when the sink fails.
+		:param commit_lag: Seconds a reading's id must be older than before it's forwarded. Must be longer than an insert can take to commit.
+		:param rescan_interval: Seconds between checks of every collection for readings inserted by other processes, such as imports, which
+		                        are not seen as they are inserted.
+		"""
+		self._db_manager = db_manager
+		self._sink = sink
+		self._name = name
+		self._batch_size = batch_size
+		self._interval = interval
+		self._max_retry_delay = max_retry_delay
+		self._commit_lag = commit_lag
+		self._rescan_interval = rescan_interval
+
+		self._checkpoints = None
+		# Checkpoints not yet saved because saving them failed
+		self._unsaved = {}
+		# Client and datatype combinations that may have readings not yet forwarded
+		self._pending = set()
+		self._pending_lock = threading.Lock()
+		db_manager.add_insert_listener(self._on_insert)
+
+	async def run(self) -> None:
+		"""
+		Forwards readings until cancelled. Should be run as a task on the broker's event loop, the broker already does so.
+		"""
+		loop = asyncio.get_event_loop()
+		while self._checkpoints is None:
+			try:
+				self._checkpoints = await loop.run_in_executor(None, self._db_manager.load_checkpoints, self._name)
+			except PyMongoError as e:
+				forwarder_logger.warning('Failed to load the checkpoints, retrying in %s seconds: %s', self._interval, e)
+				await asyncio.sleep(self._interval)
+
+		last_scan = None
+		while True:
+			if last_scan is None or monotonic() - last_scan >= self._rescan_interval:
+				# Readings stored before startup or by other processes are not seen by the insert listener
+				try:
+					for collection in await loop.run_in_executor(None, self._db_manager.list_data_collections):
+						self._mark_pending(collection)
+				except PyMongoError as e:
+					forwarder_logger.warning('Failed to list the collections to forward: %s', e)
+				else:
+					last_scan = monotonic()
+
+			try:
+				batch, last_ids = await loop.run_in_executor(None, self._read_batch)
+			except PyMongoError as e:
+				forwarder_logger.warning('Failed to read readings to forward, retrying in %s seconds: %s', self._interval, e)
+				await asyncio.sleep(self._interval)
+				continue
+
+			if len(batch) == 0:
+				if len(self._unsaved) > 0:
+					await self._save_checkpoints(loop)
+				await asyncio.sleep(self._interval)
+				continue
+
+			payload = gzcompress(b'\n'.join(batch) + b'\n')
+			await self._send(payload, len(batch))
+
+			self._checkpoints.update(last_ids)
+			self._unsaved.update(last_ids)
+			await self._save_checkpoints(loop)
+
+	async def _save_checkpoints(self, loop: asyncio.AbstractEventLoop):
+		# The checkpoints in memory are already updated, so a failure only means readings may be re-sent after a restart
+		try:
+			await loop.run_in_executor(None, self._db_manager.save_checkpoints, self._name, dict(self._unsaved))
+		except PyMongoError as e:
+			forwarder_logger.warning('Failed to save the checkpoints, retrying after the next batch: %s', e)
+		else:
+			self._unsaved.clear()
+
+	def _on_insert(self, client: str, datatype: str, document: dict):
+		self._mark_pending((client, datatype))
+
+	def _mark_pending(self, collection: tuple):
+		with self._pending_lock:
+			self._pending.add(collection)
+
+	def _read_batch(self):
+		# Cleared before reading, so inserts happening meanwhile mark their collection again
+		with self._pending_lock:
+			pending = list(self._pending)
+			self._pending.clear()
+
+		cutoff = datetime.now(timezone.utc) - timedelta(seconds=self._commit_lag)
+		batch = []
+		last_ids = {}
+		try:
+			for client, datatype in pending:
+				remaining = self._batch_size - len(batch)
+				if remaining <= 0:
+					self._mark_pending((client, datatype))
+					continue
+
+				documents = self._db_manager.tail_data(client, datatype, self._checkpoints.get((client, datatype)), remaining)
+				# Sorted by id, so the readings old enough to be forwarded come first
+				committed = [document for document in documents if document['_id'].generation_time <= cutoff]
+				if len(documents) == remaining or len(committed) < len(documents):
+					# There may be more to read on this collection
+					self._mark_pending((client, datatype))
+				if len(committed) == 0:
+					continue
+
+				for document in committed:
+					batch.append(json.dumps({
+						'c': client,
+						'd': datatype,
+						'i': str(document['_id']),
+						'v': document['value'],
+						't': int(document['datetime'].timestamp())
+					}, separators=(',', ':'), ensure_ascii=True).encode('ascii'))
+				last_ids[(client, datatype)] = committed[-1]['_id']
+		except Exception:
+			# Nothing read is forwarded, so every collection is read again next time
+			with self._pending_lock:
+				self._pending.update(pending)
+			raise
+
+		return batch, last_ids
+
+	async def _send(self, payload: bytes, count: int):
+		delay = 1
+		while True:
+			try:
+				await self._sink.send(payload)
+			except Exception as e:
+				forwarder_logger.warning('Failed to forward %d readings upstream, retrying in %s seconds: %s', count, delay, e, extra={'count': count})
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, self._max_retry_delay)
+			else:
+				forwarder_logger.info('Forwarded %d readings upstream', count, extra={'count': count})
+				return
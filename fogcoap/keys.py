@@ -0,0 +1,125 @@
+import threading
+from base64 import b64decode
+from time import time
+from datetime import datetime
+from typing import Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.exceptions import InvalidSignature
+
+
+class _Key:
+	__slots__ = ('der', 'key', 'expiry')
+
+	def __init__(self, der: bytes, expiry: Optional[float]):
+		self.der = der
+		self.key = None
+		self.expiry = expiry
+
+	def load(self) -> ec.EllipticCurvePublicKey:
+		if self.key is None:
+			self.key = serialization.load_der_public_key(self.der, default_backend())
+		return self.key
+
+
+class KeyRegistry:
+	"""
+	Public keys of the clients, used to verify the signatures of their inserts.
+	Keys are stored in their compact DER form and only parsed the first time they are used, so loading a big fleet costs little, or can be
+	parsed ahead of time in parallel with `preload`.
+	A client's key can be rotated at any time: the previous key stays valid until its expiry, so clients can switch keys without losing data.
+	Verification reads a client's keys without locking, changes replace them as a whole.
+	"""
+
+	def __init__(self):
+		# Client name -> tuple of keys, current key first
+		self._keys = {}
+		self._lock = threading.Lock()
+
+	def set(self, client: str, ecc_public_key: bytes, previous_key: Optional[bytes] = None,
+	        previous_key_expiry: Union[datetime, float, None] = None) -> None:
+		"""
+		Sets the keys of a client, replacing any keys it had.
+		:param client: The client's name.
+		:param ecc_public_key: The client's current public key, PEM or DER encoded.
+		:param previous_key: The key the client used before its last rotation, PEM or DER encoded, accepted until `previous_key_expiry`.
+		:param previous_key_expiry: When the previous key stops being accepted, as a datetime or a timestamp.
+		"""
+		keys = [_Key(self._to_der(ecc_public_key), None)]
+		if previous_key is not None and previous_key_expiry is not None:
+			if isinstance(previous_key_expiry, datetime):
+				previous_key_expiry = previous_key_expiry.timestamp()
+			if previous_key_expiry > time():
+				keys.append(_Key(self._to_der(previous_key), previous_key_expiry))
+
+		with self._lock:
+			self._keys[client] = tuple(keys)
+
+	def set_from_document(self, client_info: dict) -> None:
+		"""
+		Sets the keys of a client from its registry document, as returned by `DataManager.query_clients`.
+		"""
+		self.set(client_info['name'], client_info['ecc_public_key'], client_info.get('previous_key'), client_info.get('previous_key_expiry'))
+
+	def remove(self, client: str) -> None:
+		with self._lock:
+			self._keys.pop(client, None)
+
+	def verify(self, client: str, signature: bytes, message: bytes) -> bool:
+		"""
+		Verifies an ECDSA SHA256 signature with each valid key of a client.
+		:return: True if any of the client's keys verifies the signature.
+		"""
+		now = None
+		for key in self._keys.get(client, ()):
+			if key.expiry is not None:
+				now = now or time()
+				if key.expiry <= now:
+					continue
+
+			try:
+				key.load().verify(signature, message, ec.ECDSA(SHA256()))
+			except (InvalidSignature, ValueError):
+				# A key that can't be parsed can't verify anything either
+				continue
+			return True
+
+		return False
+
+	def preload(self, workers: int = 4) -> None:
+		"""
+		Parses every key not yet parsed, so the first insert of each client doesn't pay for it.
+		:param workers: Number of threads parsing keys at the same time.
+		"""
+		pending = [key for keys in list(self._keys.values()) for key in keys if key.key is None]
+		if len(pending) == 0:
+			return
+
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='KeyRegistry') as executor:
+			for _ in executor.map(self._try_load, pending):
+				pass
+
+	def __contains__(self, client: str) -> bool:
+		return client in self._keys
+
+	def __len__(self):
+		return len(self._keys)
+
+	@staticmethod
+	def _try_load(key: _Key):
+		try:
+			key.load()
+		except ValueError:
+			pass
+
+	@staticmethod
+	def _to_der(key: bytes) -> bytes:
+		if not key.startswith(b'-----BEGIN'):
+			return key
+
+		# Only the base64 body between the armor lines, without parsing the key itself
+		lines = [line for line in key.strip().splitlines() if not line.startswith(b'-----')]
+		return b64decode(b''.join(lines))
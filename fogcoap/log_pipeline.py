@@ -0,0 +1,86 @@
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from typing import Tuple
+
+
+class StructuredFormatter(logging.Formatter):
+	"""
+	Formatter appending the structured fields passed in a log call's `extra`, such as
+	`logger.info('Received successful data insert', extra={'client': 'c1', 'datatype': 'temp', 'latency': 0.002})`, as `key=value` pairs.
+	Fields missing from a record are left out.
+	"""
+	Fields = ('client', 'datatype', 'count', 'latency')
+
+	def __init__(self, fmt: str = None, datefmt: str = None, fields: Tuple[str, ...] = Fields):
+		"""
+		:param fmt: The format of the message, as for `logging.Formatter`.
+		:param datefmt: The format of the date, as for `logging.Formatter`.
+		:param fields: The names of the structured fields, in the order they are appended.
+		"""
+		super().__init__(fmt, datefmt)
+		self._fields = fields
+
+	def format(self, record: logging.LogRecord) -> str:
+		message = super().format(record)
+		for field in self._fields:
+			value = getattr(record, field, None)
+			if value is None:
+				continue
+			if field == 'latency':
+				message += f' latency={value * 1000:.2f}ms'
+			else:
+				message += f' {field}={value}'
+		return message
+
+
+class _InProcessQueueHandler(QueueHandler):
+	# The queue never leaves the process, so records are queued as they are and even the message is only formatted by the listener
+	def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+		return record
+
+
+class LogPipeline:
+	"""
+	Moves the output of a logger off the calling thread. The logger only puts records in a queue, a listener thread formats and writes them
+	with the actual handler, so a slow terminal or file never delays inserts.
+	Each pipeline is attached to its logger by its owner and must be closed by it, so several owners can share a logger without piling up
+	handlers.
+	"""
+
+	def __init__(self, logger: logging.Logger, handler: logging.Handler):
+		"""
+		Attaches the pipeline to the logger and starts its listener.
+		The logger's level is lowered to the handler's if needed, and raised to it if it was left unset, so records nobody would write are
+		never even created. `set_logging_level` methods can still change it afterwards.
+		:param logger: The logger whose records are written.
+		:param handler: The handler writing the records, with its level and formatter already set.
+		"""
+		self._logger = logger
+		self._queue = queue.SimpleQueue()
+		self._queue_handler = _InProcessQueueHandler(self._queue)
+		self._queue_handler.setLevel(handler.level)
+		self._listener = QueueListener(self._queue, handler, respect_handler_level=True)
+
+		# The level the logger had before, and the one it was changed to, or None if it was left as it was
+		self._previous_level = logger.level
+		self._level = None
+		if logger.level == logging.NOTSET or logger.level > handler.level:
+			self._level = handler.level
+			logger.setLevel(handler.level)
+		logger.addHandler(self._queue_handler)
+		self._listener.start()
+
+	def close(self) -> None:
+		"""
+		Detaches the pipeline from the logger and stops the listener, after every queued record is written. Does nothing if already closed.
+		The logger's level is restored, unless it was changed again since the pipeline was attached.
+		"""
+		if self._listener is None:
+			return
+
+		self._logger.removeHandler(self._queue_handler)
+		if self._level is not None and self._logger.level == self._level:
+			self._logger.setLevel(self._previous_level)
+		self._listener.stop()
+		self._listener = None
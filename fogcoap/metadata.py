@@ -0,0 +1,63 @@
+from sys import intern
+from bson.objectid import ObjectId
+from typing import Optional, Callable
+
+
+class ClientInfo:
+	"""
+	Cached information of a registered client. Only what inserts and queries need is kept, the keys are handled by the broker.
+	"""
+	__slots__ = ('id', 'name')
+
+	def __init__(self, id: ObjectId, name: str):
+		self.id = id
+		# Interned, as the same names are used for every collection name and stats key
+		self.name = intern(name)
+
+	def __repr__(self):
+		return f'ClientInfo({self.name!r}, {self.id!r})'
+
+
+class DatatypeInfo:
+	"""
+	Cached information of a registered datatype, with everything the hot paths need resolved once when it's read from the database:
+	the storage types as `StorageType` members, the bounds split into attributes and the alert specification as an `AlertSpec`.
+	"""
+	__slots__ = ('id', 'name', 'storage_type', 'array_type', 'unit', 'lower_bound', 'upper_bound', 'alert_spec', 'array_func', 'retention',
+	             'rollup')
+
+	def __init__(self, id: ObjectId, name: str, storage_type, array_type=None, unit: Optional[str] = None, lower_bound=None,
+	             upper_bound=None, alert_spec=None, array_func: Optional[Callable] = None, retention: Optional[int] = None,
+	             rollup: Optional[int] = None):
+		"""
+		:param id: The datatype's `ObjectId`.
+		:param name: The datatype's name.
+		:param storage_type: The `StorageType` of the values.
+		:param array_type: The `StorageType` of the items, if `storage_type` is ARRAY.
+		:param unit: The optional unit of the values.
+		:param lower_bound: The minimum valid value, or None.
+		:param upper_bound: The maximum valid value, or None.
+		:param alert_spec: The `AlertSpec` of the datatype, or None.
+		:param array_func: The function reducing an array to a single value for the alerts, as given by `alert_spec.array_treatment`, or
+		                   None if arrays are checked item by item.
+		:param retention: Seconds the data is kept for, or None.
+		:param rollup: Size in seconds of the summary buckets for expired data, or None.
+		"""
+		self.id = id
+		self.name = intern(name)
+		self.storage_type = storage_type
+		self.array_type = array_type
+		self.unit = unit
+		self.lower_bound = lower_bound
+		self.upper_bound = upper_bound
+		self.alert_spec = alert_spec
+		self.array_func = array_func
+		self.retention = retention
+		self.rollup = rollup
+
+	@property
+	def has_bounds(self) -> bool:
+		return self.lower_bound is not None or self.upper_bound is not None
+
+	def __repr__(self):
+		return f'DatatypeInfo({self.name!r}, {self.id!r})'
@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Hashable, Iterable, Optional
+
+
+class MetadataCache:
+	"""
+	Size bounded LRU cache for registry and metadata documents.
+	Entries expire after a time to live, and lookups that found nothing can be cached as well so repeated misses don't reach the database.
+	The same entry can be stored under several keys, such as a name and an `ObjectId`, and invalidating any of them invalidates them all.
+	"""
+	MISSING = object()
+	"""Returned by `get` when the key is not cached."""
+	NOT_FOUND = object()
+	"""Returned by `get` when the key is cached as not existing in the database."""
+
+	def __init__(self, max_size: int = 10000, ttl: Optional[float] = 300, negative_ttl: Optional[float] = 30):
+		"""
+		:param max_size: Maximum number of keys kept in the cache, least recently used keys are evicted first.
+		:param ttl: Seconds a found entry is kept. If None, entries only leave the cache when evicted or invalidated.
+		:param negative_ttl: Seconds a miss is kept. If 0, misses are not cached.
+		"""
+		if max_size <= 0:
+			raise ValueError('Cache max size must be higher than 0')
+
+		self._max_size = max_size
+		self._ttl = ttl
+		self._negative_ttl = negative_ttl
+
+		# Key -> [value, expiry time or None, all the keys of the entry]
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key: Hashable):
+		"""
+		:return: The cached value, `NOT_FOUND` if the key is cached as a miss or `MISSING` if the key is not cached or expired.
+		"""
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return self.MISSING
+
+			if entry[1] is not None and entry[1] <= monotonic():
+				self._remove(entry)
+				return self.MISSING
+
+			self._entries.move_to_end(key)
+			return entry[0]
+
+	def put(self, keys: Iterable[Hashable], value) -> None:
+		"""
+		Caches a value found in the database under every given key.
+		"""
+		self._put(tuple(keys), value, self._ttl)
+
+	def put_missing(self, key: Hashable) -> None:
+		"""
+		Caches that a key was not found in the database.
+		"""
+		if self._negative_ttl is None or self._negative_ttl > 0:
+			self._put((key,), self.NOT_FOUND, self._negative_ttl)
+
+	def invalidate(self, key: Hashable) -> None:
+		"""
+		Removes the entry stored under `key`, along with every other key of the same entry.
+		"""
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None:
+				self._remove(entry)
+
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+
+	def __len__(self):
+		with self._lock:
+			return len(self._entries)
+
+	def _put(self, keys: tuple, value, ttl: Optional[float]):
+		entry = [value, monotonic() + ttl if ttl is not None else None, keys]
+		with self._lock:
+			for key in keys:
+				old_entry = self._entries.get(key)
+				if old_entry is not None:
+					self._remove(old_entry)
+
+			for key in keys:
+				self._entries[key] = entry
+
+			while len(self._entries) > self._max_size:
+				_, oldest = self._entries.popitem(last=False)
+				self._remove(oldest)
+
+	def _remove(self, entry: list):
+		for key in entry[2]:
+			if self._entries.get(key) is entry:
+				del self._entries[key]
@@ -1,58 +1,139 @@
 import json
+import asyncio
 from datetime import datetime
+from hashlib import sha1
+from threading import Lock
+from time import monotonic
+from typing import Tuple, List, Optional, Iterable
 from gzip import compress as gzcompress, decompress as gzdecompress
 from aiocoap import Code, Message
-from aiocoap.resource import Resource
+from aiocoap.resource import Resource, ObservableResource
 from bson import ObjectId
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.hashes import SHA256
-from cryptography.exceptions import InvalidSignature
-from fogcoap import DataManager, InvalidData
+from fogcoap import DataManager, InvalidData, InvalidClient
 from fogcoap.alerts import ClientAlert
+from fogcoap.admission import AdmissionController
+from fogcoap.keys import KeyRegistry
+from fogcoap.encoding import encode_documents, to_columns
+from fogcoap.streaming import PayloadError, PayloadTooLarge, inflate_gzip, iter_json_array
 
 
 def _gzip_payload(func):
 	# Decorator for gzip compression
 	# Takes the request payload, decompresses (and checks for errors), calls the method and finally recompresses the response
-	def wraps(self: BaseResource, request: Message):
+	async def wraps(self: BaseResource, request: Message):
 		try:
 			request.payload = gzdecompress(request.payload)
 		except OSError:
 			# Since the received message was not properly compressed, return a non compressed response just in case
 			return Message(code=Code.BAD_REQUEST, payload=b'{"error":"Bad GZIP compression"}')
 		
-		response = func(self, request)
+		response = await func(self, request)
 		response.payload = gzcompress(response.payload)
 		return response
 	
 	return wraps
 
+
+def _gzip_response(func):
+	# Decorator for gzip compression of the response only, for methods that decompress the request payload themselves
+	async def wraps(self: BaseResource, request: Message):
+		response = await func(self, request)
+		response.payload = gzcompress(response.payload)
+		return response
+	
+	return wraps
+
+	
+# DER encoded ECDSA signatures, from the smallest possible up to the biggest made with P-521 keys
+_MinSigLength = 8
+_MaxSigLength = 139
+# Gzip header magic bytes followed by the deflate compression method
+_GzipMagic = b'\x1f\x8b\x08'
+# Gzip header and trailer sizes
+_GzipMinLength = 18
+
+
+def _precheck_gzip(message: bytes, max_inflated: int, max_ratio: float) -> Optional[Message]:
+	# Cheap checks on a gzip payload, before spending anything on it
+	# Returns the error response, or None if nothing is wrong
+	if len(message) < _GzipMinLength or not message.startswith(_GzipMagic):
+		return Message(code=Code.BAD_REQUEST, payload=b'{"error":"Bad GZIP compression"}')
 	
+	# The trailer has the uncompressed size, modulo 2^32, so bombs can be refused without inflating anything
+	# It can be forged, so decompression must still be bounded
+	inflated_size = int.from_bytes(message[-4:], 'little')
+	if inflated_size > max_inflated or inflated_size > len(message) * max_ratio:
+		return Message(code=Code.REQUEST_ENTITY_TOO_LARGE, payload=b'{"error":"Payload inflates too much"}')
+	
+	return None
+
+
 def _verify_sig(func):
-	def inner(self, request: Message):
+	# Decorator verifying the payload's signature with the resource's key
+	# Malformed or oversized payloads are refused first, so garbage never costs a signature verification
+	async def inner(self, request: Message):
+		if self._oscore_claim in request.remote.authenticated_claims:
+			# Already authenticated as the client by an OSCORE security context, the payload has no signature
+			if len(request.payload) > self._MaxCompressedSize:
+				return Message(code=Code.REQUEST_ENTITY_TOO_LARGE, payload=b'{"error":"Payload too large"}')
+			error = _precheck_gzip(request.payload, self._MaxInflatedSize, self._MaxInflateRatio)
+			if error is not None:
+				return error
+			return await func(self, request)
+		
 		if len(request.payload) < 4:
 			return Message(code=Code.BAD_REQUEST, payload=b'{"error":"Bad request format"}')
 		
+		if len(request.payload) > 2 + _MaxSigLength + self._MaxCompressedSize:
+			return Message(code=Code.REQUEST_ENTITY_TOO_LARGE, payload=b'{"error":"Payload too large"}')
+		
 		sig_len = int.from_bytes(request.payload[:2], 'big')
-		if len(request.payload) < 4 + sig_len:
+		if sig_len < _MinSigLength or sig_len > _MaxSigLength or len(request.payload) < 4 + sig_len:
 			return Message(code=Code.BAD_REQUEST, payload=b'{"error":"Bad request format"}')
 		
 		signature = request.payload[2:2 + sig_len]
 		message = request.payload[2 + sig_len:]
 		
-		try:
-			self._ecc_pub_key.verify(
-				signature,
-				message,
-				ec.ECDSA(SHA256())
-			)
-		except InvalidSignature:
+		error = _precheck_gzip(message, self._MaxInflatedSize, self._MaxInflateRatio)
+		if error is not None:
+			return error
+		
+		if not self._keys.verify(self._name, signature, message):
 			return Message(code=Code.UNAUTHORIZED)
-		else:
-			request.payload = message
-			return func(self, request)
+		
+		request.payload = message
+		return await func(self, request)
+	
+	return inner
+
+
+def _admit(func):
+	# Decorator bounding how many requests are processed at the same time, see `AdmissionController`
+	# Runs before anything else, so a busy broker spends nothing on the requests it turns away
+	async def inner(self, request: Message):
+		if self._admission is None:
+			return await func(self, request)
+		
+		if not self._admission.enter():
+			return Message(code=Code.SERVICE_UNAVAILABLE, max_age=self._admission.busy_retry, payload=b'{"error":"Server busy"}')
+		try:
+			return await func(self, request)
+		finally:
+			self._admission.leave()
+	
+	return inner
+
+
+def _rate_limit(func):
+	# Decorator applying the client's rate limit, see `AdmissionController`
+	# Runs after the signature is verified, so forged requests can't use up a legitimate client's rate
+	async def inner(self, request: Message):
+		if self._admission is not None:
+			retry = self._admission.take(self._name)
+			if retry > 0:
+				return Message(code=Code.TOO_MANY_REQUESTS, max_age=retry, payload=b'{"error":"Too many requests"}')
+		
+		return await func(self, request)
 	
 	return inner
 
@@ -69,102 +150,414 @@ class BaseResource(Resource):
 	@staticmethod
 	def _build_msg(code: Code = None, data=None) -> Message:
 		"""
-		Prepares a `Message` object, adding code and dumping the json data
+		Prepares a `Message` object, adding code and dumping the json data.
+		`ObjectId`s and `datetime`s in the data are dumped as strs and int timestamps, respectively.
 		"""
 		if data is not None:
-			payload = json.dumps(data, separators=(',', ':'), ensure_ascii=True).encode('ascii')
+			payload = encode_documents(data)
 		else:
 			payload = b''
 		return Message(code=code, payload=payload)
 	
+	@staticmethod
+	def _query_options(parameters: dict) -> dict:
+		"""
+		Parses the projection, limit and format parameters shared by the data query resources.
+		:return: The keyword arguments for the database manager's query methods.
+		"""
+		response_format = parameters.get('f') or parameters.get('format') or 'rows'
+		if response_format not in ('rows', 'columns'):
+			raise ValueError('Format is invalid, expected "rows" or "columns"')
+		
+		return {
+			'include_id': not (parameters.get('ni') or parameters.get('noid')),
+			'limit': 1 if parameters.get('latest') else parameters.get('l') or parameters.get('limit'),
+			'columnar': response_format == 'columns'
+		}
+	
 
-class ListClientsResource(BaseResource):
+class ListResource(BaseResource):
 	"""
-	Provides a GET method that returns all registered clients.
+	Base class for the resources that list registered entities.
+	The final compressed payload is cached along with an ETag, and is only rebuilt when the registry changes, reloading only the entities
+	that changed, or at most every `_StatsInterval` seconds when the data statistics change, so a busy broker doesn't change the ETag on
+	every insert.
 	"""
+	_registry = None
+	_stats_index = None
+	# Minimum seconds between rebuilds caused only by new statistics
+	_StatsInterval = 30
+	
 	def __init__(self, db_manager: DataManager):
-		data = {client['name']: {key: value for (key, value) in client.items() if key != 'name' and key != 'ecc_public_key'}
-		        for client in db_manager.query_clients()
-		}
+		super().__init__(db_manager)
 		
-		for client_name, client_data in data.items():
-			for key, value in client_data.items():
-				if isinstance(value, ObjectId):
-					data[client_name][key] = str(value)
-				elif isinstance(value, datetime):
-					data[client_name][key] = int(value.timestamp())
+		self._entries = {}
+		# Names of the entities that must be reloaded, None meaning every entity
+		# Everything is loaded by the first request, so creating the resource never blocks the broker's startup
+		self._changed = {None}
+		self._changed_lock = Lock()
+		# Concurrent requests wait for a single refresh instead of serving what's loaded so far
+		self._refresh_lock = asyncio.Lock()
+		
+		self._payload = None
+		self._etag = None
+		self._stats_version = None
+		self._stats_time = 0
+		db_manager.add_registry_listener(self._registry_changed)
+	
+	async def render_get(self, request: Message):
+		await self._refresh()
 		
-		self._get_response = self._build_msg(data=data)
-		super().__init__(db_manager)
+		if self._etag in request.opt.etags:
+			return Message(code=Code.VALID, etag=self._etag)
+		return Message(payload=self._payload, etag=self._etag)
+	
+	def _load_all(self) -> list:
+		raise NotImplementedError
+	
+	def _load_one(self, name: str) -> Optional[dict]:
+		raise NotImplementedError
+	
+	def _format_entity(self, entity: dict) -> dict:
+		data = {key: value for (key, value) in entity.items() if key != 'name'}
+		for key, value in data.items():
+			if isinstance(value, ObjectId):
+				data[key] = str(value)
+			elif isinstance(value, datetime):
+				data[key] = int(value.timestamp())
+		return data
+	
+	def _registry_changed(self, collection: str, name: Optional[str]):
+		if collection == self._registry:
+			with self._changed_lock:
+				self._changed.add(name)
+	
+	async def _refresh(self):
+		async with self._refresh_lock:
+			await self._refresh_locked()
+	
+	async def _refresh_locked(self):
+		with self._changed_lock:
+			changed, self._changed = self._changed, set()
 		
-	@_gzip_payload
-	def render_get(self, request: Message):
+		try:
+			if None in changed:
+				entities = await self._db_manager.run_async(self._load_all)
+				self._entries = {entity['name']: self._format_entity(entity) for entity in entities}
+			else:
+				for name in changed:
+					entity = await self._db_manager.run_async(self._load_one, name)
+					if entity is None:
+						self._entries.pop(name, None)
+					else:
+						self._entries[name] = self._format_entity(entity)
+		except Exception:
+			# Reloaded again by the next request, instead of caching an incomplete list
+			with self._changed_lock:
+				self._changed.update(changed)
+			raise
+		
+		stats_version = self._db_manager.stats_version
+		if self._payload is not None and len(changed) == 0 and (stats_version == self._stats_version or
+		                                                        monotonic() - self._stats_time < self._StatsInterval):
+			return
+		
+		# Totals of the statistics for each entity
+		stats = {}
+		for key, entry in self._db_manager.query_stats().items():
+			total = stats.setdefault(key[self._stats_index], {'count': 0, 'last': None, 'bytes': 0})
+			total['count'] += entry['count']
+			total['bytes'] += entry['bytes']
+			if entry['last'] is not None and (total['last'] is None or entry['last'] > total['last']):
+				total['last'] = entry['last']
+		
+		data = {}
+		for name, entry in self._entries.items():
+			entity_stats = stats.get(name, {'count': 0, 'last': None, 'bytes': 0})
+			if entity_stats['last'] is not None:
+				entity_stats['last'] = int(entity_stats['last'].timestamp())
+			data[name] = dict(entry, stats=entity_stats)
+		
+		raw = self._build_msg(data=data).payload
+		self._payload = gzcompress(raw)
+		self._etag = sha1(raw).digest()[:8]
+		self._stats_version = stats_version
+		self._stats_time = monotonic()
+
+
+class ListClientsResource(ListResource):
+	"""
+	Provides a GET method that returns all registered clients.
+	"""
+	_registry = 'client_registry'
+	_stats_index = 0
+	
+	async def render_get(self, request: Message):
 		"""
 		Returns a json object where each key is the name of the client and it's value is another object with it's remaining attributes.
+		The `stats` attribute contains the totals of the client's data, with the keys `count` for the number of readings, `last` for the
+		timestamp of the last reading and `bytes` for their approximate size. They may be up to 30 seconds old.
+		The response has an ETag, if it matches one sent in the request the response will be VALID and empty.
 		"""
-		return self._get_response
+		return await super().render_get(request)
+	
+	def _load_all(self) -> list:
+		return self._db_manager.query_clients()
+	
+	def _load_one(self, name: str) -> Optional[dict]:
+		return self._db_manager.query_client(name)
+	
+	def _format_entity(self, entity: dict) -> dict:
+		return super()._format_entity({key: value for (key, value) in entity.items() if key not in ('ecc_public_key', 'previous_key')})
 
 
-class ListDatatypesResource(BaseResource):
+class ListDatatypesResource(ListResource):
 	"""
 	Provides a GET method that returns all registered datatypes.
 	"""
+	_registry = 'type_metadata'
+	_stats_index = 1
+	
+	async def render_get(self, request: Message):
+		"""
+		Returns a json object where each key is the name of the datatype and it's value is another object with it's remaining attributes.
+		See `StorageType` for the enum values of the `storage_type` attribute.
+		The `stats` attribute contains the totals of the datatype's data from every client, see the client list resource.
+		The response has an ETag, if it matches one sent in the request the response will be VALID and empty.
+		"""
+		return await super().render_get(request)
+	
+	def _load_all(self) -> list:
+		return self._db_manager.query_datatypes()
+	
+	def _load_one(self, name: str) -> Optional[dict]:
+		return self._db_manager.query_datatype(name)
+
+
+class AllLatestResource(BaseResource, ObservableResource):
+	"""
+	Observable resource with the latest reading of every client and datatype, notified whenever any client inserts data.
+	"""
 	
 	def __init__(self, db_manager: DataManager):
-		data = {datatype['name']: {key: value for (key, value) in datatype.items() if key != 'name'}
-		        for datatype in db_manager.query_datatypes()
-		}
-		
-		for client_name, client_data in data.items():
-			for key, value in client_data.items():
-				if isinstance(value, ObjectId):
-					data[client_name][key] = str(value)
-				elif isinstance(value, datetime):
-					data[client_name][key] = int(value.timestamp())
-		
-		self._get_response = self._build_msg(data=data)
 		super().__init__(db_manager)
+		# Compressed table, built by the first render after a change and shared by every observer and request until the next one
+		self._payload = None
+	
+	def changed(self) -> None:
+		"""
+		Notifies the observers that a client inserted new data. Must be called from the event loop.
+		"""
+		self._payload = None
+		self.updated_state()
+	
+	async def render_get(self, request: Message):
+		"""
+		Get method for the latest readings. Ignores any payload.
+		Returns a gzip compressed json object with each client's name as keys and objects as values, each with the datatype names as keys and
+		the latest reading as values, in the same format returned by the client resource.
+		"""
+		if self._payload is None:
+			self._payload = gzcompress(self._build_msg(data=self._db_manager.query_latest()).payload)
+		return Message(payload=self._payload)
+
+
+class LatestResource(BaseResource, ObservableResource):
+	"""
+	Observable resource with the latest reading of each of a client's datatypes, notified whenever the client inserts data.
+	The readings are kept in memory by the database manager, so reading or observing this resource never queries the data.
+	"""
+	
+	def __init__(self, name: str, db_manager: DataManager, all_latest: AllLatestResource = None):
+		"""
+		:param name: The client's registered name.
+		:param db_manager: An instance of the database manager.
+		:param all_latest: The resource with every client's latest readings, notified along with this one.
+		"""
+		self._name = name
+		self._all_latest = all_latest
+		super().__init__(db_manager)
+	
+	def changed(self) -> None:
+		"""
+		Notifies the observers that the client inserted new data. Must be called from the event loop.
+		"""
+		self.updated_state()
+		if self._all_latest is not None:
+			self._all_latest.changed()
 	
 	@_gzip_payload
-	def render_get(self, request: Message):
+	async def render_get(self, request: Message):
 		"""
-		Returns a json object where each key is the name of the datatype and it's value is another object with it's remaining attributes.
-		See `StorageType` for the enum values of the `storage_type` attribute.
+		Get method for the client's latest readings. Ignores any payload.
+		Returns a gzip compressed json object containing 2 keys:
+		`c`: the client's name.
+		`d`: an object with the datatype names as keys and the latest reading as values, in the same format returned by the client resource.
+		"""
+		return self._build_msg(data={
+			'c': self._name,
+			'd': self._db_manager.query_latest(self._name)
+		})
+
+
+class DataResource(BaseResource, ObservableResource):
+	"""
+	Base class for the data resources that can optionally be observed.
+	Instead of the whole history, observers are notified only with the newly inserted readings, filtered and formatted according to the
+	parameters of the request that started the observation. Readings published while an observer's previous notification is still being
+	sent are merged into its next one, so none are skipped.
+	"""
+	_filter_keys = None
+	
+	def __init__(self, db_manager: DataManager, observable: bool = False):
+		self._observable = observable
+		# Server observation -> (request that started it, (name filter, include ids, columnar format))
+		self._filters = {}
+		# Request of an observation -> (its filters, the readings published but not yet sent to it)
+		self._unsent = {}
+		super().__init__(db_manager)
+	
+	async def add_observation(self, request: Message, serverobservation):
+		if not self._observable:
+			return
+		
+		try:
+			filters = self._parse_filters(request)
+		except ValueError:
+			# The render will answer with an error and end the observation
+			return
+		
+		self._filters[serverobservation] = (request, filters)
+		
+		def _cancel(self=self, obs=serverobservation):
+			request, _ = self._filters.pop(obs, (None, None))
+			self._unsent.pop(request, None)
+		
+		serverobservation.accept(_cancel)
+	
+	def get_link_description(self):
+		link = super().get_link_description()
+		if not self._observable:
+			link.pop('obs', None)
+		return link
+	
+	def publish(self, readings: dict) -> None:
+		"""
+		Notifies every observer whose filter matches with the new readings. Must be called from the event loop.
+		:param readings: A dict with the same keys as the resource's data, datatype names for clients and client names for datatypes, and
+		                 lists of the newly inserted documents as values.
 		"""
-		return self._get_response
+		for observation, (request, filters) in self._filters.items():
+			name = filters[0]
+			if name is not None:
+				if name not in readings:
+					continue
+				matched = {name: readings[name]}
+			else:
+				matched = readings
+			
+			_, unsent = self._unsent.setdefault(request, (filters, {}))
+			for key, documents in matched.items():
+				unsent.setdefault(key, []).extend(documents)
+			# Without a response, the notification is rendered only when it's about to be sent, with everything published until then
+			observation.trigger()
+	
+	async def render(self, request: Message):
+		unsent = self._unsent.pop(request, None)
+		if unsent is None:
+			return await super().render(request)
+		
+		filters, readings = unsent
+		return Message(code=Code.CONTENT, payload=self._delta_payload(readings, *filters))
+	
+	def _wrap_data(self, data: dict) -> dict:
+		raise NotImplementedError
+	
+	def _delta_payload(self, readings: dict, name: Optional[str], include_id: bool, columnar: bool) -> Optional[bytes]:
+		if name is not None:
+			readings = {name: readings[name]} if name in readings else {}
+		if len(readings) == 0:
+			return None
+		
+		data = {}
+		for key, documents in readings.items():
+			if not include_id:
+				documents = [{'value': document['value'], 'datetime': document['datetime']} for document in documents]
+			data[key] = to_columns(documents, include_id) if columnar else documents
+		
+		return gzcompress(encode_documents(self._wrap_data(data)))
+	
+	def _parse_filters(self, request: Message) -> Tuple[Optional[str], bool, bool]:
+		if len(request.payload) == 0:
+			return None, True, False
+		
+		try:
+			parameters = json.loads(gzdecompress(request.payload))
+		except (OSError, json.JSONDecodeError, UnicodeDecodeError):
+			raise ValueError('Bad request payload')
+		
+		if not isinstance(parameters, dict):
+			raise ValueError('Bad JSON format')
+		
+		# Also used as a dict key for observers, so anything but a str is refused as soon as it's received
+		name = parameters.get(self._filter_keys[0]) or parameters.get(self._filter_keys[1])
+		if name is not None and not isinstance(name, str):
+			raise ValueError(f'{self._filter_keys[1].capitalize()} must be a str')
+		
+		options = self._query_options(parameters)
+		return name, options['include_id'], options['columnar']
 
 
-class ClientResource(BaseResource):
+class ClientResource(DataResource):
 	"""
 	Representation of a client, for receiving the data sent from the client and for querying the stored data.
 	"""
+	_filter_keys = ('d', 'datatype')
+	# Limits for inserts, checked before verifying their signature
+	_MaxCompressedSize = 1024 * 1024
+	_MaxInflatedSize = 16 * 1024 * 1024
+	_MaxInflateRatio = 200
 	
-	def __init__(self, name: str, ecc_public_key: bytes, db_manager: DataManager, alert_resource: ClientAlert = None):
+	def __init__(self, name: str, keys: KeyRegistry, db_manager: DataManager, alert_resource: ClientAlert = None,
+	             latest_resource: LatestResource = None, observable: bool = False, admission: AdmissionController = None):
 		"""
 		Simple class for a client.
 		:param name: The client's registered name.
-		:param ecc_public_key: The client's public ECC PEM encoded key.
+		:param keys: The registry with the client's public keys, shared by every client so keys can be rotated without rebuilding resources.
 		:param db_manager: An instance of the database manager.
 		:param alert_resource: The client's alert instance, so it can be told to notify subscribed clients.
+		:param latest_resource: The client's latest readings instance, so it can be told to notify subscribed clients.
+		:param observable: Whether the resource accepts observers, notified with the newly inserted readings by `publish`.
+		:param admission: An optional `AdmissionController`, usually shared by every client, limiting the inserts accepted.
 		"""
 		self._name = name
-		self._ecc_pub_key = serialization.load_pem_public_key(ecc_public_key, default_backend())
+		self._keys = keys
+		self._oscore_claim = ':' + name
 		self._last_rcv_timestamp = 0
 		self._alert_resource = alert_resource
-		super().__init__(db_manager)
+		self._latest_resource = latest_resource
+		self._admission = admission
+		super().__init__(db_manager, observable)
 
 	@_gzip_payload
-	def render_get(self, request: Message):
+	async def render_get(self, request: Message):
 		"""
 		Get method for the client, getting data the client has sent.
 		If sent with an empty payload, will simply return all data.
-		If a payload is present, expects a gzip compressed json payload (preferably minified) with 3 optional keys:
+		If a payload is present, expects a gzip compressed json payload (preferably minified) with the following optional keys:
 		`nd` or `nodata`: a true or false value. If true, the request will not return any of the clients data.
 		`d` or `datatype: name of a specific registered datatype. If set, will only return data from that datatype.
 		`t` or `time`: an array with two values for a range of values between dates. Additionally, if the first value is null,
 		               all data since the beginning until the second value is returned. Similarly, if the second value is null,
 		               all data since the first value until now will be returned.
-		               
+		`a` or `after`: the `_id` of the last item already received. If set, only data inserted after it is returned, sorted by insertion
+		                order. Unlike `t`, this is not affected by the client's clock, so it should be preferred for incremental polling.
+		`ni` or `noid`: a true or false value. If true, the `_id` of each reading is not returned.
+		`l` or `limit`: an int, the maximum number of readings returned for each datatype. Without `a`, the latest readings are returned.
+		`latest`: a true or false value. If true, only the latest reading for each datatype is returned, same as a `l` of 1.
+		`f` or `format`: either "rows", the default, for a list of readings, or "columns" for an object with a list for each field:
+		                 `t` for the timestamps, `v` for the values and `i` for the ids, unless `ni` is set.
+		
 		The following is a valid payload, assuming the datatype "temp" exists:
 		```
 		{
@@ -179,6 +572,9 @@ class ClientResource(BaseResource):
 		     will be 0 if the broker hasn't received a message since startup.
 		`d`: the clients data, filtered according to parameters, where each key is a datatype and the values are the data sent by the client.
 		     `null` if `nd` was received with anything not interpreted as false (not set, `null`, `false`, `0`, etc).
+		
+		If the resource is observable, notifications contain only the newly inserted readings, in the same format, filtered by the `d`, `ni`
+		and `f` keys of the request that started the observation.
 		"""
 		if len(request.payload) > 0:
 			# Load the json
@@ -195,38 +591,35 @@ class ClientResource(BaseResource):
 			if not no_data:
 				datatype = parameters.get('d') or parameters.get('datatype')
 				timerange = parameters.get('t') or parameters.get('time')
+				after = parameters.get('a') or parameters.get('after')
 				try:
-					clients_data = self._db_manager.query_data_client(self._name, datatype, timerange)
+					options = self._query_options(parameters)
+					clients_data = await self._db_manager.run_async(self._db_manager.query_data_client, self._name, datatype, timerange, after,
+					                                                **options)
 				except (InvalidData, ValueError, TypeError) as e:
 					return self._build_msg(code=Code.BAD_REQUEST, data={'error': str(e)})
 			else:
 				clients_data = None
 		
 		else:
-			clients_data = self._db_manager.query_data_client(self._name)
+			clients_data = await self._db_manager.run_async(self._db_manager.query_data_client, self._name)
 		
-		# Reformat data for response
-		if clients_data is not None:
-			for datatype in clients_data.values():
-				for item in datatype:
-					item['_id'] = str(item['_id'])
-					item['datetime'] = int(item['datetime'].timestamp())
-		
-		return self._build_msg(data={
-			'c': self._name,
-			'l': self._last_rcv_timestamp,
-			'd': clients_data
-		})
+		return self._build_msg(data=self._wrap_data(clients_data))
 	
+	@_admit
 	@_verify_sig
-	@_gzip_payload
-	def render_post(self, request: Message):
+	@_rate_limit
+	@_gzip_response
+	async def render_post(self, request: Message):
 		"""
 		Post method for the client, for inserting data values.
 		Expects a payload with the following format:
 		First 2 bytes are the signature length, with the first being the msb (for example, 0x00f0 is interpreted as 240 decimal).
 		The following bytes are the message signature, made with the client's ECC private key and SHA256 hash. It must have the length
-		specified by the first 2 bytes.
+		specified by the first 2 bytes. After the client's key is rotated, signatures made with the previous key are still accepted until it
+		expires.
+		If the broker has OSCORE credentials for the client, under the name ":" followed by the client's name, requests protected with that
+		security context are already authenticated: their payload is only the message itself, without the signature length and signature.
 		The remaining bytes are the message itself, which must be a gzip compressed payload with a json object list (preferably minified),
 		with each object containing 3 values:
 		`n` or `name`: the name specified when registering a `datatype`.
@@ -242,98 +635,153 @@ class ClientResource(BaseResource):
 		]
 		```
 		
-		Will insert each object one at a time. To avoid retransmissions, will still continue to insert objects even if there is an error
-		in one or more.
+		Will insert each object one at a time, as soon as it is decompressed and parsed, so the whole payload is never held in memory.
+		To avoid retransmissions, will still continue to insert objects even if there is an error in one or more.
 		On at least one successful insert, the return code will be CHANGED. If no inserts were successful, the return code will be BAD_REQUEST.
 		The response payload will be a json object list where each object will either contain the key `id` with the string representation of the
 		inserted `ObjectId` or the key `error` with a message explaining the error, ordered by the same order of the inserted data.
 		Clients should only retransmit data which had errors. Ideally, an error would never happen and a check for errors would be unnecessary.
 		
-		If the entire json could not be loaded a BAD_REQUEST will be returned with a simple json object payload `{"error", "Bad JSON format"}`.
-		Similarly, if the loaded object is not a list, the error shall be `"JSON top object not an array"`.
+		If the json could not be loaded at all a BAD_REQUEST will be returned with a simple json object payload `{"error", "Bad JSON format"}`.
+		Similarly, if the loaded object is not a list, the error shall be `"JSON top object not an array"`, and if the payload inflates to more
+		than 16 MiB, the error shall be `"Payload inflates too much"` with 4.13 Request Entity Too Large.
+		If the payload is only malformed or too big after some of the objects, those are still inserted and the list gets an extra last
+		object with the key `error`: every object sent after the ones in the list must be retransmitted.
 		The response payload will be gzip compressed.
 		
+		If an `AdmissionController` is set, inserts may also be refused as a whole: with 5.03 Service Unavailable when the broker is busy or
+		4.29 Too Many Requests when the client exceeded its rate, both with an uncompressed error payload and a Max-Age option with the
+		seconds to wait before retrying. Inserts with more objects than its maximum number of readings are refused as a whole, before any is
+		inserted, with 4.13 Request Entity Too Large: the client must split them.
+		Before the signature is verified, payloads bigger than 1 MiB compressed, or that declare more than 16 MiB or 200 times their size
+		uncompressed, are refused with 4.13 Request Entity Too Large, and payloads not starting with a gzip header with BAD_REQUEST.
+		
 		
 		"""
-		# Load the json data
-		try:
-			data_list = json.loads(request.payload)
-		except (json.decoder.JSONDecodeError, UnicodeDecodeError):
-			return self._build_msg(code=Code.BAD_REQUEST, data={'error': 'Bad JSON format'})
+		# The readings are decompressed and parsed while they are inserted
+		readings = iter_json_array(inflate_gzip(request.payload, self._MaxInflatedSize))
+		insert_status, alerts, one_successful, error = await self._db_manager.run_async(self._insert_all, readings)
 		
-		if not isinstance(data_list, list) or len(data_list) == 0:
-			return self._build_msg(code=Code.BAD_REQUEST, data={'error': 'JSON top object not an array'})
+		if len(insert_status) == 0:
+			if error is None:
+				error = PayloadError('JSON top object not an array')
+			return self._build_msg(code=Code.REQUEST_ENTITY_TOO_LARGE if isinstance(error, PayloadTooLarge) else Code.BAD_REQUEST,
+			                       data={'error': str(error)})
 		
-		one_successful = False
-		insert_status = []
+		if error is not None:
+			insert_status.append({'error': str(error)})
 		
-		if self._alert_resource is not None:
-			alerts = []
-		
-		# Insert values
-		for data in data_list:
-			if not isinstance(data, dict):
-				insert_status.append({'error': 'Bad JSON format'})
-				continue
-				
-			try:
-				alert = None
-				if self._alert_resource is not None:
-					alert = self._db_manager.verify_alert(self._name, data)
-					if alert is not None:
-						alerts.append(alert)
-						
-				if alert is not None and alert['p']:
-					insert_status.append({'error': f'Alert prohibits insert: {alert["a"]}'})
-					continue
-				
-				obj_id = self._db_manager.insert_data(self._name, data)
-				
-			except InvalidData as e:
-				insert_status.append({'error': str(e)})
-			
-			except Exception:
-				from traceback import print_exc
-				print_exc()
-				insert_status.append({'error': 'Internal Server Error'})
-				
-			else:
-				insert_status.append({'id': str(obj_id)})
-				one_successful = True
-				
 		if one_successful:
 			self._last_rcv_timestamp = int(datetime.now().timestamp())
-			
+			if self._latest_resource is not None:
+				self._latest_resource.changed()
+		
 		if self._alert_resource is not None and len(alerts) > 0:
 			self._alert_resource.notify(alerts)
 		
 		return self._build_msg(code=Code.CHANGED if one_successful else Code.BAD_REQUEST,
 		                       data=insert_status)
+	
+	def _insert_all(self, readings: Iterable) -> Tuple[List[dict], List[dict], bool, Optional[PayloadError]]:
+		"""
+		Verifies alerts and inserts each reading as it is read, possibly from one of the database manager's worker threads.
+		:return: The insert status for each reading, the generated alerts, whether at least one insert was successful and the error that
+		         stopped reading the payload, if any.
+		"""
+		one_successful = False
+		insert_status = []
+		alerts = []
+		max_readings = self._admission.max_readings if self._admission is not None else None
+		stop_error = None
 
+		if max_readings is not None:
+			# Read up to one over the limit before inserting anything, so too many readings are refused as a whole
+			buffered = []
+			try:
+				for data in readings:
+					buffered.append(data)
+					if len(buffered) > max_readings:
+						return [], [], False, PayloadTooLarge(f'Too many readings, at most {max_readings} are accepted at once')
+			except PayloadError as e:
+				stop_error = e
+			readings = buffered
+
+		# Insert values
+		try:
+			for data in readings:
+				if not isinstance(data, dict):
+					insert_status.append({'error': 'Bad JSON format'})
+					continue
 
-class DatatypeResource(BaseResource):
+				try:
+					alert = None
+					if self._alert_resource is not None:
+						alert = self._db_manager.verify_alert(self._name, data)
+						if alert is not None:
+							alerts.append(alert)
+
+					if alert is not None and alert['p']:
+						insert_status.append({'error': f'Alert prohibits insert: {alert["a"]}'})
+						continue
+
+					obj_id = self._db_manager.insert_data(self._name, data)
+
+				except InvalidData as e:
+					insert_status.append({'error': str(e)})
+
+				except Exception:
+					from traceback import print_exc
+					print_exc()
+					insert_status.append({'error': 'Internal Server Error'})
+
+				else:
+					insert_status.append({'id': str(obj_id)})
+					one_successful = True
+
+		except PayloadError as e:
+			return insert_status, alerts, one_successful, e
+
+		return insert_status, alerts, one_successful, stop_error
+	
+	def _wrap_data(self, data: Optional[dict]) -> dict:
+		return {
+			'c': self._name,
+			'l': self._last_rcv_timestamp,
+			'd': data
+		}
+
+
+class DatatypeResource(DataResource):
 	"""
 	Representation of a datatype, for querying the stored data by datatype instead of by client.
 	"""
+	_filter_keys = ('c', 'client')
 	
-	def __init__(self, name: str, db_manager: DataManager):
+	def __init__(self, name: str, db_manager: DataManager, observable: bool = False):
 		"""
 		Simple class for a datatype.
 		:param name: The datatype's registered name.
 		:param db_manager: An instance of the database manager.
+		:param observable: Whether the resource accepts observers, notified with the newly inserted readings by `publish`.
 		"""
 		self._name = name
-		super().__init__(db_manager)
+		super().__init__(db_manager, observable)
 	
 	@_gzip_payload
-	def render_get(self, request: Message):
+	async def render_get(self, request: Message):
 		"""
 		Get method for the datatype, getting data the clients have sent of the specified datatype.
 		If sent with an empty payload, will simply return all data.
-		If a payload is present, expects a gzip compressed json payload (preferably minified) with the following optional key:
+		If a payload is present, expects a gzip compressed json payload (preferably minified) with the following optional keys:
 		`t` or `time`: an array with two values for a range of values between dates. Additionally, if the first value is null,
 					   all data since the beginning until the second value is returned. Similarly, if the second value is null,
 					   all data since the first value until now will be returned.
+		`a` or `after`: the `_id` of the last item already received, see the client resource.
+		`ni` or `noid`: a true or false value. If true, the `_id` of each reading is not returned.
+		`l` or `limit`: an int, the maximum number of readings returned for each client. Without `a`, the latest readings are returned.
+		`latest`: a true or false value. If true, only the latest reading for each client is returned, same as a `l` of 1.
+		`f` or `format`: either "rows", the default, for a list of readings, or "columns" for an object with a list for each field:
+		                 `t` for the timestamps, `v` for the values and `i` for the ids, unless `ni` is set.
 		
 		The following is a valid payload::
 		```
@@ -346,6 +794,8 @@ class DatatypeResource(BaseResource):
 		     the requested data that said client sent.
 		     
 		If you must filter by client, use the client resource instead.
+		If the resource is observable, notifications contain only the newly inserted readings, in the same format, filtered by the `ni` and
+		`f` keys of the request that started the observation and by its `c` or `client` key, the name of a single client.
 		"""
 		if len(request.payload) > 0:
 			# Load the json
@@ -358,37 +808,41 @@ class DatatypeResource(BaseResource):
 			
 			# Verify parameters
 			timerange = parameters.get('t') or parameters.get('time')
+			after = parameters.get('a') or parameters.get('after')
 			try:
-				datatype_data = self._db_manager.query_data_type(self._name, timerange)
+				options = self._query_options(parameters)
+				datatype_data = await self._db_manager.run_async(self._db_manager.query_data_type, self._name, timerange, after, **options)
 			except (InvalidData, ValueError, TypeError) as e:
 				return self._build_msg(code=Code.BAD_REQUEST, data={'error': str(e)})
 		
 		else:
-			datatype_data = self._db_manager.query_data_type(self._name)
+			datatype_data = await self._db_manager.run_async(self._db_manager.query_data_type, self._name)
 			
-		# Reformat data for response
-		if datatype_data is not None:
-			for client in datatype_data.values():
-				for item in client:
-					item['_id'] = str(item['_id'])
-					item['datetime'] = int(item['datetime'].timestamp())
-		
-		return self._build_msg(data={
+		return self._build_msg(data=self._wrap_data(datatype_data))
+	
+	def _wrap_data(self, data: Optional[dict]) -> dict:
+		return {
 			'n': self._name,
-			'd': datatype_data
-		})
+			'd': data
+		}
 
 
 class AllData(BaseResource):
 	@_gzip_payload
-	def render_get(self, request: Message):
+	async def render_get(self, request: Message):
 		"""
 		Get method all data in the database;
 		If sent with an empty payload, will simply return all data.
-		If a payload is present, expects a gzip compressed json payload (preferably minified) with the following optional key:
+		If a payload is present, expects a gzip compressed json payload (preferably minified) with the following optional keys:
 		`t` or `time`: an array with two values for a range of values between dates. Additionally, if the first value is null,
 					   all data since the beginning until the second value is returned. Similarly, if the second value is null,
 					   all data since the first value until now will be returned.
+		`a` or `after`: the `_id` of the last item already received, see the client resource.
+		`ni` or `noid`: a true or false value. If true, the `_id` of each reading is not returned.
+		`l` or `limit`: an int, the maximum number of readings returned for each client and datatype. Without `a`, the latest readings are returned.
+		`latest`: a true or false value. If true, only the latest reading for each client and datatype is returned, same as a `l` of 1.
+		`f` or `format`: either "rows", the default, for a list of readings, or "columns" for an object with a list for each field:
+		                 `t` for the timestamps, `v` for the values and `i` for the ids, unless `ni` is set.
 
 		The following is a valid payload::
 		```
@@ -417,23 +871,71 @@ class AllData(BaseResource):
 			
 			# Verify parameters
 			timerange = parameters.get('t') or parameters.get('time')
+			after = parameters.get('a') or parameters.get('after')
 			try:
-				data = self._db_manager.query_all(timerange)
+				options = self._query_options(parameters)
+				data = await self._db_manager.run_async(self._db_manager.query_all, timerange, after, **options)
 			except (InvalidData, ValueError, TypeError) as e:
 				return self._build_msg(code=Code.BAD_REQUEST, data={'error': str(e)})
 		
 		else:
-			data = self._db_manager.query_all()
-		
-		# Convert datetimes to timestamps and ObjectIds to strings
-		# 4 nested loops, gods help us all
-		for client in data.values():
-			for datatype in client.values():
-				for item in datatype:
-					for key, value in item.items():
-						if isinstance(value, ObjectId):
-							item[key] = str(value)
-						elif isinstance(value, datetime):
-							item[key] = int(value.timestamp())
+			data = await self._db_manager.run_async(self._db_manager.query_all)
 		
 		return self._build_msg(data=data)
+
+
+class AlertHistoryResource(BaseResource):
+	"""
+	Provides a GET method for querying the persisted alert history.
+	"""
+	
+	@_gzip_payload
+	async def render_get(self, request: Message):
+		"""
+		Get method for the alert history.
+		If sent with an empty payload, will simply return all stored alerts.
+		If a payload is present, expects a gzip compressed json payload (preferably minified) with 3 optional keys:
+		`c` or `client`: name of a specific registered client. If set, will only return alerts from that client.
+		`d` or `datatype`: name of a specific registered datatype. If set, will only return alerts from that datatype.
+		`t` or `time`: an array with two values for a range of values between dates. Additionally, if the first value is null,
+		               all alerts since the beginning until the second value are returned. Similarly, if the second value is null,
+		               all alerts since the first value until now will be returned.
+		
+		The following is a valid payload, assuming the datatype "temp" exists:
+		```
+		{
+			"d": "temp",
+			"t": [null, 1566687475]
+		}
+		```
+		
+		Returns a gzip compressed json list of alerts ordered by time, each an object with the keys:
+		`_id`: the alert's id.
+		`c`: the client's name.
+		`n`: the datatype's name.
+		`a`: the alert description, as sent to the client's alert observers.
+		`p`: whether or not the alert prohibited the insert.
+		`datetime`: timestamp of the data that generated the alert.
+		"""
+		client = None
+		datatype = None
+		timerange = None
+		if len(request.payload) > 0:
+			# Load the json
+			try:
+				parameters = json.loads(request.payload)
+				if not isinstance(parameters, dict):
+					return self._build_msg(code=Code.BAD_REQUEST, data={'error': 'Bad JSON format'})
+			except (json.JSONDecodeError, UnicodeDecodeError):
+				return self._build_msg(code=Code.BAD_REQUEST, data={'error': 'Bad JSON format'})
+			
+			client = parameters.get('c') or parameters.get('client')
+			datatype = parameters.get('d') or parameters.get('datatype')
+			timerange = parameters.get('t') or parameters.get('time')
+		
+		try:
+			alerts = await self._db_manager.run_async(self._db_manager.query_alerts, client, datatype, timerange)
+		except (InvalidData, InvalidClient, ValueError, TypeError) as e:
+			return self._build_msg(code=Code.BAD_REQUEST, data={'error': str(e)})
+		
+		return self._build_msg(data=alerts)
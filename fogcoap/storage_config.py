@@ -0,0 +1,91 @@
+from pymongo import ReadPreference
+from typing import Optional, List, Union
+
+
+class StorageConfig:
+	_ReadPreferences = {
+		'primary': ReadPreference.PRIMARY,
+		'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+		'secondary': ReadPreference.SECONDARY,
+		'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+		'nearest': ReadPreference.NEAREST
+	}
+
+	def __init__(self, max_pool_size: int = 100, min_pool_size: int = 0, max_idle_time_ms: Optional[int] = None,
+	             connect_timeout_ms: Optional[int] = None, server_selection_timeout_ms: Optional[int] = None,
+	             socket_timeout_ms: Optional[int] = None, compressors: Optional[List[str]] = None, w: Union[int, str, None] = None,
+	             journal: Optional[bool] = None, query_read_preference: str = 'primary', async_workers: int = 0,
+	             query_concurrency: int = 8, use_union_with: bool = False):
+		"""
+		Connection and driver settings for the `DataManager`. Every parameter left as `None` uses the driver's default.
+		:param max_pool_size: Maximum number of connections to the database.
+		:param min_pool_size: Number of connections kept open even when idle.
+		:param max_idle_time_ms: Milliseconds a connection can stay idle in the pool before being closed.
+		:param connect_timeout_ms: Milliseconds to wait for a connection to be established.
+		:param server_selection_timeout_ms: Milliseconds to wait for a suitable server before an operation fails.
+		:param socket_timeout_ms: Milliseconds to wait for a response on an established connection.
+		:param compressors: Wire protocol compressors to negotiate with the server, in order of preference, for example `['zstd', 'snappy']`.
+		                    Each one requires its python module to be installed.
+		:param w: Write concern for inserts, either the number of nodes that must acknowledge a write or `'majority'`.
+		:param journal: Whether writes must be committed to the journal before being acknowledged.
+		:param query_read_preference: Read preference for the data and alert queries, one of `'primary'`, `'primaryPreferred'`, `'secondary'`,
+		                              `'secondaryPreferred'` or `'nearest'`. Reading from secondaries keeps big queries away from the node
+		                              receiving inserts. Metadata is always read from the primary.
+		:param async_workers: If higher than 0, enables the async mode: the broker's resources run their database operations on this many
+		                      worker threads instead of on the event loop, so slow queries don't stall other requests. Must not be higher
+		                      than `max_pool_size`.
+		:param query_concurrency: Maximum number of collections read at the same time by a single query spanning several collections.
+		                          Each concurrent read takes a connection from the pool.
+		:param use_union_with: Whether datatype queries should read every client's collection in a single aggregation with `$unionWith`,
+		                       instead of one read per client. Requires MongoDB 4.4 or newer.
+		"""
+		if max_pool_size <= 0:
+			raise ValueError('max_pool_size must be higher than 0')
+		if min_pool_size < 0 or min_pool_size > max_pool_size:
+			raise ValueError('min_pool_size must be between 0 and max_pool_size')
+		if query_read_preference not in self._ReadPreferences:
+			raise ValueError(f'Invalid read preference {query_read_preference}, expected one of {", ".join(self._ReadPreferences)}')
+		if async_workers < 0:
+			raise ValueError('async_workers must not be negative')
+		if async_workers > max_pool_size:
+			raise ValueError('async_workers must not be higher than max_pool_size, or workers would starve the connection pool')
+		if query_concurrency <= 0:
+			raise ValueError('query_concurrency must be higher than 0')
+
+		self.max_pool_size = max_pool_size
+		self.min_pool_size = min_pool_size
+		self.max_idle_time_ms = max_idle_time_ms
+		self.connect_timeout_ms = connect_timeout_ms
+		self.server_selection_timeout_ms = server_selection_timeout_ms
+		self.socket_timeout_ms = socket_timeout_ms
+		self.compressors = compressors
+		self.w = w
+		self.journal = journal
+		self.query_read_preference = query_read_preference
+		self.async_workers = async_workers
+		self.query_concurrency = query_concurrency
+		self.use_union_with = use_union_with
+
+	def client_options(self) -> dict:
+		"""
+		:return: The keyword arguments for `pymongo.MongoClient`.
+		"""
+		options = {
+			'maxPoolSize': self.max_pool_size,
+			'minPoolSize': self.min_pool_size,
+			'maxIdleTimeMS': self.max_idle_time_ms,
+			'connectTimeoutMS': self.connect_timeout_ms,
+			'serverSelectionTimeoutMS': self.server_selection_timeout_ms,
+			'socketTimeoutMS': self.socket_timeout_ms,
+			'compressors': ','.join(self.compressors) if self.compressors else None,
+			'w': self.w,
+			'journal': self.journal
+		}
+
+		return {key: value for (key, value) in options.items() if value is not None}
+
+	def read_preference(self):
+		"""
+		:return: The pymongo read preference for queries.
+		"""
+		return self._ReadPreferences[self.query_read_preference]
@@ -0,0 +1,140 @@
+import json
+import zlib
+from codecs import getincrementaldecoder
+from typing import Iterable, Iterator
+
+
+class PayloadError(ValueError):
+	"""Raised when a streamed payload is malformed"""
+	pass
+
+
+class PayloadTooLarge(PayloadError):
+	"""Raised when a streamed payload goes over its size limits"""
+	pass
+
+
+_decoder = json.JSONDecoder()
+_Whitespace = ' \t\n\r'
+# Parser states
+_Start, _FirstItem, _Item, _Separator, _End = range(5)
+
+
+def inflate_gzip(payload: bytes, max_size: int, chunk_size: int = 65536) -> Iterator[bytes]:
+	"""
+	Decompresses a gzip payload incrementally, never holding more than `chunk_size` decompressed bytes at once.
+	Payloads made of several concatenated gzip members are supported, like `gzip.decompress` does.
+	:param payload: The gzip compressed payload.
+	:param max_size: Maximum total size of the decompressed data. `PayloadTooLarge` is raised as soon as it's exceeded.
+	:param chunk_size: Maximum size of each decompressed chunk.
+	:return: An iterator over the decompressed chunks.
+	"""
+	decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	data = payload
+	total = 0
+
+	try:
+		while True:
+			chunk = decompressor.decompress(data, chunk_size)
+			data = decompressor.unconsumed_tail
+
+			total += len(chunk)
+			if total > max_size:
+				raise PayloadTooLarge('Payload inflates too much')
+			if len(chunk) > 0:
+				yield chunk
+
+			if decompressor.eof:
+				data = decompressor.unused_data
+				if len(data) == 0:
+					return
+				decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+			elif len(chunk) == 0 and len(data) == 0:
+				# Nothing left to read, but the stream didn't end
+				raise PayloadError('Bad GZIP compression')
+
+	except zlib.error:
+		raise PayloadError('Bad GZIP compression')
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator:
+	"""
+	Parses a json array incrementally from chunks of utf-8 encoded text, yielding each item as soon as it's complete.
+	Only the item being parsed is kept in memory, never the whole text nor the whole array.
+	Raises `PayloadError` if the top object is not an array or the text is not valid json, after yielding every item before the error.
+	:param chunks: An iterable of bytes, such as the one returned by `inflate_gzip`.
+	:return: An iterator over the array's items.
+	"""
+	text_decoder = getincrementaldecoder('utf-8')()
+	buffer = ''
+	state = _Start
+	# Size the buffer must reach before retrying to parse an incomplete item, so big items aren't parsed again for every chunk
+	retry_size = 0
+
+	chunks = iter(chunks)
+	final = False
+	while not final:
+		try:
+			chunk = next(chunks)
+		except StopIteration:
+			chunk = b''
+			final = True
+
+		try:
+			buffer += text_decoder.decode(chunk, final)
+		except UnicodeDecodeError:
+			raise PayloadError('Bad JSON format')
+
+		pos = 0
+		while True:
+			while pos < len(buffer) and buffer[pos] in _Whitespace:
+				pos += 1
+			if pos == len(buffer):
+				break
+
+			if state == _Start:
+				if buffer[pos] != '[':
+					raise PayloadError('JSON top object not an array')
+				pos += 1
+				state = _FirstItem
+
+			elif state == _Separator or (state == _FirstItem and buffer[pos] == ']'):
+				if buffer[pos] == ']':
+					pos += 1
+					state = _End
+				elif buffer[pos] == ',':
+					pos += 1
+					state = _Item
+				else:
+					raise PayloadError('Bad JSON format')
+
+			elif state == _End:
+				raise PayloadError('Bad JSON format')
+
+			else:
+				if len(buffer) - pos < retry_size and not final:
+					break
+
+				try:
+					item, end = _decoder.raw_decode(buffer, pos)
+				except json.JSONDecodeError:
+					if final:
+						raise PayloadError('Bad JSON format')
+					# Most likely an item cut between chunks, wait for more
+					retry_size = 2 * (len(buffer) - pos)
+					break
+
+				if end == len(buffer) and not final:
+					# A number or literal at the end may still continue in the next chunk
+					retry_size = 2 * (len(buffer) - pos)
+					break
+
+				pos = end
+				state = _Separator
+				retry_size = 0
+				yield item
+
+		buffer = buffer[pos:]
+
+	if state != _End:
+		raise PayloadError('Bad JSON format')
@@ -0,0 +1,139 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+from aiocoap import Message, Code
+from fogcoap.admission import TokenBucket, AdmissionController
+from fogcoap.resources import _admit, _rate_limit
+
+
+class _Clock:
+	def __init__(self):
+		self.now = 100.0
+
+	def __call__(self) -> float:
+		return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+	def setUp(self):
+		self.clock = _Clock()
+		patcher = patch('fogcoap.admission.monotonic', self.clock)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_burst(self):
+		bucket = TokenBucket(rate=1, burst=3)
+		self.assertEqual([bucket.take() for _ in range(3)], [0, 0, 0])
+		self.assertEqual(bucket.take(), 1)
+
+	def test_refill(self):
+		bucket = TokenBucket(rate=2, burst=1)
+		self.assertEqual(bucket.take(), 0)
+		self.assertEqual(bucket.take(), 0.5)
+
+		self.clock.now += 0.25
+		self.assertAlmostEqual(bucket.take(), 0.25)
+		self.clock.now += 0.25
+		self.assertEqual(bucket.take(), 0)
+
+	def test_refill_is_capped_at_burst(self):
+		bucket = TokenBucket(rate=10, burst=2)
+		self.clock.now += 60
+		self.assertEqual([bucket.take() for _ in range(2)], [0, 0])
+		self.assertGreater(bucket.take(), 0)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+	def setUp(self):
+		self.clock = _Clock()
+		patcher = patch('fogcoap.admission.monotonic', self.clock)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_unbounded_by_default(self):
+		admission = AdmissionController()
+		self.assertTrue(all(admission.enter() for _ in range(1000)))
+		self.assertEqual(admission.take('c1'), 0)
+
+	def test_per_client_limits(self):
+		admission = AdmissionController(client_rate=0.5, client_burst=2)
+		self.assertEqual([admission.take('c1') for _ in range(2)], [0, 0])
+		# Rounded up, 2 seconds for a whole token at 0.5 per second
+		self.assertEqual(admission.take('c1'), 2)
+		# Other clients have their own bucket
+		self.assertEqual(admission.take('c2'), 0)
+
+		self.clock.now += 2
+		self.assertEqual(admission.take('c1'), 0)
+
+	def test_in_flight(self):
+		admission = AdmissionController(max_in_flight=2)
+		self.assertTrue(admission.enter())
+		self.assertTrue(admission.enter())
+		self.assertFalse(admission.enter())
+		self.assertEqual(admission.in_flight, 2)
+
+		admission.leave()
+		self.assertTrue(admission.enter())
+
+	def test_invalid_limits(self):
+		for kwargs in ({'client_rate': 0}, {'client_burst': 0}, {'max_in_flight': 0}, {'max_readings': -1}):
+			with self.subTest(**kwargs), self.assertRaises(ValueError):
+				AdmissionController(**kwargs)
+
+
+class _Resource:
+	def __init__(self, admission: AdmissionController):
+		self._name = 'c1'
+		self._admission = admission
+		self.handled = 0
+
+	async def handle(self, request: Message) -> Message:
+		self.handled += 1
+		if request.payload == b'fail':
+			raise ValueError('failed')
+		return Message(code=Code.CHANGED)
+
+
+class RejectTest(unittest.TestCase):
+	def setUp(self):
+		self.clock = _Clock()
+		patcher = patch('fogcoap.admission.monotonic', self.clock)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_busy(self):
+		admission = AdmissionController(max_in_flight=1, busy_retry=3)
+		resource = _Resource(admission)
+		admission.enter()
+
+		response = asyncio.run(_admit(_Resource.handle)(resource, Message(code=Code.POST)))
+		self.assertEqual(response.code, Code.SERVICE_UNAVAILABLE)
+		self.assertEqual(response.opt.max_age, 3)
+		self.assertEqual(resource.handled, 0)
+
+		admission.leave()
+		response = asyncio.run(_admit(_Resource.handle)(resource, Message(code=Code.POST)))
+		self.assertEqual(response.code, Code.CHANGED)
+		self.assertEqual(admission.in_flight, 0)
+
+	def test_failed_requests_leave(self):
+		admission = AdmissionController(max_in_flight=1)
+		with self.assertRaises(ValueError):
+			asyncio.run(_admit(_Resource.handle)(_Resource(admission), Message(code=Code.POST, payload=b'fail')))
+		self.assertEqual(admission.in_flight, 0)
+
+	def test_too_many_requests(self):
+		resource = _Resource(AdmissionController(client_rate=1, client_burst=1))
+		handle = _rate_limit(_Resource.handle)
+
+		self.assertEqual(asyncio.run(handle(resource, Message(code=Code.POST))).code, Code.CHANGED)
+		response = asyncio.run(handle(resource, Message(code=Code.POST)))
+		self.assertEqual(response.code, Code.TOO_MANY_REQUESTS)
+		self.assertEqual(response.opt.max_age, 1)
+		self.assertEqual(response.payload, b'{"error":"Too many requests"}')
+		self.assertEqual(resource.handled, 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,133 @@
+import json
+import asyncio
+import unittest
+from gzip import compress as gzcompress, decompress as gzdecompress
+from aiocoap import Message, Code
+from fogcoap.alerts import AlertStream, ClientAlert
+
+
+def _alert(datatype: str, description: str = 'value > 10') -> dict:
+	return {'n': datatype, 't': 1000, 'a': description, 'p': False}
+
+
+def _request(parameters: dict = None) -> Message:
+	return Message(code=Code.GET, payload=gzcompress(json.dumps(parameters).encode('ascii')) if parameters is not None else b'')
+
+
+class _Stream:
+	def __init__(self):
+		self.published = []
+
+	def publish(self, client: str, alerts: list):
+		self.published.append((client, alerts))
+
+
+class ClientAlertTest(unittest.TestCase):
+	def test_coalesced_alerts_are_sent_together(self):
+		stream = _Stream()
+		resource = ClientAlert(coalesce_window=0.05, client='c1', stream=stream)
+
+		async def notify():
+			resource.notify([_alert('temp')])
+			resource.notify([_alert('hum')])
+			self.assertEqual(stream.published, [])
+			await asyncio.sleep(0.1)
+			return await resource.render_get(_request())
+
+		response = asyncio.run(notify())
+		self.assertEqual([alert['n'] for alert in json.loads(gzdecompress(response.payload))], ['temp', 'hum'])
+		self.assertEqual(len(stream.published), 1)
+
+	def test_duplicates_are_dropped(self):
+		stream = _Stream()
+		resource = ClientAlert(dedup_window=60, client='c1', stream=stream)
+		resource.notify([_alert('temp')])
+		resource.notify([_alert('temp')])
+		resource.notify([_alert('temp', 'value < 0')])
+		self.assertEqual([alerts[0]['a'] for _, alerts in stream.published], ['value > 10', 'value < 0'])
+
+	def test_rate_limit(self):
+		stream = _Stream()
+		resource = ClientAlert(min_interval=60, client='c1', stream=stream)
+		resource.notify([_alert('temp')])
+		resource.notify([_alert('temp', 'value < 0')])
+		resource.notify([_alert('hum')])
+		self.assertEqual([alerts[0]['n'] for _, alerts in stream.published], ['temp', 'hum'])
+
+	def test_stream_requires_client(self):
+		with self.assertRaises(ValueError):
+			ClientAlert(stream=_Stream())
+
+
+class AlertStreamTest(unittest.TestCase):
+	def _render(self, stream: AlertStream, parameters: dict = None):
+		response = asyncio.run(stream.render_get(_request(parameters)))
+		return response.code, json.loads(gzdecompress(response.payload))
+
+	def _published(self, count: int = 3, backlog: int = 1024) -> AlertStream:
+		stream = AlertStream(backlog)
+		for i in range(count):
+			stream.publish(f'c{i}', [_alert('temp' if i % 2 == 0 else 'hum')])
+		return stream
+
+	def test_latest_event(self):
+		code, events = self._render(self._published())
+		self.assertEqual([event['s'] for event in events], [3])
+
+	def test_catch_up(self):
+		stream = self._published()
+		_, events = self._render(stream, {'s': 1, 'e': stream._epoch})
+		self.assertEqual([event['s'] for event in events], [2, 3])
+
+	def test_catch_up_is_bounded_by_the_backlog(self):
+		stream = self._published(5, backlog=2)
+		_, events = self._render(stream, {'s': 0, 'e': stream._epoch})
+		self.assertEqual([event['s'] for event in events], [4, 5])
+
+	def test_filters(self):
+		stream = self._published()
+		_, events = self._render(stream, {'s': 0, 'd': 'temp'})
+		self.assertEqual([event['c'] for event in events], ['c0', 'c2'])
+		_, events = self._render(stream, {'s': 0, 'c': 'c1'})
+		self.assertEqual([event['c'] for event in events], ['c1'])
+
+	def test_previous_epoch_gets_everything(self):
+		stream = self._published()
+		_, events = self._render(stream, {'s': 2, 'e': stream._epoch - 1})
+		self.assertEqual([event['s'] for event in events], [1, 2, 3])
+		self.assertTrue(all(event['e'] == stream._epoch for event in events))
+
+	def test_seq_from_a_previous_run_gets_everything(self):
+		_, events = self._render(self._published(), {'s': 5000})
+		self.assertEqual([event['s'] for event in events], [1, 2, 3])
+
+	def test_bool_seq_is_rejected(self):
+		code, error = self._render(self._published(), {'s': True})
+		self.assertEqual(code, Code.BAD_REQUEST)
+		self.assertEqual(error, {'error': 'Sequence number must be an int'})
+
+	def test_bad_gzip_error_is_not_compressed(self):
+		response = asyncio.run(AlertStream().render_get(Message(code=Code.GET, payload=b'not gzip')))
+		self.assertEqual(response.code, Code.BAD_REQUEST)
+		self.assertEqual(response.payload, b'{"error": "Bad GZIP compression"}')
+
+	def test_observers_are_notified_when_filters_match(self):
+		stream = AlertStream()
+		triggered = []
+
+		class Observation:
+			def accept(self, cancellation_callback):
+				pass
+
+			def trigger(self, response=None):
+				triggered.append(json.loads(gzdecompress(response.payload)))
+
+		asyncio.run(stream.add_observation(_request({'d': 'hum'}), Observation()))
+		stream.publish('c1', [_alert('temp')])
+		stream.publish('c1', [_alert('hum'), _alert('temp')])
+		self.assertEqual(len(triggered), 1)
+		self.assertEqual([alert['n'] for alert in triggered[0][0]['a']], ['hum'])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,39 @@
+import asyncio
+import unittest
+from aiocoap import Context, Message, Code
+from fogcoap.broker import _StartingSite
+
+
+class StartingSiteTest(unittest.TestCase):
+	_Bind = ('127.0.0.1', 56830)
+
+	def _request(self, site: _StartingSite, path: tuple) -> Message:
+		async def request():
+			server = await Context.create_server_context(site, bind=self._Bind)
+			try:
+				client = await Context.create_client_context()
+				try:
+					uri = f'coap://{self._Bind[0]}:{self._Bind[1]}/' + '/'.join(path)
+					return await client.request(Message(code=Code.GET, uri=uri)).response
+				finally:
+					await client.shutdown()
+			finally:
+				await server.shutdown()
+
+		return asyncio.run(request())
+
+	def test_unknown_path_while_starting(self):
+		response = self._request(_StartingSite(), ('client', 'unknown'))
+		self.assertEqual(response.code, Code.SERVICE_UNAVAILABLE)
+		self.assertEqual(response.opt.max_age, 1)
+		self.assertEqual(response.payload, b'{"error":"Server starting"}')
+
+	def test_unknown_path_after_starting(self):
+		site = _StartingSite()
+		site.starting = False
+		response = self._request(site, ('client', 'unknown'))
+		self.assertEqual(response.code, Code.NOT_FOUND)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,113 @@
+import gzip
+import os
+import unittest
+import numpy as np
+from tempfile import TemporaryDirectory
+from datetime import datetime, timedelta
+from fogcoap.bulk import BulkExporter, BulkImporter
+from fogcoap.data_manager import DataManager, StorageType, InvalidData, InvalidClient
+
+
+class _FakeManager:
+	# Stores readings in memory, as {(client, datatype): [(datetime, value)]}, with the chunking of `DataManager.export`
+	def __init__(self):
+		self.data = {}
+		self.datatypes = {
+			'temp': {'name': 'temp', 'storage_type': StorageType.NUMBER.value},
+			'label': {'name': 'label', 'storage_type': StorageType.STR.value}
+		}
+		self.batches = 0
+
+	def query_client(self, client: str):
+		return {'name': client} if client == 'c1' else None
+
+	def query_datatype(self, datatype: str):
+		return self.datatypes.get(datatype)
+
+	def insert_many(self, client: str, readings: list) -> list:
+		self.batches += 1
+		results = []
+		for reading in readings:
+			if reading['n'] not in self.datatypes:
+				results.append(InvalidData('Specified datatype has not been registered'))
+				continue
+			self.data.setdefault((client, reading['n']), []).append((DataManager._parse_timestamp(reading['t']), reading['v']))
+			results.append(len(results))
+		return results
+
+	def export(self, clients, datatypes, date_range, chunk_size: int):
+		for (client, datatype), readings in self.data.items():
+			for i in range(0, len(readings), chunk_size):
+				chunk = readings[i:i + chunk_size]
+				yield client, datatype, {'t': [when for when, _ in chunk], 'v': [value for _, value in chunk]}
+			yield client, datatype, None
+
+
+def _readings(count: int, milliseconds: bool = True) -> list:
+	start = datetime(2024, 1, 1)
+	return [(start + timedelta(seconds=i, milliseconds=i if milliseconds else 0), float(i)) for i in range(count)]
+
+
+class RoundTripTest(unittest.TestCase):
+	def test_npz_chunks(self):
+		dm = _FakeManager()
+		dm.data[('c1', 'temp')] = _readings(5)
+		dm.data[('c1', 'label')] = [(when, str(value)) for when, value in _readings(3)]
+
+		with TemporaryDirectory() as directory:
+			counts = BulkExporter(dm, chunk_size=2).export(directory, 'npz')
+			self.assertEqual(counts, {('c1', 'temp'): 5, ('c1', 'label'): 3})
+
+			with np.load(os.path.join(directory, 'c1.temp.npz')) as file:
+				self.assertEqual(sorted(file.files), ['t_0', 't_1', 't_2', 'v_0', 'v_1', 'v_2'])
+				self.assertEqual([len(file[f't_{i}']) for i in range(3)], [2, 2, 1])
+				times = np.concatenate([file[f't_{i}'] for i in range(3)])
+				values = np.concatenate([file[f'v_{i}'] for i in range(3)])
+
+			with np.load(os.path.join(directory, 'c1.label.npz')) as file:
+				labels = np.concatenate([file[f'v_{i}'] for i in range(2)])
+
+		self.assertEqual([when.astype(datetime) for when in times], [when for when, _ in dm.data[('c1', 'temp')]])
+		self.assertEqual(values.tolist(), [value for _, value in dm.data[('c1', 'temp')]])
+		self.assertEqual(labels.tolist(), ['0.0', '1.0', '2.0'])
+
+		# Imported back into another database
+		other = _FakeManager()
+		readings = ((i, {'n': 'temp', 't': when.isoformat(), 'v': value}) for i, (when, value) in
+		            enumerate(zip((when.astype(datetime) for when in times), values.tolist()), 1))
+		result = BulkImporter(other, workers=2, batch_size=2).import_readings('c1', readings)
+		self.assertEqual((result.inserted, result.rejected), (5, 0))
+		self.assertEqual(sorted(other.data[('c1', 'temp')]), dm.data[('c1', 'temp')])
+
+	def test_ndjson(self):
+		dm = _FakeManager()
+		# Timestamps are written in seconds
+		dm.data[('c1', 'temp')] = _readings(5, milliseconds=False)
+
+		with TemporaryDirectory() as directory:
+			BulkExporter(dm, chunk_size=2).export(directory, 'ndjson')
+			with gzip.open(os.path.join(directory, 'c1.temp.ndjson.gz'), 'rt') as file:
+				readings = [(line, dict(reading, n='temp')) for line, reading in BulkImporter.iter_ndjson(file)]
+
+		other = _FakeManager()
+		result = BulkImporter(other, batch_size=2).import_readings('c1', readings)
+		self.assertEqual((result.inserted, result.rejected), (5, 0))
+		self.assertEqual(other.batches, 3)
+		self.assertEqual(sorted(other.data[('c1', 'temp')]), dm.data[('c1', 'temp')])
+
+	def test_import_rejects(self):
+		readings = [(1, {'n': 'temp', 't': 1000, 'v': 0}), (2, InvalidData('Bad JSON format')), (3, {'n': 'unknown', 't': 1000, 'v': 1})]
+		dm = _FakeManager()
+		result = BulkImporter(dm).import_readings('c1', readings)
+
+		self.assertEqual((result.inserted, result.rejected), (1, 2))
+		self.assertEqual([line for line, _ in result.errors], [2, 3])
+		self.assertEqual(dm.data[('c1', 'temp')][0][1], 0)
+
+	def test_unknown_client(self):
+		with self.assertRaises(InvalidClient):
+			BulkImporter(_FakeManager()).import_readings('c2', [])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,137 @@
+import logging
+import threading
+import unittest
+from datetime import datetime
+from fogcoap.data_manager import DataManager, InvalidData, StorageType
+from fogcoap.storage_config import StorageConfig
+
+
+def _bare_manager() -> DataManager:
+	# Only the in-memory state used by the methods under test, without connecting to a database
+	dm = DataManager.__new__(DataManager)
+	dm._stats = {}
+	dm._stats_lock = threading.Lock()
+	dm._stats_version = 0
+	dm._latest = {}
+	dm._latest_lock = threading.Lock()
+	return dm
+
+
+class _FakeCollection:
+	def __init__(self, documents: list = ()):
+		self.documents = list(documents)
+		self.operations = []
+
+	def find(self):
+		return iter(self.documents)
+
+	def put(self, operation, key=None):
+		self.operations.append(operation)
+
+
+class ParseTimestampTest(unittest.TestCase):
+	def test_offset_is_converted_to_naive_local_time(self):
+		parsed = DataManager._parse_timestamp('2024-01-01T12:00:00+02:00')
+		self.assertIsNone(parsed.tzinfo)
+		self.assertEqual(parsed, DataManager._parse_timestamp(int(datetime.fromisoformat('2024-01-01T12:00:00+02:00').timestamp())))
+
+	def test_naive_values_are_unchanged(self):
+		self.assertEqual(DataManager._parse_timestamp('2024-01-01T12:00:00'), datetime(2024, 1, 1, 12))
+		self.assertEqual(DataManager._parse_timestamp(datetime(2024, 1, 1, 12)), datetime(2024, 1, 1, 12))
+
+
+class VerifyDataTest(unittest.TestCase):
+	def setUp(self):
+		self.dm = _bare_manager()
+		self.dm._logger = logging.Logger(__name__)
+
+	def test_zero_value(self):
+		for key in ('v', 'value'):
+			with self.subTest(key=key):
+				name, value, when = self.dm._verify_data({'n': 'temp', key: 0, 't': 1000})
+				self.assertEqual((name, value, when), ('temp', 0, datetime.fromtimestamp(1000)))
+
+	def test_missing_value(self):
+		with self.assertRaises(InvalidData):
+			self.dm._verify_data({'n': 'temp', 't': 1000})
+		with self.assertRaises(InvalidData):
+			self.dm._verify_data({'n': 'temp', 'v': None, 't': 1000})
+
+
+class VerifyRetentionTest(unittest.TestCase):
+	def setUp(self):
+		self.dm = _bare_manager()
+		self.dm._logger = logging.Logger(__name__)
+
+	def test_valid(self):
+		self.assertEqual(self.dm._verify_retention(3600, 60, StorageType.NUMBER), (3600, 60))
+		self.assertEqual(self.dm._verify_retention(None, None, StorageType.NUMBER), (None, None))
+		self.assertEqual(self.dm._verify_retention(3600, 60, StorageType.STR), (3600, None))
+
+	def test_bools_are_rejected(self):
+		for retention, rollup in ((True, None), (3600, True), (False, None)):
+			with self.subTest(retention=retention, rollup=rollup), self.assertRaises(ValueError):
+				self.dm._verify_retention(retention, rollup, StorageType.NUMBER)
+
+	def test_invalid(self):
+		for retention, rollup in ((0, None), (-1, None), (1.5, None), (None, 60), (3600, 0), (3600, '60')):
+			with self.subTest(retention=retention, rollup=rollup), self.assertRaises(ValueError):
+				self.dm._verify_retention(retention, rollup, StorageType.NUMBER)
+
+
+class StatsTest(unittest.TestCase):
+	def test_offset_insert_after_naive_seed(self):
+		dm = _bare_manager()
+		# Seeded from the database, which returns naive datetimes
+		dm._stats[('c', 'd')] = [1, datetime(2000, 1, 1), 10]
+
+		document = {'value': 1, 'datetime': DataManager._parse_timestamp('2024-01-01T12:00:00+02:00')}
+		dm._update_stats('c', 'd', document)
+		self.assertEqual(dm._stats[('c', 'd')][:2], [2, document['datetime']])
+
+
+class LatestTest(unittest.TestCase):
+	def test_offset_insert_after_naive_load(self):
+		dm = _bare_manager()
+		# As stored by MongoDB, which returns naive datetimes
+		loaded = {'_id': {'c': 'c', 'd': 'd'}, 'i': 1, 'value': 1, 'datetime': datetime(2000, 1, 1)}
+		dm._database = {DataManager._Latest: _FakeCollection([loaded])}
+		dm._latest_writer = _FakeCollection()
+		dm._load_latest()
+
+		document = {'_id': 2, 'value': 2, 'datetime': DataManager._parse_timestamp('2024-01-01T12:00:00+02:00')}
+		dm._update_latest('c', 'd', document)
+		self.assertEqual(dm._latest['c']['d'], document)
+		self.assertEqual(len(dm._latest_writer.operations), 1)
+
+		older = {'_id': 3, 'value': 3, 'datetime': DataManager._parse_timestamp('1999-01-01T12:00:00-03:00')}
+		dm._update_latest('c', 'd', older)
+		self.assertEqual(dm._latest['c']['d'], document)
+
+
+class QueryExecutorTest(unittest.TestCase):
+	def test_concurrent_queries_share_one_pool(self):
+		dm = _bare_manager()
+		dm._storage_config = StorageConfig(query_concurrency=2)
+		dm._query_executor = None
+		dm._query_executor_lock = threading.Lock()
+
+		barrier = threading.Barrier(8)
+		executors = []
+
+		def get():
+			barrier.wait()
+			executors.append(dm._get_query_executor())
+
+		threads = [threading.Thread(target=get) for _ in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(len(set(map(id, executors))), 1)
+		executors[0].shutdown()
+
+
+if __name__ == '__main__':
+	unittest.main()
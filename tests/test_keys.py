@@ -0,0 +1,174 @@
+import asyncio
+import unittest
+from time import time
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from gzip import compress as gzcompress
+from aiocoap import Message, Code
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.hashes import SHA256
+from fogcoap.keys import KeyRegistry
+from fogcoap.resources import ClientResource, _verify_sig
+
+
+def _private_key() -> ec.EllipticCurvePrivateKey:
+	return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+
+def _public(private_key: ec.EllipticCurvePrivateKey, encoding=serialization.Encoding.PEM) -> bytes:
+	return private_key.public_key().public_bytes(encoding, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+def _sign(private_key: ec.EllipticCurvePrivateKey, message: bytes) -> bytes:
+	return private_key.sign(message, ec.ECDSA(SHA256()))
+
+
+class KeyRegistryTest(unittest.TestCase):
+	def setUp(self):
+		self.key = _private_key()
+		self.message = b'message'
+		self.signature = _sign(self.key, self.message)
+
+	def test_pem_and_der(self):
+		keys = KeyRegistry()
+		keys.set('pem', _public(self.key))
+		keys.set('der', _public(self.key, serialization.Encoding.DER))
+		self.assertTrue(keys.verify('pem', self.signature, self.message))
+		self.assertTrue(keys.verify('der', self.signature, self.message))
+		self.assertEqual(keys._keys['pem'][0].der, keys._keys['der'][0].der)
+
+	def test_missing_client(self):
+		keys = KeyRegistry()
+		self.assertFalse(keys.verify('c1', self.signature, self.message))
+		self.assertNotIn('c1', keys)
+
+	def test_wrong_key(self):
+		keys = KeyRegistry()
+		keys.set('c1', _public(_private_key()))
+		self.assertFalse(keys.verify('c1', self.signature, self.message))
+
+	def test_bad_signature(self):
+		keys = KeyRegistry()
+		keys.set('c1', _public(self.key))
+		self.assertFalse(keys.verify('c1', self.signature, b'other message'))
+		self.assertFalse(keys.verify('c1', b'garbage', self.message))
+
+	def test_unparseable_key(self):
+		keys = KeyRegistry()
+		keys.set('c1', b'not a key')
+		keys.preload()
+		self.assertFalse(keys.verify('c1', self.signature, self.message))
+
+	def test_rotation(self):
+		new_key = _private_key()
+		keys = KeyRegistry()
+		keys.set('c1', _public(new_key), _public(self.key), datetime.now() + timedelta(hours=1))
+		self.assertTrue(keys.verify('c1', self.signature, self.message))
+		self.assertTrue(keys.verify('c1', _sign(new_key, self.message), self.message))
+
+		# Once expired, the previous key is no longer accepted
+		keys._keys['c1'][1].expiry = time() - 1
+		self.assertFalse(keys.verify('c1', self.signature, self.message))
+		self.assertTrue(keys.verify('c1', _sign(new_key, self.message), self.message))
+
+	def test_expired_previous_key_is_not_kept(self):
+		keys = KeyRegistry()
+		keys.set('c1', _public(_private_key()), _public(self.key), time() - 1)
+		self.assertEqual(len(keys._keys['c1']), 1)
+		self.assertFalse(keys.verify('c1', self.signature, self.message))
+
+	def test_set_replaces_keys(self):
+		keys = KeyRegistry()
+		keys.set('c1', _public(self.key))
+		keys.set_from_document({'name': 'c1', 'ecc_public_key': _public(_private_key())})
+		self.assertFalse(keys.verify('c1', self.signature, self.message))
+
+		keys.remove('c1')
+		self.assertEqual(len(keys), 0)
+
+	def test_preload(self):
+		keys = KeyRegistry()
+		for i in range(5):
+			keys.set(f'c{i}', _public(_private_key()))
+		keys.preload(workers=2)
+		self.assertTrue(all(key.key is not None for client_keys in keys._keys.values() for key in client_keys))
+
+
+class _Resource:
+	_MaxCompressedSize = ClientResource._MaxCompressedSize
+	_MaxInflatedSize = ClientResource._MaxInflatedSize
+	_MaxInflateRatio = ClientResource._MaxInflateRatio
+
+	def __init__(self, keys: KeyRegistry):
+		self._name = 'c1'
+		self._oscore_claim = ':c1'
+		self._keys = keys
+		self.received = []
+
+	@_verify_sig
+	async def render_post(self, request) -> Message:
+		self.received.append(request.payload)
+		return Message(code=Code.CHANGED)
+
+
+def _request(payload: bytes, claims=()):
+	return SimpleNamespace(payload=payload, remote=SimpleNamespace(authenticated_claims=list(claims)))
+
+
+class VerifySigTest(unittest.TestCase):
+	def setUp(self):
+		self.key = _private_key()
+		self.keys = KeyRegistry()
+		self.keys.set('c1', _public(self.key))
+		self.message = gzcompress(b'{"d":{}}')
+
+	def _signed(self, key: ec.EllipticCurvePrivateKey) -> bytes:
+		signature = _sign(key, self.message)
+		return len(signature).to_bytes(2, 'big') + signature + self.message
+
+	def test_signed(self):
+		resource = _Resource(self.keys)
+		response = asyncio.run(resource.render_post(_request(self._signed(self.key))))
+		self.assertEqual(response.code, Code.CHANGED)
+		self.assertEqual(resource.received, [self.message])
+
+	def test_bad_key(self):
+		resource = _Resource(self.keys)
+		response = asyncio.run(resource.render_post(_request(self._signed(_private_key()))))
+		self.assertEqual(response.code, Code.UNAUTHORIZED)
+		self.assertEqual(resource.received, [])
+
+	def test_missing_key(self):
+		resource = _Resource(KeyRegistry())
+		response = asyncio.run(resource.render_post(_request(self._signed(self.key))))
+		self.assertEqual(response.code, Code.UNAUTHORIZED)
+
+	def test_oscore(self):
+		# Authenticated by the security context, so no signature and no key are needed
+		resource = _Resource(KeyRegistry())
+		response = asyncio.run(resource.render_post(_request(self.message, [':c1'])))
+		self.assertEqual(response.code, Code.CHANGED)
+		self.assertEqual(resource.received, [self.message])
+
+	def test_oscore_of_another_client(self):
+		resource = _Resource(self.keys)
+		response = asyncio.run(resource.render_post(_request(self.message, [':c2'])))
+		self.assertEqual(response.code, Code.BAD_REQUEST)
+		self.assertEqual(resource.received, [])
+
+	def test_oscore_bad_gzip(self):
+		resource = _Resource(KeyRegistry())
+		response = asyncio.run(resource.render_post(_request(b'not gzip at all', [':c1'])))
+		self.assertEqual(response.code, Code.BAD_REQUEST)
+		self.assertEqual(response.payload, b'{"error":"Bad GZIP compression"}')
+
+	def test_oscore_too_large(self):
+		resource = _Resource(KeyRegistry())
+		response = asyncio.run(resource.render_post(_request(b'\0' * (ClientResource._MaxCompressedSize + 1), [':c1'])))
+		self.assertEqual(response.code, Code.REQUEST_ENTITY_TOO_LARGE)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+from unittest.mock import patch
+from fogcoap.metadata_cache import MetadataCache
+
+
+class MetadataCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.now = 100.0
+		patcher = patch('fogcoap.metadata_cache.monotonic', lambda: self.now)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def test_lru_eviction(self):
+		cache = MetadataCache(max_size=2)
+		cache.put(('a',), 1)
+		cache.put(('b',), 2)
+		# Used, so 'b' becomes the least recently used
+		self.assertEqual(cache.get('a'), 1)
+		cache.put(('c',), 3)
+
+		self.assertIs(cache.get('b'), MetadataCache.MISSING)
+		self.assertEqual(cache.get('a'), 1)
+		self.assertEqual(cache.get('c'), 3)
+		self.assertEqual(len(cache), 2)
+
+	def test_eviction_removes_every_key_of_the_entry(self):
+		cache = MetadataCache(max_size=3)
+		cache.put(('name', 'id'), 1)
+		cache.put(('other', 'other id'), 2)
+
+		self.assertIs(cache.get('name'), MetadataCache.MISSING)
+		self.assertIs(cache.get('id'), MetadataCache.MISSING)
+		self.assertEqual(cache.get('other id'), 2)
+		self.assertEqual(len(cache), 2)
+
+	def test_invalidate_any_key(self):
+		cache = MetadataCache()
+		cache.put(('name', 'id'), 1)
+		cache.invalidate('id')
+
+		self.assertIs(cache.get('name'), MetadataCache.MISSING)
+		self.assertEqual(len(cache), 0)
+		# Invalidating something not cached is fine
+		cache.invalidate('name')
+
+	def test_put_replaces_entries_sharing_a_key(self):
+		cache = MetadataCache()
+		cache.put(('name', 'old id'), 1)
+		cache.put(('name', 'new id'), 2)
+
+		self.assertIs(cache.get('old id'), MetadataCache.MISSING)
+		self.assertEqual(cache.get('name'), 2)
+		self.assertEqual(cache.get('new id'), 2)
+
+	def test_ttl(self):
+		cache = MetadataCache(ttl=10, negative_ttl=1)
+		cache.put(('a',), 1)
+		cache.put_missing('b')
+		self.assertIs(cache.get('b'), MetadataCache.NOT_FOUND)
+
+		self.now += 5
+		self.assertEqual(cache.get('a'), 1)
+		self.assertIs(cache.get('b'), MetadataCache.MISSING)
+
+		self.now += 5
+		self.assertIs(cache.get('a'), MetadataCache.MISSING)
+		self.assertEqual(len(cache), 0)
+
+	def test_no_ttl(self):
+		cache = MetadataCache(ttl=None)
+		cache.put(('a',), 1)
+		self.now += 10 ** 9
+		self.assertEqual(cache.get('a'), 1)
+
+	def test_misses_not_cached(self):
+		cache = MetadataCache(negative_ttl=0)
+		cache.put_missing('a')
+		self.assertIs(cache.get('a'), MetadataCache.MISSING)
+
+	def test_clear(self):
+		cache = MetadataCache()
+		cache.put(('a', 'b'), 1)
+		cache.clear()
+		self.assertEqual(len(cache), 0)
+
+	def test_invalid_size(self):
+		with self.assertRaises(ValueError):
+			MetadataCache(max_size=0)
+
+
+if __name__ == '__main__':
+	unittest.main()
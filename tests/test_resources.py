@@ -0,0 +1,189 @@
+import json
+import asyncio
+import unittest
+from datetime import datetime
+from gzip import compress as gzcompress, decompress as gzdecompress
+from aiocoap import Message, Code
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+from fogcoap.admission import AdmissionController
+from fogcoap.resources import ListClientsResource, DatatypeResource, ClientResource, AllLatestResource
+from fogcoap.streaming import PayloadTooLarge, PayloadError
+
+
+class _ListManager:
+	# The parts of the database manager used by the list resources
+	async_mode = False
+	stats_version = 0
+
+	def __init__(self):
+		self.clients = [{'name': 'c1'}]
+		self.failures = 0
+
+	def add_registry_listener(self, callback):
+		self.registry_changed = callback
+
+	def query_clients(self):
+		if self.failures > 0:
+			self.failures -= 1
+			raise AutoReconnect('down')
+		return self.clients
+
+	def query_client(self, name: str):
+		return next((client for client in self.clients if client['name'] == name), None)
+
+	def query_stats(self):
+		return {}
+
+	async def run_async(self, func, *args):
+		await asyncio.sleep(0)
+		return func(*args)
+
+
+class ListResourceTest(unittest.TestCase):
+	def test_failed_load_is_retried(self):
+		dm = _ListManager()
+		dm.failures = 1
+		resource = ListClientsResource(dm)
+
+		async def requests():
+			with self.assertRaises(AutoReconnect):
+				await resource.render_get(Message(code=Code.GET))
+			return await resource.render_get(Message(code=Code.GET))
+
+		response = asyncio.run(requests())
+		self.assertIn('c1', resource._entries)
+		self.assertIsNotNone(response.opt.etag)
+
+	def test_concurrent_requests_share_the_load(self):
+		resource = ListClientsResource(_ListManager())
+
+		async def requests():
+			return await asyncio.gather(*(resource.render_get(Message(code=Code.GET)) for _ in range(3)))
+
+		responses = asyncio.run(requests())
+		self.assertEqual(len({response.payload for response in responses}), 1)
+		self.assertEqual(len({response.opt.etag for response in responses}), 1)
+
+
+class _Observation:
+	def __init__(self):
+		self.triggers = 0
+
+	def accept(self, cancellation_callback):
+		self.cancel = cancellation_callback
+
+	def trigger(self, response=None):
+		self.triggers += 1
+
+
+def _reading(value: int) -> dict:
+	return {'_id': ObjectId(), 'value': value, 'datetime': datetime.fromtimestamp(1000 + value)}
+
+
+class DataResourceTest(unittest.TestCase):
+	def test_readings_published_before_sending_are_merged(self):
+		resource = DatatypeResource('temp', None, observable=True)
+		request = Message(code=Code.GET)
+		observation = _Observation()
+
+		async def notify():
+			await resource.add_observation(request, observation)
+			# Published before the first notification is rendered
+			resource.publish({'c1': [_reading(0)]})
+			resource.publish({'c1': [_reading(1)], 'c2': [_reading(2)]})
+			return await resource.render(request)
+
+		response = asyncio.run(notify())
+		data = json.loads(gzdecompress(response.payload))['d']
+		self.assertEqual([reading['value'] for reading in data['c1']], [0, 1])
+		self.assertEqual([reading['value'] for reading in data['c2']], [2])
+		self.assertEqual(observation.triggers, 2)
+		self.assertEqual(resource._unsent, {})
+
+	def test_filtered_readings_are_not_queued(self):
+		resource = DatatypeResource('temp', None, observable=True)
+		request = Message(code=Code.GET, payload=gzcompress(b'{"c":"c2"}'))
+		observation = _Observation()
+
+		async def notify():
+			await resource.add_observation(request, observation)
+			resource.publish({'c1': [_reading(0)]})
+
+		asyncio.run(notify())
+		self.assertEqual(observation.triggers, 0)
+		self.assertEqual(resource._unsent, {})
+
+		observation.cancel()
+		self.assertEqual(resource._filters, {})
+
+
+class _InsertManager:
+	def __init__(self):
+		self.inserted = []
+
+	def insert_data(self, client: str, data: dict) -> ObjectId:
+		self.inserted.append(data)
+		return ObjectId()
+
+
+class MaxReadingsTest(unittest.TestCase):
+	def _insert(self, readings, max_readings: int = 2):
+		dm = _InsertManager()
+		resource = ClientResource('c1', None, dm, admission=AdmissionController(max_readings=max_readings))
+		return dm, resource._insert_all(readings)
+
+	def test_too_many_readings_insert_nothing(self):
+		dm, (insert_status, _, one_successful, error) = self._insert(iter([{'n': 'temp'}] * 3))
+		self.assertIsInstance(error, PayloadTooLarge)
+		self.assertEqual(insert_status, [])
+		self.assertFalse(one_successful)
+		self.assertEqual(dm.inserted, [])
+
+	def test_readings_up_to_the_limit_are_inserted(self):
+		dm, (insert_status, _, one_successful, error) = self._insert(iter([{'n': 'temp'}] * 2))
+		self.assertIsNone(error)
+		self.assertTrue(one_successful)
+		self.assertEqual(len(dm.inserted), 2)
+
+	def test_error_within_the_limit_keeps_the_readings_before_it(self):
+		def readings():
+			yield {'n': 'temp'}
+			raise PayloadError('Bad JSON format')
+
+		dm, (insert_status, _, one_successful, error) = self._insert(readings())
+		self.assertEqual(str(error), 'Bad JSON format')
+		self.assertEqual(len(insert_status), 1)
+		self.assertEqual(len(dm.inserted), 1)
+
+
+class _LatestManager:
+	def __init__(self):
+		self.queries = 0
+		self.latest = {'c1': {'temp': {'value': 1, 'datetime': datetime.fromtimestamp(1000)}}}
+
+	def query_latest(self):
+		self.queries += 1
+		return self.latest
+
+
+class AllLatestResourceTest(unittest.TestCase):
+	def test_payload_is_built_once_per_change(self):
+		dm = _LatestManager()
+		resource = AllLatestResource(dm)
+
+		async def renders():
+			# Every observer renders the notification of each change
+			for _ in range(2):
+				resource.changed()
+				payloads = [(await resource.render_get(Message(code=Code.GET))).payload for _ in range(5)]
+				self.assertEqual(len(set(payloads)), 1)
+			return payloads[0]
+
+		payload = asyncio.run(renders())
+		self.assertEqual(dm.queries, 2)
+		self.assertEqual(json.loads(gzdecompress(payload)), {'c1': {'temp': {'value': 1, 'datetime': 1000}}})
+
+
+if __name__ == '__main__':
+	unittest.main()
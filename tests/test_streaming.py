@@ -0,0 +1,103 @@
+import gzip
+import json
+import unittest
+from aiocoap import Code
+from fogcoap.streaming import PayloadError, PayloadTooLarge, inflate_gzip, iter_json_array
+from fogcoap.resources import _precheck_gzip
+
+
+def _split(data: bytes, size: int) -> list:
+	return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class InflateGzipTest(unittest.TestCase):
+	def test_small_chunks(self):
+		data = bytes(range(256)) * 100
+		chunks = list(inflate_gzip(gzip.compress(data), len(data), chunk_size=7))
+		self.assertEqual(b''.join(chunks), data)
+		self.assertTrue(all(len(chunk) <= 7 for chunk in chunks))
+
+	def test_concatenated_members(self):
+		payload = gzip.compress(b'[1,') + gzip.compress(b'2]')
+		self.assertEqual(b''.join(inflate_gzip(payload, 100)), b'[1,2]')
+
+	def test_truncated(self):
+		payload = gzip.compress(b'[1, 2, 3]' * 100)
+		with self.assertRaises(PayloadError):
+			list(inflate_gzip(payload[:len(payload) // 2], 10000))
+
+	def test_bad_compression(self):
+		with self.assertRaises(PayloadError):
+			list(inflate_gzip(b'\x1f\x8b\x08' + b'\x00' * 7 + b'not deflate', 10000))
+
+	def test_size_cap(self):
+		# A small payload inflating far past the limit is stopped without inflating it all
+		payload = gzip.compress(b'0' * 10000000)
+		inflated = 0
+		with self.assertRaises(PayloadTooLarge):
+			for chunk in inflate_gzip(payload, 100000, chunk_size=1000):
+				inflated += len(chunk)
+		self.assertLessEqual(inflated, 100000)
+
+	def test_exact_size_is_accepted(self):
+		self.assertEqual(b''.join(inflate_gzip(gzip.compress(b'x' * 100), 100)), b'x' * 100)
+
+
+class IterJsonArrayTest(unittest.TestCase):
+	_Items = [{'n': 'temp', 'v': 21.5, 't': 1546336800}, {'n': 'text', 'v': 'ação', 't': '2019-01-01 10:00:00'}, 12345, [1, 2], None, True]
+
+	def test_every_chunk_size(self):
+		text = json.dumps(self._Items, ensure_ascii=False).encode('utf-8')
+		for size in range(1, len(text) + 1):
+			with self.subTest(size=size):
+				self.assertEqual(list(iter_json_array(_split(text, size))), self._Items)
+
+	def test_number_split_at_chunk_end(self):
+		self.assertEqual(list(iter_json_array([b'[12', b'34', b'5]'])), [12345])
+
+	def test_empty_array(self):
+		self.assertEqual(list(iter_json_array([b' [ ', b' ] '])), [])
+
+	def test_not_an_array(self):
+		with self.assertRaisesRegex(PayloadError, 'not an array'):
+			list(iter_json_array([b'{"n": 1}']))
+
+	def test_items_before_an_error_are_yielded(self):
+		items = []
+		with self.assertRaises(PayloadError):
+			for item in iter_json_array([b'[1, 2, ', b'{bad']):
+				items.append(item)
+		self.assertEqual(items, [1, 2])
+
+	def test_unterminated(self):
+		with self.assertRaises(PayloadError):
+			list(iter_json_array([b'[1, 2']))
+
+	def test_trailing_data(self):
+		with self.assertRaises(PayloadError):
+			list(iter_json_array([b'[1] 2']))
+
+	def test_bad_utf8(self):
+		with self.assertRaises(PayloadError):
+			list(iter_json_array([b'["\xff"]']))
+
+
+class PrecheckGzipTest(unittest.TestCase):
+	def test_valid(self):
+		self.assertIsNone(_precheck_gzip(gzip.compress(b'[1, 2, 3]'), 1000, 200))
+
+	def test_too_short(self):
+		self.assertEqual(_precheck_gzip(gzip.compress(b'')[:17], 1000, 200).code, Code.BAD_REQUEST)
+
+	def test_not_gzip(self):
+		self.assertEqual(_precheck_gzip(b'[' + b' ' * 30 + b']', 1000, 200).code, Code.BAD_REQUEST)
+
+	def test_declared_size_over_limit(self):
+		self.assertEqual(_precheck_gzip(gzip.compress(b'0' * 2000), 1000, 10000).code, Code.REQUEST_ENTITY_TOO_LARGE)
+
+	def test_declared_ratio_over_limit(self):
+		self.assertEqual(_precheck_gzip(gzip.compress(b'0' * 100000), 10 ** 9, 200).code, Code.REQUEST_ENTITY_TOO_LARGE)
+
+
+if __name__ == '__main__':
+	unittest.main()